@@ -1,24 +1,378 @@
 #!/usr/bin/python
 
 # fastafetch.py -- extract sequences from a fasta file, web UI for samtools faidx
+#
+# Sequences are read directly from the FASTA file (memory-mapped), using
+# the samtools faidx index (<file>.fai) to find them. Sequence names are
+# listed and searched using a sorted name catalogue for each file, which
+# is rebuilt when the index changes. Regions listed in an uploaded BED
+# file or ID list are read in file order, and downloaded (in the order
+# listed) as a gzip-compressed FASTA file.
 
 import cgi # for cgi forms
 import cgitb # for cgi trace-back
 import re # for regular expression parsing
 import os # file existence, urandom [sessionIDs]
+import sys # for output streams
+import cStringIO # for collecting WSGI output
 import base64 # for encoding sessionIDs
-import subprocess # for running external programs
+import mmap # for reading FASTA files and name catalogues
+import tempfile # for writing name catalogues
+import zlib # for compressing bulk downloads
 import csv # for parsing csv files (e.g. blast output)
 import time # for results file cleanup
-import tempfile # for blast results
 from Bio.Blast import NCBIXML # for XML parsing
 from decimal import Decimal # for scientific notation
 
 # set-up variables
 fastaDBdir = 'db/fasta/'
-runFetch = False
+catalogueDir = fastaDBdir + 'catalogue/'
+fastaLineLength = 60 # as for samtools faidx
+namesPerPage = 1000 # sequence names shown per page
 
-def printHiddenValues(lastForm, parameters):
+# open FASTA files and name catalogues, and the list of FASTA files, kept
+# between requests when run as a WSGI application
+fastaCache = dict()
+catalogueCache = dict()
+fastaListCache = dict()
+
+class FastaFile(object):
+    # a FASTA file with a samtools faidx index; index entries are looked
+    # up as they are needed, rather than reading the whole index
+    def __init__(self, fastaPath):
+        self.path = fastaPath
+        self.entries = dict() # name -> (length, offset, lineBases, lineWidth)
+        self.data = ''
+        with open(fastaPath, 'rb') as fastaFile:
+            if(os.fstat(fastaFile.fileno()).st_size > 0):
+                self.data = mmap.mmap(fastaFile.fileno(), 0,
+                                      access = mmap.ACCESS_READ)
+    def lookup(self, names):
+        # reads index entries for names (None if a name isn't in the index)
+        missing = set(x for x in names if not (x in self.entries))
+        if(missing):
+            with open(self.path + '.fai', 'r') as faiFile:
+                for line in faiFile:
+                    name = line[:line.find('\t')]
+                    if(name in missing):
+                        self.entries[name] = tuple(
+                            int(x) for x in line.split('\t')[1:5])
+                        missing.discard(name)
+                        if(not missing):
+                            break
+            for name in missing:
+                self.entries[name] = None
+    def entry(self, name):
+        self.lookup([name])
+        return self.entries[name]
+    def blocks(self, name, start, end, blockSize = fastaLineLength * 16384):
+        # yields the sequence from start to end (1-based, inclusive), in
+        # blocks of blockSize bases without line breaks
+        (length, offset, lineBases, lineWidth) = self.entry(name)
+        end = min(end, length)
+        for blockStart in xrange(start - 1, end, blockSize):
+            blockEnd = min(blockStart + blockSize, end) - 1
+            startPos = offset + (blockStart // lineBases) * lineWidth + (blockStart % lineBases)
+            endPos = offset + (blockEnd // lineBases) * lineWidth + (blockEnd % lineBases)
+            yield self.data[startPos:(endPos + 1)].translate(None, '\r\n')
+
+def fastaFile(fastaPath):
+    # returns the FastaFile for a path, re-opening it if the file or its
+    # index has changed
+    signature = tuple((os.stat(x).st_mtime, os.stat(x).st_size)
+                      for x in (fastaPath, fastaPath + '.fai'))
+    if((not (fastaPath in fastaCache)) or
+       (fastaCache[fastaPath][0] != signature)):
+        fastaCache[fastaPath] = (signature, FastaFile(fastaPath))
+    return fastaCache[fastaPath][1]
+
+class NameCatalogue(object):
+    # sorted sequence names, one per line after a header line (which
+    # ends with the number of names); data is a memory-mapped catalogue
+    # file (or a string)
+    def __init__(self, data):
+        self.data = data
+        self.start = data.find('\n') + 1
+        self.end = len(data)
+        self.numNames = int(data[:(self.start - 1)].split()[-1])
+    def bisect(self, key):
+        # returns the offset of the first name that is not less than key
+        (low, high) = (self.start, self.end)
+        while(low < high):
+            lineStart = self.data.rfind('\n', 0, (low + high) // 2) + 1
+            lineEnd = self.data.find('\n', lineStart)
+            if(self.data[lineStart:lineEnd] < key):
+                low = lineEnd + 1
+            else:
+                high = lineStart
+        return low
+    def skipLines(self, pos, numLines, end):
+        # returns the offset numLines names after pos
+        while((numLines > 0) and (pos < end)):
+            chunk = self.data[pos:min(pos + 1048576, end)]
+            chunkLines = chunk.count('\n')
+            if(chunkLines == 0):
+                numLines -= 1
+                pos = self.data.find('\n', pos, end) + 1 or end
+            elif(chunkLines < numLines):
+                numLines -= chunkLines
+                pos += chunk.rfind('\n') + 1
+            else:
+                pos += len(chunk) - len(chunk.split('\n', numLines)[-1])
+                numLines = 0
+        return pos
+    def countLines(self, start, end, blockSize = 1048576):
+        # number of names from start to end, counted a block at a time
+        return sum(self.data[pos:min(pos + blockSize, end)].count('\n')
+                   for pos in xrange(start, end, blockSize))
+    def prefixSearch(self, prefix, first, count):
+        # returns (number of names starting with prefix, names [first,
+        # first + count) of those)
+        (start, end, total) = (self.start, self.end, self.numNames)
+        if(prefix):
+            start = self.bisect(prefix)
+            end = self.bisect(prefix + '\xff')
+            total = self.countLines(start, end)
+        pos = self.skipLines(start, first, end)
+        names = self.data[pos:self.skipLines(pos, count, end)].split('\n')[:-1]
+        return (total, names)
+    def substringSearch(self, text, first, count):
+        # returns (number of names containing text, names [first,
+        # first + count) of those); names are checked in large chunks
+        total = 0
+        names = list()
+        pos = self.start
+        while(pos < self.end):
+            chunkEnd = self.data.rfind('\n', pos, min(pos + 4194304, self.end)) + 1
+            if(chunkEnd <= pos):
+                chunkEnd = self.data.find('\n', pos) + 1
+            chunk = self.data[pos:chunkEnd]
+            pos = chunkEnd
+            if(not (text in chunk)):
+                continue
+            matches = [x for x in chunk.split('\n') if text in x]
+            if((total + len(matches) > first) and (len(names) < count)):
+                names.extend(matches[max(first - total, 0):][:(count - len(names))])
+            total += len(matches)
+        return (total, names)
+
+def nameCatalogue(fastaPath):
+    # returns the NameCatalogue for a FASTA file, rebuilding the
+    # catalogue file if it was made from a different index
+    faiStat = os.stat(fastaPath + '.fai')
+    signature = '# %d %.6f' % (faiStat.st_size, faiStat.st_mtime)
+    if((fastaPath in catalogueCache) and
+       (catalogueCache[fastaPath][0] == signature)):
+        return catalogueCache[fastaPath][1]
+    fileName = catalogueDir + os.path.basename(fastaPath) + '.names'
+    try:
+        with open(fileName, 'r') as catalogueFile:
+            header = catalogueFile.readline().rstrip('\n')
+            upToDate = (header.rsplit(' ', 1)[0] == signature)
+    except IOError:
+        upToDate = False
+    if(not upToDate):
+        with open(fastaPath + '.fai', 'r') as faiFile:
+            names = [line.split()[0] for line in faiFile if line.strip()]
+        names.sort()
+        text = '\n'.join(['%s %d' % (signature, len(names))] + names) + '\n'
+        try:
+            if(not os.path.isdir(catalogueDir)):
+                os.makedirs(catalogueDir)
+            # write to a temporary file then rename, so other requests
+            # never see a partially-written catalogue
+            tmpFile = tempfile.NamedTemporaryFile(dir = catalogueDir,
+                                                  delete = False)
+            tmpFile.write(text)
+            tmpFile.close()
+            os.rename(tmpFile.name, fileName)
+        except (IOError, OSError):
+            # can't save the catalogue, so only use it for this request
+            return NameCatalogue(text)
+    with open(fileName, 'rb') as catalogueFile:
+        catalogue = NameCatalogue(mmap.mmap(catalogueFile.fileno(), 0,
+                                            access = mmap.ACCESS_READ))
+    catalogueCache[fastaPath] = (signature, catalogue)
+    return catalogue
+
+def listFastaFiles():
+    # names of indexed FASTA files; the directory is only read again
+    # when it changes
+    dirTime = os.stat(fastaDBdir).st_mtime
+    if(fastaListCache.get('mtime') != dirTime):
+        fastaListCache['names'] = [x[:-4] for x in sorted(os.listdir(fastaDBdir))
+                                   if x.endswith('.fai')]
+        fastaListCache['mtime'] = dirTime
+    return fastaListCache['names']
+
+def pageButtons(page, numPages):
+    # buttons for the first, last, and nearby pages of names
+    if(numPages <= 1):
+        return('')
+    buttonText = '<p>Page:'
+    lastShown = 0
+    for pageNum in xrange(1, numPages + 1):
+        if((pageNum != 1) and (pageNum != numPages) and
+           (abs(pageNum - page) > 3)):
+            continue
+        if(pageNum > lastShown + 1):
+            buttonText += ' ...'
+        if(pageNum == page):
+            buttonText += ' <b>%d</b>' % pageNum
+        else:
+            buttonText += (' <button type="submit" name="listPage" value="%d">%d</button>'
+                           % (pageNum, pageNum))
+        lastShown = pageNum
+    buttonText += '</p>\n'
+    return(buttonText)
+
+def parseRegion(fasta, region):
+    # 'name', 'name:start' or 'name:start-end' -> (name, start, end) with
+    # 1-based inclusive positions (end is None for the end of the
+    # sequence), or None if the region can't be understood. As with
+    # samtools, a name containing ':' is used as-is if it is in the index.
+    if(fasta.entry(region) or not (':' in region)):
+        return (region, 1, None)
+    (name, seqRange) = region.rsplit(':', 1)
+    rangeMatch = re.match('^([0-9]+)(?:-([0-9]*))?$', seqRange.replace(',', ''))
+    if(not rangeMatch):
+        return None
+    start = max(int(rangeMatch.group(1)), 1)
+    end = int(rangeMatch.group(2)) if rangeMatch.group(2) else None
+    return (name, start, end)
+
+def writeRegion(fasta, name, start, end, header, outFile = sys.stdout):
+    # writes one region in FASTA format; returns an error message, or
+    # None if the region was written
+    entry = fasta.entry(name)
+    if(not entry):
+        return 'The sequence "%s" not found' % name
+    if(end == None):
+        end = entry[0]
+    outFile.write('>%s\n' % header)
+    for block in fasta.blocks(name, start, end):
+        for linePos in xrange(0, len(block), fastaLineLength):
+            outFile.write(block[linePos:(linePos + fastaLineLength)] + '\n')
+    return None
+
+def readRegionList(fasta, lines):
+    # reads a BED file, or a list of IDs/regions (one per line); returns
+    # (regions, errors), with one region (name, start, end, header) for
+    # each line, in the order given. The header is the BED name column
+    # (or region) for BED lines, and the ID as written for other lines.
+    requests = list()
+    for (lineNum, line) in enumerate(lines, 1):
+        fields = line.split()
+        if((not fields) or fields[0].startswith('#') or
+           (fields[0] in ('track', 'browser'))):
+            continue
+        requests.append((lineNum, fields))
+    # look up all names with one pass through the index
+    fasta.lookup([x[1][0] for x in requests] +
+                 [x[1][0].rsplit(':', 1)[0] for x in requests])
+    regions = list()
+    errors = list()
+    for (lineNum, fields) in requests:
+        if((len(fields) >= 3) and fields[1].isdigit() and fields[2].isdigit()):
+            # BED positions are 0-based, with an exclusive end
+            region = (fields[0], int(fields[1]) + 1, int(fields[2]))
+            header = (fields[3] if (len(fields) >= 4) else
+                      '%s:%d-%s' % (fields[0], region[1], fields[2]))
+        else:
+            region = parseRegion(fasta, fields[0])
+            header = fields[0]
+        if(region == None):
+            errors.append('Unable to parse region "%s" (line %d)' %
+                          (fields[0], lineNum))
+            continue
+        (name, start, end) = region
+        entry = fasta.entry(name)
+        if(not entry):
+            errors.append('The sequence "%s" not found (line %d)' %
+                          (name, lineNum))
+            continue
+        end = entry[0] if (end == None) else min(end, entry[0])
+        if(start > end):
+            errors.append('The region "%s" is empty or outside the sequence (line %d)' %
+                          (' '.join(fields[0:3]), lineNum))
+            continue
+        regions.append((name, start, end, header))
+    return (regions, errors)
+
+def fastaLines(block):
+    return ''.join(block[linePos:(linePos + fastaLineLength)] + '\n'
+                   for linePos in xrange(0, len(block), fastaLineLength))
+
+def fastaStream(fasta, regions, batchBases = 16777216):
+    # yields regions in FASTA format, in the order given. Regions are
+    # read in batches of up to batchBases, sorted by their position in
+    # the FASTA file so that it is read sequentially; a region larger
+    # than that is streamed on its own.
+    batchStart = 0
+    while(batchStart < len(regions)):
+        batchEnd = batchStart + 1
+        batchSize = regions[batchStart][2] - regions[batchStart][1] + 1
+        while((batchEnd < len(regions)) and
+              (batchSize + regions[batchEnd][2] - regions[batchEnd][1] + 1
+               <= batchBases)):
+            batchSize += regions[batchEnd][2] - regions[batchEnd][1] + 1
+            batchEnd += 1
+        batch = regions[batchStart:batchEnd]
+        batchStart = batchEnd
+        if(len(batch) == 1):
+            (name, start, end, header) = batch[0]
+            yield '>%s\n' % header
+            for block in fasta.blocks(name, start, end):
+                yield fastaLines(block)
+            continue
+        sequences = dict()
+        for index in sorted(xrange(len(batch)), key = lambda x:
+                            (fasta.entry(batch[x][0])[1], batch[x][1])):
+            (name, start, end, header) = batch[index]
+            sequences[index] = ''.join(fasta.blocks(name, start, end))
+        for (index, (name, start, end, header)) in enumerate(batch):
+            yield '>%s\n' % header + fastaLines(sequences.pop(index))
+
+def gzipStream(pieces, chunkSize = 1048576):
+    # yields gzip-compressed data for pieces, compressing about chunkSize
+    # bytes at a time
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    buffered = list()
+    bufferedSize = 0
+    for piece in pieces:
+        buffered.append(piece)
+        bufferedSize += len(piece)
+        if(bufferedSize >= chunkSize):
+            data = compressor.compress(''.join(buffered))
+            (buffered, bufferedSize) = (list(), 0)
+            if(data):
+                yield data
+    yield compressor.compress(''.join(buffered)) + compressor.flush()
+
+def isBulkFetch(form):
+    return((form.getfirst('fetch', '') == 'fetchFASTA') and
+           (form.getfirst('seqOpt', '') == 'getBulk'))
+
+def bulkFetch(form):
+    # fetches the regions in an uploaded file; returns (download file
+    # name, gzip-compressed FASTA data chunks), or (None, error messages)
+    queryDB = form.getfirst('queryDB', '')
+    if((not ('regionFile' in form)) or isinstance(form['regionFile'], list) or
+       (not form['regionFile'].file)):
+        return (None, ['No BED file or ID list was uploaded'])
+    try:
+        fasta = fastaFile(fastaDBdir + queryDB)
+    except (IOError, OSError) as e:
+        return (None, ['Unable to open "%s": %s' % (queryDB, e)])
+    (regions, errors) = readRegionList(fasta, form['regionFile'].file)
+    if((not regions) and (not errors)):
+        errors.append('No regions were found in the uploaded file')
+    if(errors):
+        return (None, errors)
+    fileName = os.path.basename(queryDB).replace('"', '') + '_regions.fa.gz'
+    return (fileName, gzipStream(fastaStream(fasta, regions)))
+
+def printHiddenValues(lastForm, parameters, outFile = sys.stdout):
     # make sure runBlast state isn't preserved across multiple submits
     # [don't want it to try running more than once]
     parameters['seenFields'].append('runBlast')
@@ -26,94 +380,190 @@ def printHiddenValues(lastForm, parameters):
     for field in parameters['addFields']:
         if(not(field in parameters['seenFields']) and
            field in parameters):
-            print('<input type="hidden" name="%s" value="%s">' %
-                  (field, parameters[field]))
+            outFile.write('<input type="hidden" name="%s" value="%s">\n' %
+                          (field, parameters[field]))
     # add fields from previous form to hidden values
     for field in lastForm:
         if(not(field in parameters['seenFields'])):
-            print('<input type="hidden" name="%s" value="%s">' %
-                  (field, lastForm.getfirst(field)))
+            outFile.write('<input type="hidden" name="%s" value="%s">\n' %
+                          (field, lastForm.getfirst(field)))
 
-def printOptions(lastForm, parameters):
-    print('<p><label accesskey=f>FASTA file: <select name="queryDB">')
+def printOptions(lastForm, parameters, outFile = sys.stdout):
+    outFile.write('<p><label accesskey=f>FASTA file: <select name="queryDB">\n')
     fastaNames = list()
-    for filename in sorted(os.listdir(fastaDBdir)):
-        if(filename.endswith(".fai")):
-            baseName = filename[:-4]
-            if(('queryDB' in parameters) and
-               (baseName == parameters['queryDB'])):
-                fastaNames[0:0] = [baseName]
-            else:
-                fastaNames.append(baseName)
+    for baseName in listFastaFiles():
+        if(('queryDB' in parameters) and
+           (baseName == parameters['queryDB'])):
+            fastaNames[0:0] = [baseName]
+        else:
+            fastaNames.append(baseName)
     for baseName in fastaNames:
-        print('<option value="%s">%s</option>' % (baseName, baseName))
-    print('</select></p>')
-    print('')
-    print('<p class="textOption"><span style="color: white">or </span>' +
-          '<input type="radio" value="getSeq" name="seqOpt" id="optGS" checked />')
-    print('<label>Sequence ID(s): <textarea cols=40 rows=4 id="fastaResult" name="seqID"></textarea>' +
-          '</label></p>')
-    print('<p>or <input type="radio" value="getList" name="seqOpt" id="optGL" />')
-    print('<label for="optGL">List sequences</label></p>')
-    print('<button type="submit" class="blastbutton" name="fetch" value="fetchFASTA">' +
-          'Fetch</button>')
+        outFile.write('<option value="%s">%s</option>\n' % (baseName, baseName))
+    outFile.write('</select></p>\n')
+    outFile.write('\n')
+    seqOpt = parameters.get('seqOpt', 'getSeq')
+    checked = dict((x, ' checked' if (x == seqOpt) else '')
+                   for x in ('getSeq', 'getList', 'getBulk'))
+    outFile.write('<p class="textOption"><span style="color: white">or </span>' +
+                  '<input type="radio" value="getSeq" name="seqOpt" id="optGS"%s />\n' %
+                  checked['getSeq'])
+    outFile.write('<label>Sequence ID(s): <textarea cols=40 rows=4 id="fastaResult" name="seqID"></textarea>' +
+                  '</label></p>\n')
+    outFile.write('<p>or <input type="radio" value="getList" name="seqOpt" id="optGL"%s />\n' %
+                  checked['getList'])
+    outFile.write('<label for="optGL">List sequences</label>\n')
+    searchType = parameters.get('searchType', 'prefix')
+    outFile.write('<select name="searchType" onfocus="document.getElementById(\'optGL\').checked = true">' +
+                  ''.join('<option value="%s"%s>%s</option>' %
+                          (value, ' selected' if (value == searchType) else '', label)
+                          for (value, label) in (('prefix', 'starting with'),
+                                                 ('substring', 'containing'))) +
+                  '</select>\n')
+    outFile.write('<input type="text" size=20 name="nameSearch" value="%s" ' %
+                  cgi.escape(parameters.get('nameSearch', ''), True) +
+                  'onfocus="document.getElementById(\'optGL\').checked = true" /></p>\n')
+    outFile.write('<p>or <input type="radio" value="getBulk" name="seqOpt" id="optBF"%s />\n' %
+                  checked['getBulk'])
+    outFile.write('<label for="optBF">Download regions (gzipped FASTA) from a BED file or ID list:</label>\n')
+    outFile.write('<input type="file" name="regionFile" ' +
+                  'onchange="document.getElementById(\'optBF\').checked = true" /></p>\n')
+    outFile.write('<button type="submit" class="blastbutton" name="fetch" value="fetchFASTA">' +
+                  'Fetch</button>\n')
 
 def loadForm(lastForm, parameters):
     # retrieves data values from the previous form
     for field in lastForm:
         parameters[field] = lastForm.getfirst(field, '')
 
-### Begin Actual Program ###
+def printFetch(parameters, outFile = sys.stdout):
+    # writes the sequence list, or the requested sequences
+    queryPath = fastaDBdir + parameters['queryDB']
+    if(parameters['seqOpt'] == 'getList'):
+        catalogue = nameCatalogue(queryPath)
+        searchText = parameters.get('nameSearch', '').strip()
+        page = 1
+        if(parameters.get('listPage', '').isdigit()):
+            page = max(int(parameters['listPage']), 1)
+        search = catalogue.prefixSearch
+        if(searchText and (parameters.get('searchType') == 'substring')):
+            search = catalogue.substringSearch
+        (numNames, names) = search(searchText, (page - 1) * namesPerPage,
+                                   namesPerPage)
+        numPages = (numNames + namesPerPage - 1) // namesPerPage
+        if((page > numPages) and (numPages > 0)):
+            page = numPages
+            (numNames, names) = search(searchText, (page - 1) * namesPerPage,
+                                       namesPerPage)
+        outFile.write('<h2>Sequence list</h2>\n')
+        outFile.write('<p><em>[From "%s"]</em></p>\n' % parameters['queryDB'])
+        if(searchText):
+            outFile.write('<p>%d sequence names %s "%s"</p>\n' %
+                          (numNames, 'containing' if (search == catalogue.substringSearch)
+                           else 'starting with', cgi.escape(searchText)))
+        if(numPages > 1):
+            outFile.write('<p>Showing names %d-%d of %d</p>\n' %
+                          ((page - 1) * namesPerPage + 1,
+                           (page - 1) * namesPerPage + len(names), numNames))
+        outFile.write('<textarea cols=80 rows=10 id="fastaResult">\n')
+        for seq in names:
+            outFile.write(seq + '\n')
+        outFile.write('</textarea>\n')
+        outFile.write(pageButtons(page, numPages))
+    elif(parameters['seqOpt'] == 'getBulk'):
+        # only shown if the regions couldn't be downloaded
+        outFile.write('<h2>Sequence regions</h2>\n')
+        outFile.write('<p><em>[From "%s"]</em></p>\n' % parameters['queryDB'])
+        outFile.write('<textarea cols=80 rows=10 id="fastaResult">\n')
+        outFile.write('** Error **\n')
+        for error in parameters.get('bulkErrors', []):
+            outFile.write(error + '\n')
+        outFile.write('</textarea>\n')
+    else:
+        outFile.write('<h2>Sequence</h2>\n')
+        outFile.write('<p><em>[From "%s"]</em></p>\n' % parameters['queryDB'])
+        outFile.write('<textarea cols=80 rows=10 id="fastaResult">\n')
+        errors = list()
+        try:
+            fasta = fastaFile(queryPath)
+        except (IOError, OSError) as e:
+            fasta = None
+            errors.append('Unable to open "%s": %s' % (parameters['queryDB'], e))
+        seqIDs = parameters['seqID'].split()
+        if(fasta):
+            # look up all names with one pass through the index
+            fasta.lookup(seqIDs + [x.rsplit(':', 1)[0] for x in seqIDs])
+        for seqID in (seqIDs if fasta else []):
+            if(not ':' in seqID):
+                # prevent too-large sequences from being accidentally included
+                region = (seqID, 1, 19999)
+            else:
+                region = parseRegion(fasta, seqID)
+            if(region == None):
+                errors.append('Unable to parse region "%s"' % seqID)
+                continue
+            error = writeRegion(fasta, region[0], region[1], region[2],
+                                seqID, outFile)
+            if(error):
+                errors.append(error)
+        if(errors):
+            outFile.write('** Error **\n')
+        for error in errors:
+            outFile.write(error + '\n')
+        outFile.write('</textarea>\n')
 
-cgitb.enable() # make errors visible on web pages
-
-form = cgi.FieldStorage()   # FieldStorage object to
-                            # hold the form data
-myparams = {
-    "class_query"  : "taboff",
-    "class_params" : "taboff",
-    "class_results": "taboff",
-    "seenFields"   : list(),
-    "addFields"    : ('resultsExist','sessionID' ,'blastCommand'),
-    }
-
-currentProgram = form.getfirst("selectProgram","blastn")
-currentTab = form.getfirst("selectTab","query")
-
-# overwrite default values with previous form values
-loadForm(form, myparams)
-
-# add sessionID if it doesn't already exist
-if(not('sessionID' in myparams)):
-    myparams['sessionID'] = base64.b64encode(os.urandom(16))
-
-myparams['program'] = currentProgram
-# activate current tab
-myparams['class_' + currentTab] = "tabon"
-
-if(myparams['program'] in ('blastn', 'blastx', 'tblastx')):
-    myparams['inputType'] = 'nucleotide';
-if(myparams['program'] in ('blastp', 'tblastn')):
-    myparams['inputType'] = 'protein';
-
-if('REQUEST_URI' in os.environ):
-    myparams['request_uri'] = os.environ['REQUEST_URI']
-else:
-    myparams['request_uri'] = '[THE FILE YOU RAN]'
-
-# run BLAST (if requested)
-if(form.getfirst("fetch","") == "fetchFASTA"):
-    runFetch = True
-
-if((not('resultsExist' in myparams)) or (myparams['resultsExist'] != 'True')):
-    myparams['class_results'] += " tabdisabled"
-else:
-    # retrieve result file, and display on tab (if tab is visible)
-    if(currentTab == 'results'):
-        myparams['results'] = getResults(myparams)
-
-print('Content-type: text/html\n')
-print '''<html><head>
+def handleRequest(form, requestURI, outFile = sys.stdout, bulkErrors = None):
+    # writes the page (without HTTP header) for a submitted form;
+    # bulkErrors are the reasons a bulk download couldn't be made
+    runFetch = False
+    myparams = {
+        "class_query"  : "taboff",
+        "class_params" : "taboff",
+        "class_results": "taboff",
+        "seenFields"   : list(),
+        "addFields"    : ('resultsExist','sessionID' ,'blastCommand'),
+        }
+
+    currentProgram = form.getfirst("selectProgram","blastn")
+    currentTab = form.getfirst("selectTab","query")
+
+    # overwrite default values with previous form values
+    loadForm(form, myparams)
+    # uploaded regions aren't kept for later requests
+    myparams.pop('regionFile', None)
+    myparams['seenFields'].append('regionFile')
+    if(bulkErrors):
+        myparams['bulkErrors'] = bulkErrors
+
+    # add sessionID if it doesn't already exist
+    if(not('sessionID' in myparams)):
+        myparams['sessionID'] = base64.b64encode(os.urandom(16))
+
+    myparams['program'] = currentProgram
+    # activate current tab
+    myparams['class_' + currentTab] = "tabon"
+
+    if(myparams['program'] in ('blastn', 'blastx', 'tblastx')):
+        myparams['inputType'] = 'nucleotide';
+    if(myparams['program'] in ('blastp', 'tblastn')):
+        myparams['inputType'] = 'protein';
+
+    myparams['request_uri'] = requestURI
+
+    # run BLAST (if requested)
+    if((form.getfirst("fetch","") == "fetchFASTA") or
+       form.getfirst("listPage","")):
+        runFetch = True
+    # the requested page of names isn't kept for later requests
+    myparams['seenFields'].append('listPage')
+
+    if((not('resultsExist' in myparams)) or (myparams['resultsExist'] != 'True')):
+        myparams['class_results'] += " tabdisabled"
+    else:
+        # retrieve result file, and display on tab (if tab is visible)
+        if(currentTab == 'results'):
+            myparams['results'] = getResults(myparams)
+
+    outFile.write('''<html><head>
 <title>FASTA Sequence Fetcher</title>
 <style id="pageStyle" type="text/css">
   .textOption *{
@@ -124,59 +574,78 @@ print '''<html><head>
 <h1>FASTA Sequence Fetcher</h1>
 <em>[Interface to <tt>SAMtools faidx</tt>]</em>
 <form method="post" action="%s" enctype="multipart/form-data">
-''' % (myparams['request_uri'])
-
-printOptions(form, myparams)
-
-printHiddenValues(form, myparams)
-
-print('</form>')
-
-if(runFetch):
-    queryPath = fastaDBdir + myparams['queryDB']
-    if(myparams['seqOpt'] == 'getList'):
-        seqs = list()
-        with open(queryPath + '.fai') as f:
-            print('<h2>Sequence list</h2>')
-            print('<p><em>[From "%s"]</em></p>' % myparams['queryDB'])
-            print('<textarea cols=80 rows=10 id="fastaResult">')
-            for line in f:
-                line = line.split()[0]
-                seqs.append(line)
-        for seq in sorted(seqs):
-            print seq
-        print('</textarea>')
+''' % (myparams['request_uri']) + '\n')
+
+    printOptions(form, myparams, outFile)
+
+    printHiddenValues(form, myparams, outFile)
+
+    # results are inside the form, so that their page buttons work
+    if(runFetch):
+        printFetch(myparams, outFile)
+
+    outFile.write('</form>\n')
+
+    outFile.write('''</body>
+</html>''' + '\n')
+
+def application(environ, start_response):
+    # WSGI entry point, so that a long-running process can serve many
+    # requests (e.g. mod_wsgi, or 'fastafetch.py serve' for local testing)
+    # the FASTA directory is relative to the script directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    form = cgi.FieldStorage(fp = environ['wsgi.input'], environ = environ)
+    requestURI = environ.get('REQUEST_URI')
+    if(not requestURI):
+        requestURI = environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')
+        if(environ.get('QUERY_STRING')):
+            requestURI += '?' + environ['QUERY_STRING']
+    bulkErrors = None
+    if(isBulkFetch(form)):
+        (fileName, result) = bulkFetch(form)
+        if(fileName):
+            # stream the download rather than collecting it
+            start_response('200 OK', [('Content-Type', 'application/x-gzip'),
+                                      ('Content-Disposition',
+                                       'attachment; filename="%s"' % fileName)])
+            return result
+        bulkErrors = result
+    outFile = cStringIO.StringIO()
+    handleRequest(form, requestURI, outFile, bulkErrors)
+    page = outFile.getvalue()
+    start_response('200 OK', [('Content-Type', 'text/html'),
+                              ('Content-Length', str(len(page)))])
+    return [page]
+
+### Begin Actual Program ###
+
+if(__name__ == '__main__'):
+    if((len(sys.argv) > 1) and (sys.argv[1] == 'serve') and
+       not ('GATEWAY_INTERFACE' in os.environ)):
+        # local test server: fastafetch.py serve [port]
+        from wsgiref.simple_server import make_server
+        port = int(sys.argv[2]) if (len(sys.argv) > 2) else 8000
+        sys.stderr.write('Serving on http://localhost:%d/\n' % port)
+        make_server('localhost', port, application).serve_forever()
     else:
-        resultFile = tempfile.TemporaryFile()
-        errorFile = tempfile.TemporaryFile()
-        cmdArgs = ['samtools','faidx', queryPath]
-        seqIDs = myparams['seqID'].split()
-        for seqID in seqIDs:
-            if(not ':' in seqID):
-                # prevent too-large sequences from being accidentally included
-                cmdArgs.append(seqID + ":1-19999")
-            else:
-                cmdArgs.append(seqID)
-        resData = subprocess.call(cmdArgs, stdout=resultFile, stderr=errorFile)
-        errorFile.seek(0)
-        resultFile.seek(0)
-        print('<h2>Sequence</h2>')
-        print('<p><em>[From "%s"]</em></p>' % myparams['queryDB'])
-        print('<textarea cols=80 rows=10 id="fastaResult">')
-        errorAdded = False
-        for line in resultFile:
-            line = line.rstrip()
-            if(line.endswith(":1-19999")): # remove too-large indicator
-                line = line[:-8]
-            print line
-        for line in errorFile:
-            if(not errorAdded):
-                print '** Error **'
-                errorAdded = True
-            print line.rstrip()
-        resultFile.close()
-        errorFile.close()
-        print('</textarea>')
-
-print '''</body>
-</html>'''
+        cgitb.enable() # make errors visible on web pages
+
+        form = cgi.FieldStorage()   # FieldStorage object to
+                                    # hold the form data
+        bulkErrors = None
+        if(isBulkFetch(form)):
+            (fileName, result) = bulkFetch(form)
+            if(fileName):
+                sys.stdout.write('Content-Type: application/x-gzip\n' +
+                                 'Content-Disposition: attachment; filename="%s"\n\n' %
+                                 fileName)
+                for chunk in result:
+                    sys.stdout.write(chunk)
+                sys.exit(0)
+            bulkErrors = result
+        print('Content-type: text/html\n')
+        if('REQUEST_URI' in os.environ):
+            requestURI = os.environ['REQUEST_URI']
+        else:
+            requestURI = '[THE FILE YOU RAN]'
+        handleRequest(form, requestURI, sys.stdout, bulkErrors)
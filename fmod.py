@@ -1,110 +1,426 @@
 #!/usr/bin/python
 
+import os
 import sys
 import array
-import struct
 import wave
 import csv
-from math import sin, asin, pi, log, exp, sqrt
+import numpy
+from math import pi, log
 
 ## Carry out frequency modulation; vary the frequency of a wave based
 ## on a signal
 ##
 ## Here is the rough process:
-# 1) find out the phase of the current frequency at the previous position
-# 2) calculate the new amplitude by adding one time slice to that phase
+# 1) convert the signal into a frequency for each signal sample
+# 2) accumulate the phase advanced by each signal sample
+# 3) fill in the sound samples for each signal sample, starting from
+#    the accumulated phase
+# All steps work on whole NumPy arrays; sound is generated in chunks of
+# signal samples to limit memory use.
+
+def scale_frequencies(signal, minSig, maxSig, minFreq, maxFreq,
+                      logScale=True):
+    ## limit signal to within MAD range, scale to 0..99
+    if(maxSig > minSig):
+        signal = (float(99) * (numpy.clip(signal, minSig, maxSig) - minSig) /
+                  (maxSig - minSig))
+    else:
+        signal = numpy.zeros(len(signal))
+    if(logScale):
+        logRange = log(maxFreq) - log(minFreq)
+        return numpy.exp((numpy.log(signal + 1) / log(100)) * logRange +
+                         log(minFreq))
+    else:
+        linRange = maxFreq - minFreq
+        return (signal / 100) * linRange + minFreq
+
+def synthesize(freqs, phase, stepOffset, oldRate, newRate, volume):
+    ## create sound samples for consecutive signal samples; returns
+    ## 16-bit samples, and the phase at the end of the last signal sample
+    # sound samples for each signal sample
+    steps = numpy.arange(stepOffset, stepOffset + len(freqs))
+    newPerOld = (float(newRate) / (float(oldRate)))
+    sStart = (steps * newPerOld).astype(numpy.int64)
+    sEnd = ((steps + 1) * newPerOld).astype(numpy.int64)
+    # phase at the start of each signal sample
+    sigPhases = numpy.cumsum(freqs * 2 * pi / oldRate)
+    startPhases = (phase + numpy.concatenate(([0], sigPhases[:-1]))) % (2 * pi)
+    outPhaseSteps = freqs * 2 * pi / newRate
+    # signal sample index, and offset within that sample, for each sound sample
+    stepIndex = numpy.repeat(numpy.arange(len(freqs)), sEnd - sStart)
+    stepPos = numpy.arange(len(stepIndex)) - (sStart - sStart[0])[stepIndex]
+    samples = numpy.sin(startPhases[stepIndex] +
+                        stepPos * outPhaseSteps[stepIndex])
+    return ((samples * volume * 32767).astype(numpy.int16),
+            (phase + sigPhases[-1]) % (2 * pi))
+
+def mad_range(signal):
+    ## signal range, limited to within 4 mean absolute deviations of
+    ## the mean
+    meanSig = signal.mean()
+    madSig = numpy.abs(signal - meanSig).mean()
+    return (max(meanSig - madSig * 4, signal.min()),
+            min(meanSig + madSig * 4, signal.max()))
 
 def fmod(outFile, signal, minFreq, maxFreq, oldRate, newRate,
-         speed=1.0, volume=0.8, logScale=True):
+         speed=1.0, volume=0.8, logScale=True, chunkSize=100000):
     oldRate = oldRate * speed
-    logRange = log(maxFreq) - log(minFreq)
-    linRange = maxFreq - minFreq
-    meanSig = sum(signal) / len(signal)
-    madSig = sum(map(lambda x: abs(x - meanSig), signal)) / len(signal)
-    minSig = meanSig - madSig * 4;
-    maxSig = meanSig + madSig * 4;
-    if(min(signal) > minSig):
-        minSig = min(signal)
-    if(max(signal) < maxSig):
-        maxSig = max(signal)
+    signal = numpy.asarray(signal, dtype=numpy.float64)
+    (minSig, maxSig) = mad_range(signal)
     sys.stderr.write("Min: %f, Max: %f, Signal: %d\n" %
                      (minSig, maxSig, len(signal)))
-    ## limit signal to within MAD range, scale to 0..100
-    signal = map(lambda x: float(0) if (x < minSig) else
-                 (float(99) if x > maxSig else
-                  float(99) * (x - minSig) / (maxSig - minSig)), signal)
-    newFreqs = (map(
-        lambda x: exp((log(x + 1) / log(100)) * logRange + log(minFreq)),
-        signal)) if logScale else (
-            map(lambda x: (x/100) * linRange + minFreq, signal))
-    # number of sound samples per signal sample
-    newPerOld  = (float(newRate) / (float(oldRate)))
-    amp = [0] * int(len(signal) * newPerOld)
-    # start in first quadrant [0..pi/2)
-    quadrant = 0
-    oldPhase = 0
-    oldAmplitude = 0
-    for s in xrange(len(signal)-1):
-        ## work out phase of previous signal
-        if(quadrant == 0):
-            oldPhase = asin(oldAmplitude)
-        if(quadrant == 1):
-            oldPhase = pi - asin(oldAmplitude)
-        if(quadrant == 2):
-            oldPhase = pi - asin(oldAmplitude)
-        if(quadrant == 3):
-            oldPhase = 2 * pi + asin(oldAmplitude)
-        newFreq = newFreqs[s+1]
-        ## determine phase step (for input)
-        sigPhaseStep = (newFreq * 2 * pi / oldRate)
-        ## determine phase step (for output)
-        outPhaseStep = (newFreq * 2 * pi / newRate)
-        ## determine new phase
-        newPhase = (oldPhase + sigPhaseStep) % (2 * pi)
-        ## calculate new quadrant
-        quadrant = int(newPhase / (pi/2))
-        ## determine new amplitude
-        oldAmplitude = sin(newPhase)
-        ## write signal to file
-        sStart = int(s*newPerOld);
-        sEnd = int((s+1)*newPerOld);
-        packedSamples = map(
-            lambda x: struct.pack('h',int(sin(oldPhase + x*outPhaseStep) *
-                                          volume * 32767)),
-            xrange(sEnd-sStart))
-        fmodOut.writeframes(''.join(packedSamples))
-
-rate=int(sys.argv[2])
-
-if(".csv" in sys.argv[1]):
-    with open(sys.argv[1]) as csvfile:
+    newFreqs = scale_frequencies(signal, minSig, maxSig, minFreq, maxFreq,
+                                 logScale)
+    # the sound for signal sample s uses the frequency of sample s+1
+    phase = 0
+    for cStart in xrange(0, len(signal) - 1, chunkSize):
+        cEnd = min(cStart + chunkSize, len(signal) - 1)
+        (samples, phase) = synthesize(newFreqs[(cStart+1):(cEnd+1)], phase,
+                                      cStart, oldRate, newRate, volume)
+        outFile.writeframes(samples.tostring())
+
+## Streaming
+## Input is read in blocks of signal samples, and sound is written as
+## each block is processed, carrying the phase (and the position in the
+## sound output) across blocks. The signal range used for scaling is
+## either calculated from two passes through the input (mean, then mean
+## absolute deviation), or from a trailing window of signal samples.
+
+def read_signal_blocks(fileName, blockSize=100000, partial=False):
+    ## yield blocks of signal from a CSV file (second column) or a raw
+    ## file of unsigned 16-bit values ('-' for standard input). With
+    ## partial=True, blocks are yielded as soon as any data is available
+    ## (up to blockSize), rather than waiting for a full block.
+    if(".csv" in fileName):
+        with open(fileName) as csvfile:
+            block = list()
+            # readline avoids the read-ahead buffering of file iteration
+            lines = iter(csvfile.readline, "") if partial else csvfile
+            for row in csv.reader(lines, delimiter=",", quotechar='"'):
+                block.append(float(row[1]))
+                if(len(block) >= blockSize):
+                    yield numpy.array(block, dtype=numpy.float32)
+                    block = list()
+            if(block):
+                yield numpy.array(block, dtype=numpy.float32)
+    else:
+        inFile = sys.stdin if (fileName == "-") else open(fileName, "rb")
+        leftOver = ""
+        while True:
+            if(partial):
+                inData = os.read(inFile.fileno(), blockSize * 2)
+            else:
+                inData = inFile.read(blockSize * 2)
+            if(not inData):
+                break
+            inData = leftOver + inData
+            evenLength = len(inData) - (len(inData) % 2)
+            leftOver = inData[evenLength:]
+            if(evenLength > 0):
+                yield numpy.frombuffer(inData[:evenLength], dtype=numpy.uint16)
+        if(inFile is not sys.stdin):
+            inFile.close()
+
+def two_pass_range(fileName, blockSize=100000):
+    ## MAD-limited signal range for a whole file, using constant memory
+    count = 0
+    sumSig = 0.0
+    minSig = float("inf")
+    maxSig = float("-inf")
+    for block in read_signal_blocks(fileName, blockSize):
+        count += len(block)
+        sumSig += block.sum(dtype=numpy.float64)
+        minSig = min(minSig, block.min())
+        maxSig = max(maxSig, block.max())
+    if(count == 0):
+        return (0, 0)
+    meanSig = sumSig / count
+    sumDev = 0.0
+    for block in read_signal_blocks(fileName, blockSize):
+        sumDev += numpy.abs(block - meanSig).sum()
+    madSig = sumDev / count
+    minSig = max(meanSig - madSig * 4, minSig)
+    maxSig = min(meanSig + madSig * 4, maxSig)
+    sys.stderr.write("Min: %f, Max: %f, Signal: %d\n" %
+                     (minSig, maxSig, count))
+    return (minSig, maxSig)
+
+class WindowRange(object):
+    ## MAD-limited signal range over the most recent signal samples
+    def __init__(self, windowSize):
+        self.windowSize = windowSize
+        self.window = numpy.zeros(0)
+
+    def update(self, block):
+        self.window = numpy.concatenate(
+            (self.window, block))[-self.windowSize:]
+        return mad_range(self.window)
+
+def fmod_stream(outFile, blocks, rangeFunc, minFreq, maxFreq, oldRate,
+                newRate, speed=1.0, volume=0.8, logScale=True):
+    ## frequency modulation of a sequence of signal blocks; rangeFunc
+    ## is called on each block to get the (minimum, maximum) for scaling
+    oldRate = oldRate * speed
+    phase = 0
+    steps = 0
+    firstBlock = True
+    for block in blocks:
+        (minSig, maxSig) = rangeFunc(block)
+        freqs = scale_frequencies(numpy.asarray(block, dtype=numpy.float64),
+                                  minSig, maxSig, minFreq, maxFreq, logScale)
+        # the sound for signal sample s uses the frequency of sample s+1
+        if(firstBlock):
+            freqs = freqs[1:]
+            firstBlock = False
+        if(len(freqs) == 0):
+            continue
+        (samples, phase) = synthesize(freqs, phase, steps, oldRate, newRate,
+                                      volume)
+        outFile.writeframes(samples.tostring())
+        steps += len(freqs)
+
+## fast5 input
+## Raw signal is read directly from '/Raw/Reads/*/Signal' in each fast5
+## file, and one WAV file is written per read. Files are processed in
+## parallel on a process pool.
+
+def render_fast5(fast5Args):
+    ## write a WAV file for each raw read in a fast5 file; returns the
+    ## names of the files that were written
+    (fileName, outPattern, rate, minFreq, maxFreq, outRate) = fast5Args
+    import h5py
+    outNames = list()
+    try:
+        h5File = h5py.File(fileName, 'r')
+    except IOError:
+        sys.stderr.write("Unable to open file '%s' as a fast5 file\n" %
+                         fileName)
+        return outNames
+    with h5File:
+        if(not "/Raw/Reads" in h5File):
+            return outNames
+        if(not rate):
+            rate = h5File['UniqueGlobalKey/channel_id'].attrs["sampling_rate"]
+        for readName in h5File["/Raw/Reads"]:
+            signal = h5File["/Raw/Reads/%s/Signal" % readName][()]
+            if(len(signal) < 2):
+                continue
+            outName = outPattern % {
+                "file": os.path.basename(fileName).replace(".fast5", ""),
+                "read": readName}
+            fmodOut = wave.open(outName, 'w')
+            fmodOut.setparams((1, 2, outRate, 0, 'NONE', 'not compressed'))
+            fmod(outFile=fmodOut, signal=signal, minFreq=minFreq,
+                 maxFreq=maxFreq, speed=1.0, oldRate=rate, newRate=outRate,
+                 volume=0.1)
+            fmodOut.close()
+            outNames.append(outName)
+    return outNames
+
+def count_raw_reads(fileName):
+    ## number of raw reads in a fast5 file (0 if it can't be read)
+    import h5py
+    try:
+        with h5py.File(fileName, 'r') as h5File:
+            if(not "/Raw/Reads" in h5File):
+                return 0
+            return len(h5File["/Raw/Reads"])
+    except IOError:
+        return 0
+
+## Real-time output
+## Raw PCM samples are written in small fixed-size blocks as soon as they
+## are synthesized, so output can be piped to an audio player while
+## input is still being read, e.g.
+##   fmod.py - 4000 -pcm - | aplay -f S16_LE -r 44100 -c 1
+
+class PCMWriter(object):
+    ## wave-like writer for raw 16-bit PCM, emitted in fixed-size blocks
+    def __init__(self, outFile, blockFrames=512):
+        self.outFile = outFile
+        self.blockBytes = blockFrames * 2
+        self.buffer = ""
+
+    def writeframes(self, data):
+        self.buffer += data
+        blockEnd = len(self.buffer) - (len(self.buffer) % self.blockBytes)
+        for pos in xrange(0, blockEnd, self.blockBytes):
+            self.outFile.write(self.buffer[pos:(pos + self.blockBytes)])
+            self.outFile.flush()
+        self.buffer = self.buffer[blockEnd:]
+
+    def close(self):
+        self.outFile.write(self.buffer)
+        self.outFile.flush()
+        self.buffer = ""
+        if(self.outFile is not sys.stdout):
+            self.outFile.close()
+
+def usageQuit(message):
+    sys.stderr.write(message + "\n\n")
+    sys.stderr.write("Usage: %s <signal file> <sample rate> [options]\n" %
+                     sys.argv[0])
+    sys.stderr.write("       %s <fast5 file/directory> [sample rate] [options]\n" %
+                     sys.argv[0])
+    sys.stderr.write(" where <signal file> is a CSV file (signal in column 2)\n")
+    sys.stderr.write(" or raw unsigned 16-bit values ('-' for standard input)\n")
+    sys.stderr.write("\nOptions:\n")
+    sys.stderr.write("  -o <name>    - output file name [default: out.wav];\n")
+    sys.stderr.write("                 for fast5 input, '%(file)s' and '%(read)s'\n")
+    sys.stderr.write("                 are replaced by file and read names\n")
+    sys.stderr.write("                 [default: %(file)s_%(read)s.wav]\n")
+    sys.stderr.write("  -min <Hz>    - minimum frequency [default: 200; CSV: 50]\n")
+    sys.stderr.write("  -max <Hz>    - maximum frequency [default: 1000]\n")
+    sys.stderr.write("  -p <procs>   - processes for fast5 input [default: cpu count]\n")
+    sys.stderr.write("  -s           - stream input in blocks (constant memory)\n")
+    sys.stderr.write("  -pcm <file>  - real-time raw PCM output (signed 16-bit,\n")
+    sys.stderr.write("                 mono, 44100Hz) to file/pipe ('-' for stdout)\n")
+    sys.stderr.write("  -b <samples> - input block size for real-time output\n")
+    sys.stderr.write("                 [default: 20ms of signal]\n")
+    sys.stderr.write("  -w <samples> - stream, scaling by a trailing window\n")
+    sys.stderr.write("                 [default for standard input: 10s]\n")
+    sys.exit(1)
+
+if(len(sys.argv) < 2):
+    usageQuit("Error: no signal file provided")
+
+inName = sys.argv[1]
+fast5Input = os.path.isdir(inName) or inName.endswith(".fast5")
+optArgs = sys.argv[2:]
+rate = None
+if(optArgs and optArgs[0].isdigit()):
+    rate = int(optArgs.pop(0))
+elif(not fast5Input):
+    usageQuit("Error: no sample rate provided")
+streamInput = (inName == "-")
+windowSize = rate * 10 if (inName == "-") else 0
+outName = "%(file)s_%(read)s.wav" if fast5Input else "out.wav"
+minFreq = 50 if (".csv" in inName) else 200
+maxFreq = 1000
+processes = None
+pcmName = None
+pcmBlockSize = None
+while(optArgs):
+    opt = optArgs.pop(0)
+    try:
+        if(opt == "-s"):
+            streamInput = True
+        elif(opt == "-w"):
+            streamInput = True
+            windowSize = int(optArgs.pop(0))
+        elif(opt == "-o"):
+            outName = optArgs.pop(0)
+        elif(opt == "-min"):
+            minFreq = float(optArgs.pop(0))
+        elif(opt == "-max"):
+            maxFreq = float(optArgs.pop(0))
+        elif(opt == "-p"):
+            processes = int(optArgs.pop(0))
+        elif(opt == "-pcm"):
+            pcmName = optArgs.pop(0)
+        elif(opt == "-b"):
+            pcmBlockSize = max(2, int(optArgs.pop(0)))
+        else:
+            usageQuit('Error: unknown option "%s"' % opt)
+    except (IndexError, ValueError):
+        usageQuit('Error: missing or invalid value for option "%s"' % opt)
+if(not (0 < minFreq < maxFreq)):
+    usageQuit("Error: frequencies must satisfy 0 < min < max")
+if(pcmName and fast5Input):
+    usageQuit("Error: real-time output is not available for fast5 input")
+
+outRate = 44100
+
+if(fast5Input):
+    from multiprocessing import Pool
+    fileNames = [inName]
+    if(os.path.isdir(inName)):
+        fileNames = list()
+        for dirPath, dirNames, dirFileNames in os.walk(inName):
+            fileNames.extend(os.path.join(dirPath, x) for x in dirFileNames
+                             if x.endswith(".fast5"))
+    # check the output name pattern here, rather than in the workers:
+    # different (file, read) pairs must not give the same output name
+    try:
+        testNames = dict(((testFile, testRead),
+                          outName % {"file": testFile, "read": testRead})
+                         for testFile in ("file1", "file2")
+                         for testRead in ("read1", "read2"))
+    except (KeyError, ValueError, TypeError):
+        usageQuit('Error: invalid output name pattern "%s"' % outName)
+    clashes = [(x, y) for x in testNames for y in testNames
+               if (x < y) and (testNames[x] == testNames[y])]
+    if((len(fileNames) > 1) and any(x[0] != y[0] for (x, y) in clashes)):
+        usageQuit("Error: output name must include '%(file)s' " +
+                  "for more than one fast5 file")
+    if(any(x[0] == y[0] for (x, y) in clashes) and
+       any(count_raw_reads(x) > 1 for x in fileNames)):
+        usageQuit("Error: output name must include '%(read)s' " +
+                  "for fast5 files with more than one read")
+    pool = Pool(processes)
+    poolArgs = [(fileName, outName, rate, minFreq, maxFreq, outRate)
+                for fileName in sorted(fileNames)]
+    writtenCount = 0
+    for outNames in pool.imap_unordered(render_fast5, poolArgs):
+        writtenCount += len(outNames)
+    pool.close()
+    pool.join()
+    sys.stderr.write("Wrote %d WAV file(s) from %d fast5 file(s)\n" %
+                     (writtenCount, len(fileNames)))
+elif(pcmName):
+    # scaling always uses a trailing window, so output can start immediately
+    if(windowSize == 0):
+        windowSize = rate * 10
+    if(pcmBlockSize is None):
+        pcmBlockSize = max(2, rate // 50)
+    pcmOut = PCMWriter(sys.stdout if (pcmName == "-") else
+                       open(pcmName, "wb"))
+    sys.stderr.write("Writing signed 16-bit mono PCM at %d Hz\n" % outRate)
+    try:
+        fmod_stream(outFile=pcmOut,
+                    blocks=read_signal_blocks(inName, pcmBlockSize,
+                                              partial=True),
+                    rangeFunc=WindowRange(windowSize).update,
+                    minFreq=minFreq, maxFreq=maxFreq, speed=1.0,
+                    oldRate=rate, newRate=outRate, volume=0.1)
+        pcmOut.close()
+    except (IOError, KeyboardInterrupt):
+        pass # audio player or pipe has been closed
+elif(streamInput):
+    fmodOut = wave.open(outName, 'w')
+    fmodOut.setparams((1, 2, outRate, 0, 'NONE', 'not compressed'))
+    if(windowSize > 0):
+        rangeFunc = WindowRange(windowSize).update
+    else:
+        signalRange = two_pass_range(inName)
+        rangeFunc = lambda block: signalRange
+    fmod_stream(outFile=fmodOut, blocks=read_signal_blocks(inName),
+                rangeFunc=rangeFunc, minFreq=minFreq, maxFreq=maxFreq,
+                speed=1.0, oldRate=rate, newRate=outRate, volume=0.1)
+    fmodOut.close()
+elif(".csv" in inName):
+    with open(inName) as csvfile:
         myreader = csv.reader(csvfile, delimiter=",", quotechar='"')
         data = array.array('f')
         for row in myreader:
             data.append(float(row[1]))
-        outRate = 44100
-        fmodOut = wave.open('out.wav', 'w')
+        fmodOut = wave.open(outName, 'w')
         fmodOut.setparams((1, 2, outRate, 0, 'NONE', 'not compressed'))
-        fmod(outFile=fmodOut, signal=data, minFreq=50, maxFreq=1000,
+        fmod(outFile=fmodOut, signal=data, minFreq=minFreq, maxFreq=maxFreq,
              speed=1.0,
              oldRate=rate, newRate=outRate, volume=0.1)
         fmodOut.close()
-    pass
 else:
-    with open(sys.argv[1], "rb") as f:
-        outRate = 44100
+    with open(inName, "rb") as f:
         inData = f.read()
         if(len(inData) % 2 == 1):
             inData = inData[:-1]
         sys.stderr.write("Input length: %d\n" % len(inData))
         data = array.array('H', inData)
-        #print(",".join(map(str,newData[:50])))
-        fmodOut = wave.open('out.wav', 'w')
+        fmodOut = wave.open(outName, 'w')
         fmodOut.setparams((1, 2, outRate, 0, 'NONE', 'not compressed'))
-        fmod(outFile=fmodOut, signal=data, minFreq=200, maxFreq=1000,
+        fmod(outFile=fmodOut, signal=data, minFreq=minFreq, maxFreq=maxFreq,
              speed=1.0,
              oldRate=rate, newRate=outRate, volume=0.1)
         fmodOut.close()
-
-    #with open ("out.raw", "wb") as soundFile:
-    #    soundFile.write(newData)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+'''
+measures per-invocation start-up time for porejuicer.py, as seen by a
+workflow engine that runs it once per file.
+
+Usage: porejuicer-bench.py [-n <iterations>] [fast5 file] [socket path]
+
+Timings are reported (in milliseconds) for:
+  usage     - porejuicer.py with no arguments (usage error)
+  badtype   - porejuicer.py with an incorrect data type
+  telemetry - 'porejuicer.py telemetry <fast5 file>' (if a file is given)
+  client    - 'porejuicer-client.py <socket> telemetry <fast5 file>'
+              (if a running server socket is given)
+'''
+
+import os
+import sys
+import time
+import subprocess
+
+def timeCommand(args, iterations):
+    '''run a command repeatedly, return sorted wall-clock times (ms)'''
+    times = list()
+    with open(os.devnull, 'w') as nullFile:
+        for i in range(iterations):
+            startTime = time.time()
+            subprocess.call(args, stdout=nullFile, stderr=nullFile)
+            times.append((time.time() - startTime) * 1000)
+    return sorted(times)
+
+iterations = 20
+args = sys.argv[1:]
+if((len(args) > 1) and (args[0] == '-n')):
+    iterations = int(args[1])
+    args = args[2:]
+if(('-h' in args) or (len(args) > 2)):
+    sys.stderr.write(__doc__.strip() + "\n")
+    sys.exit(1)
+
+scriptDir = os.path.dirname(os.path.abspath(__file__))
+juicer = os.path.join(scriptDir, 'porejuicer.py')
+client = os.path.join(scriptDir, 'porejuicer-client.py')
+
+tests = [('usage', [sys.executable, juicer]),
+         ('badtype', [sys.executable, juicer, 'badtype', scriptDir])]
+if(len(args) > 0):
+    tests.append(('telemetry', [sys.executable, juicer, 'telemetry', args[0]]))
+if(len(args) > 1):
+    tests.append(('client', [sys.executable, client, args[1],
+                             'telemetry', args[0]]))
+
+sys.stdout.write("test,iterations,min,median,max\n")
+for (testName, testArgs) in tests:
+    times = timeCommand(testArgs, iterations)
+    sys.stdout.write("%s,%d,%0.1f,%0.1f,%0.1f\n" %
+                     (testName, iterations, times[0],
+                      times[len(times) // 2], times[-1]))
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+'''
+sends an extraction request to a running porejuicer server
+('porejuicer.py server <socket path>') and writes the results to
+standard output. Only standard library modules are loaded, so each
+request avoids the h5py/numpy start-up cost of porejuicer.py.
+
+Usage: porejuicer-client.py <socket path> <dataType> <fast5 file name> [options]
+
+The socket path can also be given in the POREJUICER_SOCKET environment
+variable, in which case it is omitted from the arguments.
+'''
+
+import os
+import sys
+import socket
+from struct import unpack
+
+def readExact(sockFile, length):
+    data = sockFile.read(length)
+    if(len(data) < length):
+        sys.stderr.write("Error: connection closed by server\n")
+        sys.exit(1)
+    return data
+
+args = sys.argv[1:]
+if('POREJUICER_SOCKET' in os.environ):
+    args[0:0] = [os.environ['POREJUICER_SOCKET']]
+if(len(args) < 3):
+    sys.stderr.write(__doc__.strip() + "\n")
+    sys.exit(1)
+
+socketPath = args[0]
+requestArgs = args[1:]
+# paths are interpreted by the server, so make them absolute
+requestArgs[1] = os.path.abspath(requestArgs[1])
+if('-o' in requestArgs[2:-1]):
+    prefixPos = requestArgs.index('-o', 2) + 1
+    requestArgs[prefixPos] = os.path.abspath(requestArgs[prefixPos])
+
+sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+try:
+    sock.connect(socketPath)
+except socket.error as e:
+    sys.stderr.write("Error: cannot connect to server at '%s' (%s)\n" %
+                     (socketPath, e))
+    sys.exit(1)
+sock.sendall(("\t".join(requestArgs) + "\n").encode())
+sockFile = sock.makefile('rb')
+outFile = getattr(sys.stdout, 'buffer', sys.stdout)
+errFile = getattr(sys.stderr, 'buffer', sys.stderr)
+status = 1
+while True:
+    tag = sockFile.read(1)
+    if(not tag):
+        sys.stderr.write("Error: connection closed by server\n")
+        break
+    (length,) = unpack('>I', readExact(sockFile, 4))
+    data = readExact(sockFile, length)
+    if(tag == b'O'):
+        outFile.write(data)
+    elif(tag == b'E'):
+        errFile.write(data)
+        errFile.flush()
+    elif(tag == b'X'):
+        status = int(data)
+        break
+outFile.flush()
+sock.close()
+sys.exit(status)
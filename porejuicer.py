@@ -15,16 +15,21 @@ code are solely liable for the consequences of code execution.
 
 import os
 import sys
-import h5py
-import numpy
 from collections import deque, Counter, OrderedDict
 from itertools import islice, repeat
 from bisect import insort, bisect_left
-from struct import pack
-from array import array
-from multiprocessing import Pool, cpu_count
 
-def generate_consensus_matrix(fileName, header=True):
+## Modules that are slow to load (h5py, numpy, multiprocessing) are
+## imported on demand, after arguments have been checked, so that usage
+## errors and short requests return quickly. The modules needed for
+## each data type are listed in 'dataModules'.
+def load_modules(moduleNames):
+    '''import modules into the global namespace, if not already loaded'''
+    for moduleName in moduleNames:
+        if(not moduleName in globals()):
+            globals()[moduleName] = __import__(moduleName)
+
+def generate_consensus_matrix(fileName, header=True, outFile=sys.stdout):
     '''write out 2D consensus matrix from fast5, return False if not present'''
     try:
         h5File = h5py.File(fileName, 'r')
@@ -60,7 +65,7 @@ def generate_consensus_matrix(fileName, header=True):
         alnHeaders = h5File[alignmentBase].dtype
         outAlnData = h5File[alignmentBase][()] # load entire array into memory
         if(header):
-            sys.stdout.write("runID,channel,mux,read,"+
+            outFile.write("runID,channel,mux,read,"+
                              "tempStart,tempEnd,compStart,compEnd,bpPos," +
                              ",".join(alnHeaders.names) + "\n")
         lastkmer = ""
@@ -98,13 +103,14 @@ def generate_consensus_matrix(fileName, header=True):
                            else compEnd)
             res=map(str,line)
             if(moved):
-                sys.stdout.write(",".join((runID,channel,mux,readName,
+                outFile.write(",".join((runID,channel,mux,readName,
                                            str(tempStart-tempRawStart),str(tempEnd-tempRawStart),
                                            str(compStart-compRawStart),str(compEnd-compRawStart),
                                            str(bpPos))) +
                                  "," + ",".join(res) + "\n")
 
-def generate_eventdir_matrix(fileName, header=True, direction=None):
+def generate_eventdir_matrix(fileName, header=True, direction=None,
+                             outFile=sys.stdout):
     '''write out directed event matrix from fast5, False if not present'''
     try: # check to make sure the file actually exists
         h5File = h5py.File(fileName, 'r')
@@ -128,7 +134,7 @@ def generate_eventdir_matrix(fileName, header=True, direction=None):
       numpy.set_printoptions(precision=15)
       headers = h5File[eventLocation].dtype
       if(header):
-          sys.stdout.write("runID,channel,mux,read,sampleRate,rawStart,"+",".join(headers.names)+"\n")
+          outFile.write("runID,channel,mux,read,sampleRate,rawStart,"+",".join(headers.names)+"\n")
       for line in outData:
         res=[repr(x) for x in line]
         # data seems to be normalised, but just in case it isn't in the future,
@@ -137,9 +143,9 @@ def generate_eventdir_matrix(fileName, header=True, direction=None):
         # (using channelMeta[("offset", "range", "digitisation")])
         # - might also be useful to know start_time from outMeta["start_time"]
         #   which should be subtracted from event/start
-        sys.stdout.write(",".join((runID,channel,mux,readName,sampleRate,rawStart)) + "," + ",".join(res) + "\n")
+        outFile.write(",".join((runID,channel,mux,readName,sampleRate,rawStart)) + "," + ",".join(res) + "\n")
 
-def generate_event_matrix(fileName, header=True):
+def generate_event_matrix(fileName, header=True, outFile=sys.stdout):
     '''write out event matrix from fast5, return False if not present'''
     try:
         h5File = h5py.File(fileName, 'r')
@@ -162,7 +168,7 @@ def generate_event_matrix(fileName, header=True):
         headers = h5File[eventLocation].dtype
         outData = h5File[eventLocation][()] # load entire array into memory
         if(header):
-            sys.stdout.write("runID,channel,mux,read,"+",".join(headers.names)+"\n")
+            outFile.write("runID,channel,mux,read,"+",".join(headers.names)+"\n")
         # There *has* to be an easier way to do this while preserving
         # precision. Reading element by element seems very inefficient
         for line in outData:
@@ -172,49 +178,99 @@ def generate_event_matrix(fileName, header=True):
           # (using channelMeta[("offset", "range", "digitisation")])
           # - might also be useful to know start_time from outMeta["start_time"]
           #   which should be subtracted from event/start
-          sys.stdout.write(",".join((runID,channel,mux,readName)) + "," + ",".join(res) + "\n")
+          outFile.write(",".join((runID,channel,mux,readName)) + "," + ",".join(res) + "\n")
+
+def trim_length(quals, trimQual):
+    '''number of bases to trim from the start of quals, BWA-style: the
+       position where the running sum of (threshold - quality) is largest,
+       looking only up to where that sum first goes negative'''
+    sums = numpy.cumsum(trimQual - quals)
+    negative = numpy.flatnonzero(sums < 0)
+    if(len(negative) > 0):
+        sums = sums[:negative[0]]
+    if((len(sums) == 0) or (sums.max() <= 0)):
+        return 0
+    return int(sums.argmax()) + 1
+
+def filter_fastq(fastqRecord, minQual=0, minLength=0, trimQual=0):
+    '''trim/filter a stored fastq record (without its leading '@');
+       returns the new record, or None if the read should be excluded
+
+    >>> load_modules(("numpy",))
+    >>> filter_fastq("r\\nAAAAAAAAAACCC\\n+\\n&&&&&&&&&&???\\n", trimQual=20)
+    'r\\nCCC\\n+\\n???\\n'
+    '''
+    (header, seq, plus, qual) = fastqRecord.rstrip("\n").split("\n")[0:4]
+    quals = numpy.frombuffer(qual, dtype=numpy.uint8).astype(numpy.int32) - 33
+    start = 0
+    end = len(quals)
+    if(trimQual > 0 and end > 0):
+        # BWA-style trimming from the 3' end, then the 5' end
+        end -= trim_length(quals[::-1], trimQual)
+        start = trim_length(quals[:end], trimQual)
+    if(end - start < max(minLength, 1)):
+        return None
+    if(minQual > 0):
+        # mean quality is calculated from the mean error probability
+        meanError = numpy.mean(10 ** (quals[start:end] / -10.0))
+        if(-10 * numpy.log10(meanError) < minQual):
+            return None
+    return "%s\n%s\n+\n%s\n" % (header, seq[start:end], qual[start:end])
 
-def generate_fastq(fileName, callID="000"):
+def generate_fastq(fileName, callID="000", outFile=sys.stdout,
+                   minQual=0, minLength=0, trimQual=0):
     '''write out fastq sequence(s) from fast5, return False if not present'''
-    callStr = ""
+    filterReads = (minQual > 0) or (minLength > 0) or (trimQual > 0)
     try:
         h5File = h5py.File(fileName, 'r')
         h5File.close()
     except:
         return False
     with h5py.File(fileName, 'r') as h5File:
-        rowData = get_telemetry(h5File, callID, fileName)
-        seqBase1D = "/Analyses/Basecall_1D_%s" % callID
-        seqBase2D = "/Analyses/Basecall_2D_%s" % callID
-        callEnd = "%s_ch%d_mux%d_read%d" % (rowData["runID"],
-                                            rowData["channel"],
-                                            rowData["mux"],
-                                            rowData["read"])
-        while((seqBase1D in h5File) or (seqBase2D in h5File)):
-            v1_2File = False
+        if(not "Analyses" in h5File):
+            return False
+        # find all base-call groups at or after callID in one pass
+        callIDs = sorted(set(
+            groupName[-3:] for groupName in h5File["Analyses"]
+            if (groupName.startswith("Basecall_1D_") or
+                groupName.startswith("Basecall_2D_"))
+            and groupName[-3:] >= callID))
+        callEnd = None
+        for callID in callIDs:
+            # only later base-call groups are labelled with their ID
+            callStr = "" if (callEnd is None) else (callID + "_")
+            rowData = get_telemetry(h5File, callID, fileName)
+            if(callEnd is None):
+                callEnd = "%s_ch%d_mux%d_read%d" % (rowData["runID"],
+                                                    rowData["channel"],
+                                                    rowData["mux"],
+                                                    rowData["read"])
+            seqBase1D = "/Analyses/Basecall_1D_%s" % callID
+            seqBase2D = "/Analyses/Basecall_2D_%s" % callID
             if(not (seqBase1D in h5File) and (seqBase2D in h5File)):
-                seqBase1D = seqBase2D
-                v1_2File = True
+                seqBase1D = seqBase2D # v1.2 file
+            fastqLocs = list()
             if( (rowData["templateCalledBases"] > 0) and
                 (rowData["templateRawLength"] / rowData["templateCalledBases"] <= 25)):
-                baseTemp = "%s/BaseCalled_template/Fastq" % seqBase1D
-                sys.stdout.write("@1Dtemp_%s%s " % (callStr, callEnd))
-                sys.stdout.write(str(h5File[baseTemp][()][1:]))
+                fastqLocs.append(("1Dtemp",
+                                  "%s/BaseCalled_template/Fastq" % seqBase1D))
             if( (rowData["complementCalledBases"] > 0) and
                 (rowData["complementRawLength"] / rowData["complementCalledBases"] <= 25)):
-                baseComp = "%s/BaseCalled_complement/Fastq" % seqBase1D
-                sys.stdout.write("@1Dcomp_%s%s " % (callStr, callEnd))
-                sys.stdout.write(str(h5File[baseComp][()][1:]))
-            if(seqBase2D in h5File):
-                base2D = "%s/BaseCalled_2D/Fastq" % seqBase2D
-                if((base2D in h5File)):
-                    sys.stdout.write("@2Dcons_%s%s " % (callStr, callEnd))
-                    sys.stdout.write(str(h5File[base2D][()][1:]))
-            callID = "%03d" % (int(callID)+1)
-            callStr = callID + "_"
-            rowData = get_telemetry(h5File, callID, fileName)
-            seqBase1D = "/Analyses/Basecall_1D_%s" % callID
-            seqBase2D = "/Analyses/Basecall_2D_%s" % callID
+                fastqLocs.append(("1Dcomp",
+                                  "%s/BaseCalled_complement/Fastq" % seqBase1D))
+            if(("%s/BaseCalled_2D/Fastq" % seqBase2D) in h5File):
+                fastqLocs.append(("2Dcons",
+                                  "%s/BaseCalled_2D/Fastq" % seqBase2D))
+            for (readType, fastqLoc) in fastqLocs:
+                fastqRecord = str(h5File[fastqLoc][()][1:])
+                if(filterReads):
+                    fastqRecord = filter_fastq(fastqRecord, minQual=minQual,
+                                               minLength=minLength,
+                                               trimQual=trimQual)
+                    if(fastqRecord is None):
+                        continue
+                outFile.write("@%s_%s%s " % (readType, callStr, callEnd))
+                outFile.write(fastqRecord)
 
 ## Running median
 ## See [http://code.activestate.com/recipes/578480-running-median-mean-and-mode/]
@@ -291,7 +347,8 @@ def get_telemetry(h5File, callID, fileName):
             rowData["%sCalledBases" % dir] = dirMeta["sequence_length"]
     return(rowData)
 
-def generate_telemetry(fileName, callID="000", header=True):
+def generate_telemetry(fileName, callID="000", header=True,
+                       outFile=sys.stdout):
     '''Create telemetry matrix from read files; any per-read summary
        statistics that would be useful to know'''
     try:
@@ -302,13 +359,14 @@ def generate_telemetry(fileName, callID="000", header=True):
     with h5py.File(fileName, 'r') as h5File:
         rowData = get_telemetry(h5File, callID, fileName)
         if(header):
-            sys.stdout.write(",".join(rowData.keys()) + "\n")
+            outFile.write(",".join(rowData.keys()) + "\n")
             # here's the raw to pA formula for future reference:
             # pA = (raw + offset)*range/digitisation
             # (using channelMeta[("offset", "range", "digitisation")])
-        sys.stdout.write(",".join(map(str,rowData.values())) + "\n")
+        outFile.write(",".join(map(str,rowData.values())) + "\n")
 
-def generate_raw(fileName, callID="000", medianWindow=21):
+def generate_raw(fileName, callID="000", medianWindow=21,
+                 outFile=sys.stdout):
     '''write out raw sequence from fast5, with optional running median
        smoothing, return False if not present'''
     try:
@@ -330,11 +388,13 @@ def generate_raw(fileName, callID="000", medianWindow=21):
         readRawLocation = "%s/%s/Signal" % (eventBase, readName)
         outData = h5File[readRawLocation][()] # load entire raw data into memory
         if(medianWindow==1):
-            sys.stdout.write(outData)
+            outFile.write(outData.tostring())
         else:
-            array("H",runningMedian(outData, M=medianWindow)).tofile(sys.stdout)
+            from array import array
+            outFile.write(array("H",runningMedian(outData, M=medianWindow)).tostring())
 
-def generate_dir_raw(fileName, callID="000", medianWindow=1, direction=None):
+def generate_dir_raw(fileName, callID="000", medianWindow=1, direction=None,
+                     outFile=sys.stdout):
     '''write out directional raw sequence from fast5, return False if not present'''
     try:
         h5File = h5py.File(fileName, 'r')
@@ -375,7 +435,12 @@ def generate_dir_raw(fileName, callID="000", medianWindow=1, direction=None):
         rangeFilt = numpy.vectorize(lambda x: meanSig if
                                     ((x < minSig) or (x > maxSig)) else x);
         signal = rangeFilt(signal)
-        sys.stdout.write(signal) # write to file
+        outFile.write(signal.tostring()) # write to file
+
+def reset_stderr():
+    '''pool worker set-up: write messages to the process's own stderr,
+       not a stream shared with the parent (i.e. a server client socket)'''
+    sys.stderr = sys.__stderr__
 
 def strip_analyses(inArgs):
     fileName = inArgs[0]
@@ -406,9 +471,185 @@ def strip_analyses(inArgs):
         os.unlink(fileName)
         os.rename(newName, fileName)
 
+## Compressed output
+## BGZF blocks are ordinary gzip members (readable by gzip/zcat), with
+## an extra 'BC' field holding the block size. Each block is compressed
+## independently, so blocks can be handed to a thread pool (zlib
+## releases the GIL while compressing).
+bgzfBlockSize = 65280
+
+def bgzf_block(data, level=6):
+    '''compress a string into a single BGZF block'''
+    import zlib
+    from struct import pack
+    compObj = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compData = compObj.compress(data) + compObj.flush()
+    return (pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6,
+                 66, 67, 2, len(compData) + 25) + compData +
+            pack('<II', zlib.crc32(data) & 0xffffffff,
+                 len(data) & 0xffffffff))
+
+class BlockCompressedWriter(object):
+    '''file-like object that writes BGZF-compressed output, compressing
+       blocks on a (possibly shared) thread pool'''
+    def __init__(self, outFile, pool, maxPending, level=6, closeFile=True):
+        self.outFile = outFile
+        self.closeFile = closeFile
+        self.pool = pool
+        self.maxPending = maxPending
+        self.level = level
+        self.buffer = []
+        self.bufferLength = 0
+        self.pending = deque()
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.bufferLength += len(data)
+        if(self.bufferLength >= bgzfBlockSize):
+            self.submit(final=False)
+
+    def submit(self, final):
+        data = "".join(self.buffer)
+        pos = 0
+        while((len(data) - pos >= bgzfBlockSize) or
+              (final and (pos < len(data)))):
+            self.pending.append(
+                self.pool.apply_async(bgzf_block,
+                                      (data[pos:(pos+bgzfBlockSize)],
+                                       self.level)))
+            pos += bgzfBlockSize
+        self.buffer = [data[pos:]]
+        self.bufferLength = len(data) - pos
+        # write out finished blocks in order, keeping the queue bounded
+        while(self.pending and (final or self.pending[0].ready() or
+                                (len(self.pending) > self.maxPending))):
+            self.outFile.write(self.pending.popleft().get())
+
+    def close(self):
+        self.submit(final=True)
+        self.outFile.write(bgzf_block("")) # BGZF end-of-file marker
+        if(self.closeFile):
+            self.outFile.close()
+        else:
+            self.outFile.flush()
+
+class LazyOutput(object):
+    '''file-like object that only opens its output (by calling <opener>)
+       when something is first written to it'''
+    def __init__(self, opener):
+        self.opener = opener
+        self.outFile = None
+
+    def write(self, data):
+        if(self.outFile is None):
+            self.outFile = self.opener()
+        self.outFile.write(data)
+
+    def flush(self):
+        if(self.outFile is not None):
+            self.outFile.flush()
+
+    def close(self):
+        if(self.outFile is not None):
+            self.outFile.close()
+
+class ShardedOutput(object):
+    '''hands out an output stream for each processed file, optionally
+       split into files by number of reads or by channel; files (and
+       compression threads) are only created when output is written'''
+    def __init__(self, prefix=None, suffix="", compress=False, threads=None,
+                 shardReads=0, shardChannel=False, stream=sys.stdout):
+        self.stream = stream
+        self.prefix = prefix
+        self.suffix = suffix + (".gz" if compress else "")
+        self.compress = compress
+        self.shardReads = shardReads
+        self.shardChannel = shardChannel
+        self.threads = threads
+        self.pool = None
+        self.streams = dict()
+        self.readCount = 0
+
+    def open_stream(self, shardName):
+        outFile = self.stream
+        if(shardName is not None):
+            outFile = open("%s%s%s" % (self.prefix, shardName, self.suffix), "wb")
+        if(self.compress):
+            if(self.pool is None):
+                from multiprocessing import cpu_count
+                from multiprocessing.pool import ThreadPool
+                self.threads = self.threads if self.threads else cpu_count()
+                self.pool = ThreadPool(self.threads)
+            outFile = BlockCompressedWriter(outFile, self.pool,
+                                            maxPending=self.threads * 2,
+                                            closeFile=(shardName is not None))
+        return outFile
+
+    def start_read(self, fileName):
+        '''return (stream, isNewStream) for the next file'''
+        shardName = None
+        if(self.shardChannel):
+            shardName = ".ch%03d" % get_channel(fileName)
+        elif(self.shardReads > 0):
+            if(self.readCount % self.shardReads == 0):
+                self.close() # previous shard is complete
+            shardName = ".%05d" % (self.readCount // self.shardReads)
+        elif(self.prefix is not None):
+            shardName = ""
+        self.readCount += 1
+        if(shardName in self.streams):
+            return (self.streams[shardName], False)
+        if(shardName is None):
+            self.streams[shardName] = self.open_stream(shardName)
+        else:
+            self.streams[shardName] = LazyOutput(
+                lambda: self.open_stream(shardName))
+        return (self.streams[shardName], True)
+
+    def close(self):
+        for stream in self.streams.values():
+            if(stream is not self.stream):
+                stream.close()
+        self.stream.flush()
+        self.streams = dict()
+
+    def finish(self):
+        self.close()
+        if(self.pool):
+            self.pool.close()
+            self.pool.join()
+
+def get_channel(fileName):
+    '''return channel number for a fast5 file, -1 if not readable'''
+    try:
+        with h5py.File(fileName, 'r') as h5File:
+            return int(h5File['UniqueGlobalKey/channel_id'].attrs["channel_number"])
+    except:
+        return -1
+
+class UsageError(Exception):
+    '''incorrect data type, file, or options in a request'''
+    pass
+
+dataModules = {
+    "fastq": ("h5py", "numpy"),
+    "fasta": (),
+    "event": ("h5py",),
+    "consensus": ("h5py",),
+    "eventfwd": ("h5py", "numpy"),
+    "eventrev": ("h5py", "numpy"),
+    "telemetry": ("h5py",),
+    "raw": ("h5py",),
+    "rawfwd": ("h5py", "numpy"),
+    "rawrev": ("h5py", "numpy"),
+    "rawsmooth": ("h5py",),
+    "strip": ("h5py",),
+    }
+
 def usageQuit(message):
     sys.stderr.write(message + "\n\n")
-    sys.stderr.write('Usage: %s <dataType> <fast5 file name>\n' % sys.argv[0])
+    sys.stderr.write('Usage: %s <dataType> <fast5 file name> [options]\n' % sys.argv[0])
+    sys.stderr.write('       %s server <socket path>\n' % sys.argv[0])
     sys.stderr.write(' where <dataType> is one of the following:\n')
     sys.stderr.write('  fastq     - extract base-called fastq data\n')
     sys.stderr.write('  event     - extract uncalled model event matrix\n')
@@ -421,80 +662,241 @@ def usageQuit(message):
     sys.stderr.write('  rawrev    - extract raw data from complement\n')
     sys.stderr.write('  rawsmooth - raw data, running-median smoothing\n')
     sys.stderr.write('  strip     - in-place remove of analyses from fast5\n')
+    sys.stderr.write('\nOptions:\n')
+    sys.stderr.write('  -z            - compress output (BGZF, gzip-compatible)\n')
+    sys.stderr.write('  -t <threads>  - compression threads (default: cpu count)\n')
+    sys.stderr.write('  -o <prefix>   - write to <prefix>.<ext> instead of stdout\n')
+    sys.stderr.write('  -n <reads>    - split output into files of <reads> reads\n')
+    sys.stderr.write('  -c            - split output into one file per channel\n')
+    sys.stderr.write('  -q <qual>     - [fastq] exclude reads below mean quality\n')
+    sys.stderr.write('  -l <length>   - [fastq] exclude reads shorter than length\n')
+    sys.stderr.write('  -m <qual>     - [fastq] trim read ends below quality\n')
+    sys.stderr.write('\nIn server mode, requests are read from a Unix socket\n')
+    sys.stderr.write('(see porejuicer-client.py), avoiding start-up costs.\n')
     sys.exit(1)
 
-if len(sys.argv) < 3:
-    usageQuit('Error: No file or directory provided in arguments')
-
-dataType = sys.argv[1]
-if(not dataType in ("fastq", "fasta", "event", "consensus", "eventfwd",
-                    "eventrev", "telemetry", "raw", "rawfwd", "rawrev",
-                    "rawsmooth", "strip")):
-    usageQuit('Error: Incorrect dataType')
-
-fileArg = sys.argv[2]
-seenHeader = False
-
-if(os.path.isdir(fileArg)):
-    sys.stderr.write("Processing directory '%s':\n" % fileArg)
-    if(dataType == "strip"): # use multithreading
-        pool = Pool(cpu_count()/2) if (cpu_count() > 1) else Pool(1)
-        for dirPath, dirNames, fileNames in os.walk(fileArg):
-            fileNames = filter(lambda x: x.endswith(".fast5"), fileNames)
-            fileNames = map(lambda x: os.path.join(dirPath, x), fileNames)
-            fc = len(fileNames)
-            poolArgs = zip(fileNames, range(fc), repeat(fc,fc))
-            for pStart in range(fc)[0:fc:1000]:
-                res=pool.map_async(strip_analyses,
-                                   poolArgs[pStart:(pStart+1000)]);
-                res.wait()
-    else:
-        for dirPath, dirNames, fileNames in os.walk(fileArg):
-            fc = len(fileNames)
-            for fileName in fileNames:
-                if(fileName.endswith(".fast5")): # only process fast5 files
-                    if((fc == 2) or ((fc-1) % 100 == 0)):
-                        sys.stderr.write("  Processing file '%s'..." % fileName)
-                    if(dataType == "event"):
-                        generate_event_matrix(os.path.join(dirPath, fileName), header=not seenHeader)
-                    elif(dataType == "consensus"):
-                        generate_consensus_matrix(os.path.join(dirPath, fileName), header=not seenHeader)
-                    elif(dataType == "telemetry"):
-                        generate_telemetry(os.path.join(dirPath, fileName), header=not seenHeader)
-                    elif(dataType == "fastq"):
-                        generate_fastq(os.path.join(dirPath, fileName))
-                    elif(dataType == "strip"):
-                        strip_analyses(os.path.join(dirPath, fileName))
-                    elif(dataType == "raw"):
-                        usageQuit('Error: raw output only works for single files!')
-                    fc -= 1
-                    seenHeader = True
-                    if(fc == 1):
-                        sys.stderr.write(" done (%d more file to process)\n" % fc)
-                    elif(fc % 100 == 0):
-                        sys.stderr.write(" done (%d more files to process)\n" % fc)
-elif(os.path.isfile(fileArg)):
-    if(dataType == "event"):
-        generate_event_matrix(fileArg)
-    elif(dataType == "consensus"):
-        generate_consensus_matrix(fileArg)
-    elif(dataType == "eventfwd"):
-        generate_eventdir_matrix(fileArg, direction="f")
-    elif(dataType == "eventrev"):
-        generate_eventdir_matrix(fileArg, direction="r")
-    elif(dataType == "telemetry"):
-        generate_telemetry(fileArg)
-    elif(dataType == "fastq"):
-        generate_fastq(fileArg)
-    elif(dataType == "rawsmooth"):
-        generate_raw(fileArg, medianWindow=21)
-    elif(dataType == "raw"):
-        generate_raw(fileArg, medianWindow=1)
-    elif(dataType == "rawfwd"):
-        generate_dir_raw(fileArg, direction="f")
-    elif(dataType == "rawrev"):
-        generate_dir_raw(fileArg, direction="r")
+def parse_options(optArgs):
+    '''convert command-line options into a dictionary of settings'''
+    options = {"compress": False, "threads": None, "prefix": None,
+               "shardReads": 0, "shardChannel": False,
+               "minQual": 0, "minLength": 0, "trimQual": 0}
+    optArgs = list(optArgs)
+    while(optArgs):
+        opt = optArgs.pop(0)
+        try:
+            if(opt == "-z"):
+                options["compress"] = True
+            elif(opt == "-c"):
+                options["shardChannel"] = True
+            elif(opt == "-t"):
+                options["threads"] = max(1, int(optArgs.pop(0)))
+            elif(opt == "-o"):
+                options["prefix"] = optArgs.pop(0)
+            elif(opt == "-n"):
+                options["shardReads"] = int(optArgs.pop(0))
+            elif(opt == "-q"):
+                options["minQual"] = float(optArgs.pop(0))
+            elif(opt == "-l"):
+                options["minLength"] = int(optArgs.pop(0))
+            elif(opt == "-m"):
+                options["trimQual"] = int(optArgs.pop(0))
+            else:
+                raise UsageError('Error: Unknown option "%s"' % opt)
+        except (IndexError, ValueError):
+            raise UsageError('Error: Missing or invalid value for option "%s"' % opt)
+    if((options["shardChannel"] or (options["shardReads"] > 0)) and
+       (options["prefix"] is None)):
+        raise UsageError('Error: splitting output requires an output prefix (-o)')
+    return options
+
+def process_request(dataType, fileArg, optArgs, stream=sys.stdout):
+    '''extract <dataType> from a fast5 file or directory into <stream>'''
+    if(not dataType in dataModules):
+        raise UsageError('Error: Incorrect dataType')
+    if(not (os.path.isdir(fileArg) or os.path.isfile(fileArg))):
+        raise UsageError('Unknown argument "%s"' % fileArg)
+    if(os.path.isdir(fileArg) and (dataType == "raw")):
+        raise UsageError('Error: raw output only works for single files!')
+    options = parse_options(optArgs)
+    load_modules(dataModules[dataType])
+    outSuffix = (".fastq" if (dataType == "fastq") else
+                 ".bin" if dataType.startswith("raw") else ".csv")
+    output = ShardedOutput(prefix=options["prefix"], suffix=outSuffix,
+                           compress=options["compress"],
+                           threads=options["threads"],
+                           shardReads=options["shardReads"],
+                           shardChannel=options["shardChannel"],
+                           stream=stream)
+    if(os.path.isdir(fileArg)):
+        sys.stderr.write("Processing directory '%s':\n" % fileArg)
+        if(dataType == "strip"): # use multithreading
+            from multiprocessing import Pool, cpu_count
+            pool = Pool(cpu_count()/2 if (cpu_count() > 1) else 1,
+                        initializer=reset_stderr)
+            for dirPath, dirNames, fileNames in os.walk(fileArg):
+                fileNames = filter(lambda x: x.endswith(".fast5"), fileNames)
+                fileNames = map(lambda x: os.path.join(dirPath, x), fileNames)
+                fc = len(fileNames)
+                poolArgs = zip(fileNames, range(fc), repeat(fc,fc))
+                for pStart in range(fc)[0:fc:1000]:
+                    res=pool.map_async(strip_analyses,
+                                       poolArgs[pStart:(pStart+1000)]);
+                    res.wait()
+            pool.close()
+        else:
+            for dirPath, dirNames, fileNames in os.walk(fileArg):
+                fc = len(fileNames)
+                for fileName in fileNames:
+                    if(fileName.endswith(".fast5")): # only process fast5 files
+                        if((fc == 2) or ((fc-1) % 100 == 0)):
+                            sys.stderr.write("  Processing file '%s'..." % fileName)
+                        filePath = os.path.join(dirPath, fileName)
+                        (outFile, newStream) = output.start_read(filePath)
+                        if(dataType == "event"):
+                            generate_event_matrix(filePath, header=newStream,
+                                                  outFile=outFile)
+                        elif(dataType == "consensus"):
+                            generate_consensus_matrix(filePath, header=newStream,
+                                                      outFile=outFile)
+                        elif(dataType == "telemetry"):
+                            generate_telemetry(filePath, header=newStream,
+                                               outFile=outFile)
+                        elif(dataType == "fastq"):
+                            generate_fastq(filePath, outFile=outFile,
+                                           minQual=options["minQual"],
+                                           minLength=options["minLength"],
+                                           trimQual=options["trimQual"])
+                        fc -= 1
+                        if(fc == 1):
+                            sys.stderr.write(" done (%d more file to process)\n" % fc)
+                        elif(fc % 100 == 0):
+                            sys.stderr.write(" done (%d more files to process)\n" % fc)
     elif(dataType == "strip"):
-        strip_analyses(fileArg)
-else:
-    usageQuit('Unknown argument "%s"' % fileArg)
+        strip_analyses((fileArg, 0, 1))
+    else:
+        (outFile, newStream) = output.start_read(fileArg)
+        if(dataType == "event"):
+            generate_event_matrix(fileArg, outFile=outFile)
+        elif(dataType == "consensus"):
+            generate_consensus_matrix(fileArg, outFile=outFile)
+        elif(dataType == "eventfwd"):
+            generate_eventdir_matrix(fileArg, direction="f", outFile=outFile)
+        elif(dataType == "eventrev"):
+            generate_eventdir_matrix(fileArg, direction="r", outFile=outFile)
+        elif(dataType == "telemetry"):
+            generate_telemetry(fileArg, outFile=outFile)
+        elif(dataType == "fastq"):
+            generate_fastq(fileArg, outFile=outFile,
+                           minQual=options["minQual"],
+                           minLength=options["minLength"],
+                           trimQual=options["trimQual"])
+        elif(dataType == "rawsmooth"):
+            generate_raw(fileArg, medianWindow=21, outFile=outFile)
+        elif(dataType == "raw"):
+            generate_raw(fileArg, medianWindow=1, outFile=outFile)
+        elif(dataType == "rawfwd"):
+            generate_dir_raw(fileArg, direction="f", outFile=outFile)
+        elif(dataType == "rawrev"):
+            generate_dir_raw(fileArg, direction="r", outFile=outFile)
+    output.finish()
+
+## Server mode
+## Requests are single tab-separated lines (<dataType>, <path>,
+## [options...]). Responses are a sequence of frames: a one-character
+## tag ('O' output, 'E' error text, 'X' exit status), a 4-byte
+## big-endian length, then the frame data. Each request is handled in a
+## forked child, so imported modules are shared with the resident
+## server process and requests can run concurrently.
+
+class FramedStream(object):
+    '''file-like object that writes tagged frames to a socket file'''
+    def __init__(self, sockFile, tag, bufferSize=65536):
+        self.sockFile = sockFile
+        self.tag = tag
+        self.bufferSize = bufferSize
+        self.buffer = []
+        self.bufferLength = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.bufferLength += len(data)
+        if(self.bufferLength >= self.bufferSize):
+            self.flush()
+
+    def flush(self):
+        if(self.bufferLength > 0):
+            from struct import pack
+            data = "".join(self.buffer)
+            self.sockFile.write(self.tag + pack('>I', len(data)) + data)
+            self.buffer = []
+            self.bufferLength = 0
+        self.sockFile.flush()
+
+def handle_request(sockFile, requestLine):
+    '''run a single server request, writing framed results to sockFile'''
+    request = requestLine.rstrip("\n").split("\t")
+    outStream = FramedStream(sockFile, "O")
+    # runs in a forked child, so this only affects the current request
+    sys.stderr = FramedStream(sockFile, "E", bufferSize=1)
+    status = "0"
+    try:
+        if(len(request) < 2):
+            raise UsageError('Error: No file or directory provided in arguments')
+        process_request(request[0], request[1], request[2:],
+                        stream=outStream)
+    except UsageError as e:
+        sys.stderr.write("%s\n" % e)
+        status = "1"
+    except Exception as e:
+        sys.stderr.write("Error: %s\n" % e)
+        status = "1"
+    outStream.flush()
+    FramedStream(sockFile, "X", bufferSize=1).write(status)
+
+def run_server(socketPath):
+    '''serve extraction requests on a Unix socket until interrupted'''
+    import signal
+    import SocketServer
+    from multiprocessing import cpu_count
+    # load everything up front, so forked request handlers don't need to
+    load_modules(set(sum(dataModules.values(), ())))
+
+    class ExtractionHandler(SocketServer.StreamRequestHandler):
+        def handle(self):
+            handle_request(self.wfile, self.rfile.readline())
+
+    class ExtractionServer(SocketServer.ForkingMixIn,
+                           SocketServer.UnixStreamServer):
+        max_children = cpu_count() * 2
+
+    if(os.path.exists(socketPath)):
+        os.unlink(socketPath)
+    # only the server's user may send requests (which can write files);
+    # the umask covers the time between binding the socket and chmod
+    oldUmask = os.umask(0o177)
+    try:
+        server = ExtractionServer(socketPath, ExtractionHandler)
+    finally:
+        os.umask(oldUmask)
+    os.chmod(socketPath, 0o600)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    sys.stderr.write("Serving requests on '%s'\n" % socketPath)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socketPath)
+
+if(__name__ == '__main__'):
+    if len(sys.argv) < 3:
+        usageQuit('Error: No file or directory provided in arguments')
+
+    if(sys.argv[1] == "server"):
+        run_server(sys.argv[2])
+    else:
+        try:
+            process_request(sys.argv[1], sys.argv[2], sys.argv[3:])
+        except UsageError as e:
+            usageQuit(str(e))
@@ -0,0 +1,478 @@
+#!/usr/bin/env python
+
+'''
+load test for webblast (cgi-bin/blast.py), using stand-in 'blastn' and
+'blastdbcmd' programs so that no BLAST installation or databases are
+needed (Biopython is still needed to read results).
+
+Usage: blast-bench.py [options]
+
+Options:
+  -c <clients>    concurrent clients (default 4)
+  -r <rounds>     views of each tab per client (default 5)
+  -q <queries>    query sequences per search (default 5)
+  -l <length>     query sequence length (default 500)
+  -hits <number>  hits per query in stand-in output (default 20)
+  -hsp <length>   HSP alignment length in stand-in output (default 300)
+  -delay <secs>   stand-in blastn run time per query (default 0.1)
+  -dbdelay <secs> stand-in blastdbcmd run time (default 0.01)
+  -xml <file>     replay a recorded BLAST XML file instead of generated
+                  output
+  -mode <mode>    'cgi' runs blast.py once per request as a CGI script
+                  (default); 'wsgi' runs it as a server ('blast.py serve')
+  -summary        run searches in summary (tabular output) mode
+  -jobs <n,...>   job store sizes for cleanup timings
+                  (default 100,1000,10000)
+  -keep           keep the working directory
+
+blast.py is run from a copy of cgi-bin (scripts and templates) in a
+temporary directory, with the stand-in programs first in the PATH. Each
+client submits a search, polls the JSON job status until it has
+finished, then views the Query, Parameters and Results tabs in turn.
+
+Timings are reported (in milliseconds) for:
+  submit    - search submission
+  wait      - from submission until the job has finished
+  query     - Query tab views
+  params    - Parameters tab views
+  results   - Results tab views
+  sweep_<n> - jobstore.sweep() with <n> jobs in the store (half expired)
+  latest_<n> - Results tab views with <n> jobs in the store
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import base64
+import urllib2
+import tempfile
+import threading
+import traceback
+import subprocess
+
+standInBlast = r'''#!%(python)s
+# stand-in blastn for blast-bench.py
+import os, sys, time, random
+args = sys.argv[1:]
+def option(name, default=None):
+    return args[args.index(name) + 1] if (name in args) else default
+queries = list()
+for line in open(option('-query')):
+    if(line.startswith('>')):
+        queries.append([line[1:].strip() or 'query', 0])
+    elif(queries):
+        queries[-1][1] += len(line.strip())
+delay = float(os.environ.get('BENCH_DELAY', '0'))
+if(os.environ.get('BENCH_XML')):
+    time.sleep(delay * len(queries))
+    sys.stdout.write(open(os.environ['BENCH_XML']).read())
+    sys.exit(0)
+numHits = int(os.environ.get('BENCH_HITS', '20'))
+hspLength = int(os.environ.get('BENCH_HSP', '300'))
+outFormat = option('-outfmt', '5').split()
+program = sys.argv[0].split('/')[-1]
+db = option('-db', 'db')
+def hsp(queryLength, hitNum):
+    alignLength = min(hspLength, max(queryLength, 1))
+    qseq = ''.join(random.choice('ACGT') for x in range(alignLength))
+    hseq = ''.join((x if random.random() < 0.9 else random.choice('ACGT-'))
+                   for x in qseq)
+    midline = ''.join(('|' if (x == y) else ' ') for (x, y) in zip(qseq, hseq))
+    hitLength = 5000 + hitNum
+    sbjctStart = random.randint(1, hitLength - alignLength)
+    sbjctEnd = sbjctStart + len(hseq.replace('-', '')) - 1
+    if(hitNum %% 2):
+        (sbjctStart, sbjctEnd) = (sbjctEnd, sbjctStart)
+    return {'qseq': qseq, 'hseq': hseq, 'midline': midline,
+            'queryStart': 1, 'queryEnd': alignLength,
+            'sbjctStart': sbjctStart, 'sbjctEnd': sbjctEnd,
+            'sframe': -1 if (hitNum %% 2) else 1, 'hitLength': hitLength,
+            'identities': midline.count('|'), 'gaps': hseq.count('-'),
+            'alignLength': alignLength, 'score': midline.count('|'),
+            'bits': midline.count('|') * 1.8,
+            'evalue': 10 ** -(midline.count('|') // 10)}
+out = sys.stdout
+if(outFormat[0] == '5'):
+    out.write('<?xml version="1.0"?>\n'
+              '<!DOCTYPE BlastOutput PUBLIC "-//NCBI//NCBI BlastOutput/EN" '
+              '"http://www.ncbi.nlm.nih.gov/dtd/NCBI_BlastOutput.dtd">\n'
+              '<BlastOutput>\n'
+              '  <BlastOutput_program>%%s</BlastOutput_program>\n'
+              '  <BlastOutput_version>BLASTN 2.2.28+</BlastOutput_version>\n'
+              '  <BlastOutput_reference>stand-in</BlastOutput_reference>\n'
+              '  <BlastOutput_db>%%s</BlastOutput_db>\n'
+              '  <BlastOutput_query-ID>Query_1</BlastOutput_query-ID>\n'
+              '  <BlastOutput_query-def>%%s</BlastOutput_query-def>\n'
+              '  <BlastOutput_query-len>%%d</BlastOutput_query-len>\n'
+              '  <BlastOutput_param>\n    <Parameters>\n'
+              '      <Parameters_expect>10</Parameters_expect>\n'
+              '    </Parameters>\n  </BlastOutput_param>\n'
+              '<BlastOutput_iterations>\n' %%
+              (program, db, queries[0][0], queries[0][1]))
+for (queryNum, (queryName, queryLength)) in enumerate(queries):
+    time.sleep(delay)
+    random.seed(queryNum)
+    if(outFormat[0] == '5'):
+        out.write('<Iteration>\n'
+                  '  <Iteration_iter-num>%%d</Iteration_iter-num>\n'
+                  '  <Iteration_query-ID>Query_%%d</Iteration_query-ID>\n'
+                  '  <Iteration_query-def>%%s</Iteration_query-def>\n'
+                  '  <Iteration_query-len>%%d</Iteration_query-len>\n'
+                  '<Iteration_hits>\n' %%
+                  (queryNum + 1, queryNum + 1, queryName, queryLength))
+        for hitNum in range(numHits):
+            h = hsp(queryLength, hitNum)
+            out.write('<Hit>\n'
+                      '  <Hit_num>%%d</Hit_num>\n'
+                      '  <Hit_id>gnl|BL_ORD_ID|%%d</Hit_id>\n'
+                      '  <Hit_def>bench_%%d stand-in subject</Hit_def>\n'
+                      '  <Hit_accession>%%d</Hit_accession>\n'
+                      '  <Hit_len>%%d</Hit_len>\n'
+                      '  <Hit_hsps>\n    <Hsp>\n'
+                      '      <Hsp_num>1</Hsp_num>\n'
+                      '      <Hsp_bit-score>%%0.3f</Hsp_bit-score>\n'
+                      '      <Hsp_score>%%d</Hsp_score>\n'
+                      '      <Hsp_evalue>%%g</Hsp_evalue>\n'
+                      '      <Hsp_query-from>%%d</Hsp_query-from>\n'
+                      '      <Hsp_query-to>%%d</Hsp_query-to>\n'
+                      '      <Hsp_hit-from>%%d</Hsp_hit-from>\n'
+                      '      <Hsp_hit-to>%%d</Hsp_hit-to>\n'
+                      '      <Hsp_query-frame>1</Hsp_query-frame>\n'
+                      '      <Hsp_hit-frame>%%d</Hsp_hit-frame>\n'
+                      '      <Hsp_identity>%%d</Hsp_identity>\n'
+                      '      <Hsp_positive>%%d</Hsp_positive>\n'
+                      '      <Hsp_gaps>%%d</Hsp_gaps>\n'
+                      '      <Hsp_align-len>%%d</Hsp_align-len>\n'
+                      '      <Hsp_qseq>%%s</Hsp_qseq>\n'
+                      '      <Hsp_hseq>%%s</Hsp_hseq>\n'
+                      '      <Hsp_midline>%%s</Hsp_midline>\n'
+                      '    </Hsp>\n  </Hit_hsps>\n</Hit>\n' %%
+                      (hitNum + 1, hitNum, hitNum, hitNum, h['hitLength'],
+                       h['bits'], h['score'], h['evalue'],
+                       h['queryStart'], h['queryEnd'], h['sbjctStart'],
+                       h['sbjctEnd'], h['sframe'], h['identities'],
+                       h['identities'], h['gaps'], h['alignLength'],
+                       h['qseq'], h['hseq'], h['midline']))
+        out.write('</Iteration_hits>\n</Iteration>\n')
+    else:
+        # tabular output with comment lines (-outfmt 7)
+        out.write('# %%s 2.2.28+\n# Query: %%s\n# Database: %%s\n'
+                  '# Fields: %%s\n# %%d hits found\n' %%
+                  (program.upper(), queryName, db, ', '.join(outFormat[1:]),
+                   numHits))
+        for hitNum in range(numHits):
+            h = hsp(queryLength, hitNum)
+            values = {
+                'qseqid': queryName.split()[0], 'sseqid': 'gnl|BL_ORD_ID|%%d' %% hitNum,
+                'stitle': 'bench_%%d stand-in subject' %% hitNum,
+                'qlen': queryLength, 'slen': h['hitLength'],
+                'length': h['alignLength'], 'qframe': 1, 'sframe': h['sframe'],
+                'score': h['score'], 'bitscore': '%%0.1f' %% h['bits'],
+                'nident': h['identities'], 'evalue': '%%g' %% h['evalue'],
+                'qstart': h['queryStart'], 'qend': h['queryEnd'],
+                'sstart': h['sbjctStart'], 'send': h['sbjctEnd'],
+                'qseq': h['qseq'], 'sseq': h['hseq']}
+            out.write('\t'.join(str(values.get(x, '')) for x in outFormat[1:]) + '\n')
+    out.flush()
+if(outFormat[0] == '5'):
+    out.write('</BlastOutput_iterations>\n</BlastOutput>\n')
+else:
+    out.write('# BLAST processed %%d queries\n' %% len(queries))
+'''
+
+standInBlastdbcmd = r'''#!%(python)s
+# stand-in blastdbcmd for blast-bench.py
+import os, sys, time
+args = sys.argv[1:]
+time.sleep(float(os.environ.get('BENCH_DBDELAY', '0')))
+if('-list' in args):
+    sys.stdout.write('db/bench,Nucleotide,Benchmark database\n')
+    sys.exit(0)
+entries = list()
+if('-entry_batch' in args):
+    entries = [x.strip() for x in open(args[args.index('-entry_batch') + 1])
+               if x.strip()]
+elif('-entry' in args):
+    seqRange = '1-100'
+    if('-range' in args):
+        seqRange = args[args.index('-range') + 1]
+    entries = ['%%s %%s' %% (args[args.index('-entry') + 1], seqRange)]
+for entry in entries:
+    (start, end) = entry.rsplit(' ', 1)[1].split('-')
+    length = int(end) - int(start) + 1
+    sys.stdout.write(('ACGTTGCA' * (length // 8 + 1))[:length] + '\n')
+'''
+
+def percentiles(times):
+    times = sorted(times)
+    return (times[0], times[len(times) // 2], times[-1])
+
+def encodeForm(fields):
+    '''encode form fields as multipart/form-data (like a browser)'''
+    boundary = '----blastbench%d' % random.randint(0, 1 << 30)
+    parts = list()
+    for (name, value) in fields:
+        if(name == 'inputFile'):
+            parts.append('--%s\r\nContent-Disposition: form-data; '
+                         'name="%s"; filename=""\r\n'
+                         'Content-Type: application/octet-stream\r\n\r\n%s\r\n'
+                         % (boundary, name, value))
+        else:
+            parts.append('--%s\r\nContent-Disposition: form-data; '
+                         'name="%s"\r\n\r\n%s\r\n' % (boundary, name, value))
+    parts.append('--%s--\r\n' % boundary)
+    return ('multipart/form-data; boundary=%s' % boundary, ''.join(parts))
+
+class BlastSite(object):
+    '''runs requests against a working copy of blast.py'''
+    def __init__(self, workDir, mode, env):
+        self.workDir = workDir
+        self.mode = mode
+        self.env = env
+        self.server = None
+        if(mode == 'wsgi'):
+            listenSocket = socket.socket()
+            listenSocket.bind(('localhost', 0))
+            self.port = listenSocket.getsockname()[1]
+            listenSocket.close()
+            with open(os.devnull, 'w') as nullFile:
+                self.server = subprocess.Popen(
+                    [sys.executable, 'blast.py', 'serve', str(self.port)],
+                    cwd=workDir, env=env, stderr=nullFile)
+            for attempt in range(100):
+                try:
+                    socket.create_connection(('localhost', self.port)).close()
+                    break
+                except socket.error:
+                    time.sleep(0.1)
+    def close(self):
+        if(self.server):
+            self.server.terminate()
+            self.server.wait()
+    def request(self, fields=None, query=''):
+        '''POST form fields (or GET with a query string); returns the body'''
+        body = ''
+        contentType = ''
+        if(fields is not None):
+            (contentType, body) = encodeForm(fields)
+        if(self.mode == 'wsgi'):
+            url = 'http://localhost:%d/cgi-bin/blast.py' % self.port
+            if(query):
+                url += '?' + query
+            request = urllib2.Request(url, body if fields else None)
+            if(fields is not None):
+                request.add_header('Content-Type', contentType)
+            return urllib2.urlopen(request).read()
+        env = dict(self.env)
+        env.update({'GATEWAY_INTERFACE': 'CGI/1.1',
+                    'REQUEST_METHOD': 'POST' if fields else 'GET',
+                    'REQUEST_URI': '/cgi-bin/blast.py' +
+                    ('?' + query if query else ''),
+                    'SCRIPT_NAME': '/cgi-bin/blast.py',
+                    'QUERY_STRING': query,
+                    'CONTENT_TYPE': contentType,
+                    'CONTENT_LENGTH': str(len(body))})
+        process = subprocess.Popen([sys.executable, 'blast.py'],
+                                   cwd=self.workDir, env=env,
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE)
+        output = process.communicate(body)[0]
+        return output.split('\n\n', 1)[-1]
+
+def makeQuery(numQueries, length):
+    return ''.join('>bench_query_%d\n%s\n' %
+                   (x, ''.join(random.choice('ACGT') for y in range(length)))
+                   for x in range(numQueries))
+
+def runClient(site, options, timings, sessions, lock):
+    sessionID = base64.b64encode(os.urandom(16))
+    form = [('selectProgram', 'blastn'), ('sessionID', sessionID),
+            ('queryDB', 'db/bench'), ('EXPECT', '10'),
+            ('MAX_NUM_SEQ', '100'), ('WORD_SIZE', '11'),
+            ('SHORT_QUERY_ADJUST', 'on'), ('CONTEXT', '0'),
+            ('OUTPUT_MODE', 'summary' if options['summary'] else 'alignments')]
+    clientTimes = dict()
+    startTime = time.time()
+    site.request(form + [('selectTab', 'results'), ('runBlast', 'BLAST'),
+                         ('inputText', makeQuery(options['queries'],
+                                                 options['length'])),
+                         ('inputFile', '')])
+    clientTimes['submit'] = [time.time() - startTime]
+    while True:
+        status = json.loads(site.request(
+            query='status=json&sessionID=%s' % urllib2.quote(sessionID, '')))
+        if(status['state'] in ('finished', 'none')):
+            break
+        time.sleep(0.2)
+    clientTimes['wait'] = [time.time() - startTime]
+    form.append(('resultsExist', 'True'))
+    for roundNum in range(options['rounds']):
+        for tab in ('query', 'params', 'results'):
+            startTime = time.time()
+            site.request(form + [('selectTab', tab)])
+            clientTimes.setdefault(tab, list()).append(time.time() - startTime)
+    with lock:
+        sessions.append(sessionID)
+        for (name, times) in clientTimes.items():
+            timings.setdefault(name, list()).extend(times)
+
+def clientThread(site, options, timings, sessions, failures, lock):
+    '''run a client, recording the traceback of any failure'''
+    try:
+        runClient(site, options, timings, sessions, lock)
+    except Exception:
+        with lock:
+            failures.append(traceback.format_exc())
+
+def fillJobStore(workDir, numJobs):
+    '''replace the benchmark jobs in the job store with <numJobs>
+    finished jobs, half of which have expired (and have results files
+    for sweep() to remove)'''
+    sys.path.insert(0, workDir)
+    import jobstore
+    resultDir = os.path.join(workDir, 'templates', 'results', 'bench')
+    if(not os.path.isdir(resultDir)):
+        os.makedirs(resultDir)
+    connection = jobstore.connect()
+    rows = list()
+    now = time.time()
+    for jobNum in range(numJobs):
+        expired = (jobNum % 2 == 0)
+        resultFile = os.path.join(resultDir, 'job%d' % jobNum)
+        if(expired):
+            with open(resultFile, 'w') as outFile:
+                outFile.write('<?xml version="1.0"?>\n'
+                              '<!DOCTYPE BlastOutput PUBLIC '
+                              '"-//NCBI//NCBI BlastOutput/EN" "">\n')
+            open(resultFile + '.err', 'w').close()
+        job = {'jobID': 'bench%d' % jobNum,
+               'sessionID': 'bench%d' % (jobNum % 50),
+               'state': 'finished',
+               'submitTime': now - (2 * 86400 if expired else 60) + jobNum * 1e-3,
+               'startTime': now, 'endTime': now, 'exitCode': 0,
+               'commandLine': '[]', 'resultFile': resultFile,
+               'errorFile': resultFile + '.err'}
+        rows.append(tuple(job.get(x) for x in jobstore.jobFields))
+    with connection:
+        connection.execute('DELETE FROM jobs WHERE jobID LIKE ?', ('bench%',))
+        connection.executemany('INSERT INTO jobs (%s) VALUES (%s)' %
+                               (', '.join(jobstore.jobFields),
+                                ', '.join('?' * len(jobstore.jobFields))), rows)
+    connection.close()
+    return jobstore
+
+options = {'clients': 4, 'rounds': 5, 'queries': 5, 'length': 500,
+           'hits': 20, 'hsp': 300, 'delay': 0.1, 'dbdelay': 0.01,
+           'xml': None, 'mode': 'cgi', 'summary': False,
+           'jobs': '100,1000,10000', 'keep': False}
+optionNames = {'-c': 'clients', '-r': 'rounds', '-q': 'queries',
+               '-l': 'length', '-hits': 'hits', '-hsp': 'hsp',
+               '-delay': 'delay', '-dbdelay': 'dbdelay', '-xml': 'xml',
+               '-mode': 'mode', '-jobs': 'jobs'}
+args = sys.argv[1:]
+while(args):
+    arg = args.pop(0)
+    if(arg == '-summary'):
+        options['summary'] = True
+    elif(arg == '-keep'):
+        options['keep'] = True
+    elif((arg in optionNames) and args):
+        name = optionNames[arg]
+        options[name] = type(options[name])(args.pop(0)) \
+            if (options[name] is not None) else args.pop(0)
+    else:
+        sys.stderr.write(__doc__.strip() + "\n")
+        sys.exit(1)
+if(not (options['mode'] in ('cgi', 'wsgi'))):
+    sys.stderr.write(__doc__.strip() + "\n")
+    sys.exit(1)
+
+scriptDir = os.path.dirname(os.path.abspath(__file__))
+workDir = tempfile.mkdtemp(prefix='blast-bench')
+cgiDir = os.path.join(workDir, 'cgi-bin')
+shutil.copytree(os.path.join(scriptDir, 'cgi-bin'), cgiDir,
+                ignore=shutil.ignore_patterns('*.pyc', 'results', 'db'))
+os.makedirs(os.path.join(cgiDir, 'db'))
+for extension in ('nhr', 'nin', 'nsq'):
+    open(os.path.join(cgiDir, 'db', 'bench.' + extension), 'w').close()
+binDir = os.path.join(workDir, 'bin')
+os.makedirs(binDir)
+for (name, script) in (('blastn', standInBlast),
+                       ('blastdbcmd', standInBlastdbcmd)):
+    with open(os.path.join(binDir, name), 'w') as scriptFile:
+        scriptFile.write(script % {'python': sys.executable})
+    os.chmod(os.path.join(binDir, name), 0o755)
+env = dict(os.environ)
+env.pop('GATEWAY_INTERFACE', None)
+env.update({'PATH': binDir + os.pathsep + env.get('PATH', ''),
+            'BENCH_HITS': str(options['hits']),
+            'BENCH_HSP': str(options['hsp']),
+            'BENCH_DELAY': str(options['delay']),
+            'BENCH_DBDELAY': str(options['dbdelay'])})
+if(options['xml']):
+    env['BENCH_XML'] = os.path.abspath(options['xml'])
+
+site = BlastSite(cgiDir, options['mode'], env)
+try:
+    timings = dict()
+    sessions = list()
+    failures = list()
+    lock = threading.Lock()
+    clients = [threading.Thread(target=clientThread,
+                                args=(site, options, timings, sessions,
+                                      failures, lock))
+               for x in range(options['clients'])]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    for failure in failures:
+        sys.stderr.write('Client failed:\n%s' % failure)
+    jobCounts = [int(x) for x in options['jobs'].split(',') if x]
+    if(not sessions):
+        sys.stderr.write('No client finished a search; '
+                         'skipping job store timings\n')
+        jobCounts = list()
+    # cleanup and job lookup costs as the job store grows
+    os.chdir(cgiDir)
+    form = [('selectProgram', 'blastn'),
+            ('sessionID', sessions[0] if sessions else ''),
+            ('queryDB', 'db/bench'), ('resultsExist', 'True'),
+            ('selectTab', 'results')]
+    for numJobs in jobCounts:
+        jobstore = fillJobStore(cgiDir, numJobs)
+        startTime = time.time()
+        errors = jobstore.sweep()
+        timings['sweep_%d' % numJobs] = [time.time() - startTime]
+        for error in errors:
+            sys.stderr.write('sweep_%d: %s\n' % (numJobs, error))
+        fillJobStore(cgiDir, numJobs)
+        for roundNum in range(options['rounds']):
+            startTime = time.time()
+            site.request(form)
+            timings.setdefault('latest_%d' % numJobs, list()).append(
+                time.time() - startTime)
+finally:
+    site.close()
+    os.chdir(scriptDir)
+    if(options['keep']):
+        sys.stderr.write('Working directory: %s\n' % workDir)
+    else:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+sys.stdout.write("test,count,min,median,max\n")
+testNames = ['submit', 'wait', 'query', 'params', 'results']
+testNames += sorted((x for x in timings if not (x in testNames)),
+                    key=lambda x: (x.split('_')[0], int(x.split('_')[1])))
+for testName in testNames:
+    if(testName in timings):
+        (minTime, medianTime, maxTime) = percentiles(timings[testName])
+        sys.stdout.write("%s,%d,%0.1f,%0.1f,%0.1f\n" %
+                         (testName, len(timings[testName]), minTime * 1000,
+                          medianTime * 1000, maxTime * 1000))
+if(failures):
+    sys.exit(1)
@@ -7,38 +7,105 @@ import cgi # for cgi forms
 import cgitb # for cgi trace-back
 import re # for regular expression parsing
 import os # file existence, urandom [sessionIDs]
+import sys # for writing generated output
+import cStringIO # for collecting hidden form values
+import types # for detecting generated output
 import base64 # for encoding sessionIDs
 import subprocess # for running external programs
 import csv # for parsing csv files (e.g. blast output)
+import json # for the cached database list, HSP frames
 import time # for results file cleanup
 import tempfile # for blast results
-from Bio.Blast import NCBIXML # for XML parsing
+import blastqueue # for running BLAST jobs
+import blastcache # for re-using results of identical searches
+import jobstore # for finding results files
+import blastresults # for processed results
 from decimal import Decimal # for scientific notation
 
-def printFile(fileName, parameters, printContent):
-    if(printContent):
-        # HTTP header
-        print('Content-type: text/html\n\n')
-    if(not(os.path.exists(fileName))):
-        print('File does not exist: %s' % fileName);
+# templates are compiled, and default value files read, once per
+# process (and again if the file changes)
+templateCache = dict()
+defaultsCache = dict()
+
+class PageError(Exception):
+    # shows an error page instead of the requested tab
+    pass
+
+def compileTemplate(fileName):
+    # returns (plan, fields) for a template. The plan is a list of text
+    # to write as-is (runs of lines without parameters), and lines with
+    # parameters, which are lists of alternating text and parameter
+    # names ('%(name)'); fields are the form fields in the template.
+    plan = list()
+    fields = list()
+    text = list()
+    with open(fileName, 'r') as readFile:
+        for line in readFile:
+            fields.extend(re.findall('<(?:input|textarea|select).*?name="(.*?)"', line))
+            pieces = re.split("%\((.*?)\)", line)
+            if(len(pieces) == 1):
+                text.append(line.rstrip() + '\n')
+                continue
+            if(text):
+                plan.append(''.join(text))
+                text = list()
+            plan.append(pieces)
+    if(text):
+        plan.append(''.join(text))
+    return (plan, fields)
+
+def loadTemplate(fileName):
+    # returns the compiled template, or None if the file doesn't exist
+    try:
+        fileStat = os.stat(fileName)
+    except OSError:
+        templateCache.pop(fileName, None)
+        return None
+    signature = (fileStat.st_mtime, fileStat.st_size)
+    if((not (fileName in templateCache)) or
+       (templateCache[fileName][0] != signature)):
+        templateCache[fileName] = (signature, compileTemplate(fileName))
+    return templateCache[fileName][1]
+
+def templateText(fileName, parameters):
+    # yields the text of a template, with parameters filled in
+    template = loadTemplate(fileName)
+    if(template == None):
+        yield 'File does not exist: %s\n' % fileName
         return
-    readFile = open(fileName, 'r')
-    for line in readFile:
-        paramMatches = re.findall("%\((.*?)\)", line)
-        for param in paramMatches:
-            # doing a 'manual' replacement because the usual %(param)
-            # notation doesn't seem to work
-            if(param in parameters):
-                line = line.replace('%(' + param + ')',
-                                    parameters[param])
+    (plan, fields) = template
+    parameters['seenFields'].extend(fields)
+    output = list()
+    for item in plan:
+        if(isinstance(item, str)):
+            output.append(item)
+            continue
+        line = list()
+        for (pos, piece) in enumerate(item):
+            if(pos % 2 == 0):
+                line.append(piece)
+                continue
+            # missing parameters are left blank
+            value = parameters.get(piece, '')
+            if(isinstance(value, types.GeneratorType)):
+                # generated content (e.g. BLAST results) is printed as
+                # it is generated, rather than put into the line
+                output.extend(line)
+                yield ''.join(output)
+                output = list()
+                line = list()
+                for text in value:
+                    yield text
             else:
-                line = line.replace('%(' + param + ')', '')
-        seenFields = re.findall('<(?:input|textarea|select).*?name="(.*?)"', line)
-        for field in seenFields:
-            parameters['seenFields'].append(field)
-        print(line.rstrip())
+                line.append(value)
+        output.append(''.join(line).rstrip() + '\n')
+    yield ''.join(output)
+
+def printFile(fileName, parameters, outFile = sys.stdout):
+    for text in templateText(fileName, parameters):
+        outFile.write(text)
 
-def printHiddenValues(lastForm, parameters):
+def printHiddenValues(lastForm, parameters, outFile = sys.stdout):
     # make sure runBlast state isn't preserved across multiple submits
     # [don't want it to try running more than once]
     parameters['seenFields'].append('runBlast')
@@ -46,26 +113,66 @@ def printHiddenValues(lastForm, parameters):
     for field in parameters['addFields']:
         if(not(field in parameters['seenFields']) and
            field in parameters):
-            print('<input type="hidden" name="%s" value="%s">' %
-                  (field, parameters[field]))
+            outFile.write('<input type="hidden" name="%s" value="%s">\n' %
+                          (field, parameters[field]))
     # add fields from previous form to hidden values
     for field in lastForm:
         if(not(field in parameters['seenFields'])):
-            print('<input type="hidden" name="%s" value="%s">' %
-                  (field, lastForm.getfirst(field)))
+            outFile.write('<input type="hidden" name="%s" value="%s">\n' %
+                          (field, lastForm.getfirst(field)))
+
 
+def dbDirSignature(dbDir):
+    # names and modification times of the database files; this changes
+    # whenever a database is added, removed or rebuilt
+    signature = ['%s:%.6f' % (dbDir, os.stat(dbDir).st_mtime)]
+    for fileName in sorted(os.listdir(dbDir)):
+        fileStat = os.stat(os.path.join(dbDir, fileName))
+        signature.append('%s:%d:%.6f' % (fileName, fileStat.st_size,
+                                         fileStat.st_mtime))
+    return ';'.join(signature)
+
+def listBlastDBs(dbDir = 'db'):
+    # returns (file, type, title) rows from 'blastdbcmd -list', which is
+    # only run if the database directory has changed since the last call
+    cacheName = 'templates/results/blastdbs.json'
+    signature = None
+    if(os.path.isdir(dbDir)):
+        signature = dbDirSignature(dbDir)
+    try:
+        with open(cacheName, 'r') as cacheFile:
+            cached = json.load(cacheFile)
+        if(signature and (cached['signature'] == signature)):
+            return([[field.encode('utf-8') for field in row]
+                    for row in cached['rows']])
+    except (IOError, ValueError, KeyError):
+        pass
+    runArgs = ('blastdbcmd','-list',dbDir,'-list_outfmt','%f,%p,%t')
+    dbProcess = subprocess.Popen(args=runArgs, shell=False,
+                                 stdout=subprocess.PIPE, cwd='.')
+    rows = [row for row in csv.reader(dbProcess.stdout) if (len(row) == 3)]
+    # wait, so a long-running (WSGI) process doesn't collect zombies
+    dbProcess.wait()
+    if(not signature):
+        return(rows)
+    if(not os.path.isdir(os.path.dirname(cacheName))):
+        os.makedirs(os.path.dirname(cacheName))
+    # write to a temporary file then rename, so other page views never
+    # see a partially-written list
+    tmpFile = tempfile.NamedTemporaryFile(dir = os.path.dirname(cacheName),
+                                          delete = False)
+    json.dump({'signature': signature, 'rows': rows}, tmpFile)
+    tmpFile.close()
+    os.rename(tmpFile.name, cacheName)
+    return(rows)
 
 def getBlastDBs(parameters):
     printString = ''
-    runArgs = ('blastdbcmd','-list','db','-list_outfmt','%f,%p,%t')
     expectsNucleotide = parameters['program'] in ('blastn', 'tblastn', 'tblastx')
     expectsProtein = parameters['program'] in ('blastp', 'blastx')
-    # writeError('program: %s, en: %s, ep: %s' % (parameters['program'], expectsNucleotide, expectsProtein), parameters)
-    dbOutFile = subprocess.Popen(args=runArgs, shell=False,
-                                  stdout=subprocess.PIPE, cwd='.').stdout
-    reader = csv.reader(dbOutFile)
-    for row in reader:
-        if((len(row) == 3) and not (re.search("\.[0-9]+",row[0]))):
+    # raise PageError('program: %s, en: %s, ep: %s' % (parameters['program'], expectsNucleotide, expectsProtein))
+    for row in listBlastDBs():
+        if(not (re.search("\.[0-9]+",row[0]))):
             if((expectsNucleotide and (row[1] == 'Nucleotide')) or
                (expectsProtein and (row[1] == 'Protein'))):
                 if(('queryDB' in parameters) and (parameters['queryDB'] == row[0])):
@@ -81,42 +188,34 @@ def loadForm(lastForm, parameters):
 
 def loadDefaults(fileName, parameters):
     # loads default form values from a file
-    reader = csv.reader(open(fileName))
-    for row in reader:
-        if(len(row) == 2):
-            parameters[row[0]] = row[1]
-
-def writeError(errorMessage, parameters):
-    printFile('templates/header.html', myparams, True)
-    print("<h1>Error</h1>")
-    print("<p>%s</p>" % errorMessage)
-    printHiddenValues(form, myparams)
-    printFile('templates/footer.html', myparams, False)
-    exit(0)
+    fileStat = os.stat(fileName)
+    signature = (fileStat.st_mtime, fileStat.st_size)
+    if((not (fileName in defaultsCache)) or
+       (defaultsCache[fileName][0] != signature)):
+        with open(fileName) as defaultsFile:
+            defaultsCache[fileName] = (signature, [
+                row for row in csv.reader(defaultsFile) if (len(row) == 2)])
+    for row in defaultsCache[fileName][1]:
+        parameters[row[0]] = row[1]
 
 def runBlast(programName, lastForm, parameters):
-    resultStorageName = 'templates/results/resultsFiles.csv';
     allowedPrograms = ('blastn','blastp','blastx','tblastn','tblastx')
     if(not(programName in allowedPrograms)):
-        writeError("Unable to run '%s' (not an allowed program)"
-                   % programName, parameters)
-        return
+        raise PageError("Unable to run '%s' (not an allowed program)"
+                        % programName)
     resultFile = tempfile.NamedTemporaryFile(delete = False)
     errorFile = tempfile.NamedTemporaryFile(delete = False)
-    # print header so that file will be deleted
-    resultStorageFile = open(resultStorageName,'ab')
     inputFile = tempfile.NamedTemporaryFile(delete = False)
+    queryText = ''
     if(not(parameters['inputText'].startswith('>'))):
-        # no sequence name, so add in a name from the session ID
-        inputFile.write("> %s\n" % parameters['sessionID'])
-    inputFile.write("%s\n" % parameters['inputText'])
+        # no sequence name, so add in a generic name [the session ID
+        # shouldn't appear in results that may be shared via the cache]
+        queryText += "> query\n"
+    queryText += "%s\n" % parameters['inputText']
     if(len(parameters['inputFile']) > 0):
-        inputFile.write(parameters['inputFile'])
+        queryText += parameters['inputFile']
+    inputFile.write(queryText)
     inputFile.close()
-    writer = csv.writer(resultStorageFile)
-    writer.writerow( (parameters['sessionID'],resultFile.name,str(time.time())) )
-    writer.writerow( (parameters['sessionID']+".err",errorFile.name,str(time.time())) )
-    resultStorageFile.close()
     commandLine = list((programName,
                    '-db', parameters['queryDB'],
                    '-query', inputFile.name,
@@ -140,110 +239,129 @@ def runBlast(programName, lastForm, parameters):
             commandLine.extend(('-word_size', parameters['WORD_SIZE']))
     if(('TASK' in parameters) and (parameters['TASK'] != '')):
         commandLine.extend(('-task', parameters['TASK']))
+    if(parameters.get('OUTPUT_MODE') == 'summary'):
+        # compact tabular output; alignments are formatted when opened
+        commandLine[commandLine.index('-outfmt') + 1] = (
+            '7 ' + blastresults.tabularFields)
     parameters['blastCommand'] = str(commandLine)
-    runProcess = subprocess.Popen(commandLine, stdout = resultFile, stderr = errorFile)
-    # allow a bit of time for BLAST to start up [and give the user
-    # some illusion that things aren't happening in the background]
-    time.sleep(1)
-    # remove the input file (on unix it will only be deleted when
-    # the subprocess is finished)
-    os.unlink(inputFile.name)
+    # show the first page of the new results
+    parameters['seenFields'].extend(('resultsPage', 'showAlignment'))
+    resultFile.close()
+    errorFile.close()
+    cacheKey = blastcache.cacheKey(commandLine, queryText,
+                                   parameters['queryDB'])
+    # queue the job (the input file is removed when the job finishes),
+    # or re-use the result of an identical search if there is one
+    job = blastqueue.submitJob(parameters['sessionID'], commandLine,
+                               resultFile.name, errorFile.name,
+                               inputFile.name, parameters, cacheKey=cacheKey)
+    if(job['state'] == 'finished'):
+        parameters['blastCommand'] += ' [cached result]'
     parameters['resultsExist'] = 'True'
 
-def getSequences(parameters, searchDict):
-    lookups = list(searchDict.keys())
-    searchFileName = ""
-    with tempfile.NamedTemporaryFile(delete=False) as searchFile:
-        searchFileName = searchFile.name
-        for searchCode in lookups:
-            searchFile.write('%s\n' % searchCode)
-    commandLine = list(('blastdbcmd',
-                        '-db', parameters['queryDB'],
-                        '-entry_batch', searchFileName,
-                        '-outfmt', '%s'))
-    seqs = list()
-    with tempfile.TemporaryFile() as outFile:
-        runProcess = subprocess.Popen(commandLine, stdout = outFile)
-        runProcess.wait()
-        outFile.seek(0)
-        for line in outFile:
-           seqs.append(line.rstrip())
-    for pos in xrange(len(seqs)):
-        searchDict[lookups[pos]] = seqs[pos]
-    os.unlink(searchFileName)
-
-def cleanUpResultsFiles(parameters):
-    # NOTE: this method deletes files. While attempts are made to make
-    # sure only appropriate files are deleted, it is not advisable to
-    # trust this completely (i.e. don't run the web server as a user
-    # that has access to critical system files)
-    resultStorageName = 'templates/results/resultsFiles.csv';
-    if(not(os.path.exists(resultStorageName))):
-        # no file exists, so no results files exist
-        return
-    filesToAdd = list()
-    reader = csv.reader(open(resultStorageName))
-    for row in reader:
-        sessionID = row[0]
-        resultFileName = row[1]
-        creationTime = float(row[2])
-        currentTime = time.time()
-        removed = False
-        # delete results 24h after creation
-        if(currentTime - creationTime > 60 * 60 * 24):
-            # read first line to make sure it really is a results file
-            # [the program shouldn't delete files that aren't results files]
-            if(os.path.exists(resultFileName)):
-                resultFile = open(resultFileName, 'r')
-                isResultFile = False
-                if(os.path.getsize(resultFileName) > 0):
-                    line1 = resultFile.readline()
-                    if(('BLAST' in line1) or ('USAGE' in line1) or
-                       ('Command line argument error:' in line1) or
-                       ('Error: NCBI' in line1) or ('CFastaReader' in line1)):
-                        isResultFile = True
-                    else:
-                        line2 = resultFile.readline()
-                        resultFile.close()
-                        if('NCBI BlastOutput' in line2):
-                            isResultFile = True
-                else:
-                    # empty files are assumed to be empty results files
-                    isResultFile = True
-                if(not(isResultFile)):
-                    if(not 'errors' in parameters):
-                        parameters['errors'] = ''
-                    parameters['errors'] += 'File \'%s\' does not look like a results file\n' % (
-                        resultFileName)
-                else:
-                    try:
-                        os.remove(resultFileName)
-                        removed = True
-                    except OSError:
-                        if(not 'errors' in parameters):
-                            parameters['errors'] = ''
-                        parameters['errors'] += 'File \'%s\' cannot be deleted by %s' % (
-                            resultFileName, os.getuid())
-            else:
-                # File has already been removed, so it shouldn't be in the list
-                removed = True
-        if(not(removed)):
-            filesToAdd.append(row)
-    # re-write files that have not been deleted back to file
-    resultStorageFile = open(resultStorageName,'wb')
-    writer = csv.writer(resultStorageFile)
-    writer.writerows(filesToAdd)
-    resultStorageFile.close()
+def formatSequence(matchCode, seqs):
+    # FASTA-formatted subject sequence for a blastdbcmd entry
+    keyAnnot = '%s]' % matchCode.replace("-","..").replace(" "," [")
+    value = seqs.get(matchCode, '')
+    seqStr = ''
+    for spos in xrange(0,len(value),70):
+        seqStr += value[spos:spos+70] + '\n'
+    return('>%s\n%s' % (keyAnnot, seqStr))
 
-def getResults(parameters):
-    resultStorageName = 'templates/results/resultsFiles.csv';
-    mostRecentFileName = None
-    mostRecentTime = 0
-    mostRecentErrorFileName = None
-    mostRecentErrorTime = 0
-    formattedPreResult = ''
-    formattedSummaryResult = ''
-    formattedFullResult = ''
+def linkSubject(subject, hsp, gbrowsePatterns):
+    # place appropriate hyperlinks into subject names
+    for subPattern in gbrowsePatterns:
+        if(subPattern in subject):
+            subject = (
+                gbrowsePatterns[subPattern] %
+                (subject,
+                 min(hsp['sbjctStart'], hsp['sbjctEnd']),
+                 max(hsp['sbjctStart'], hsp['sbjctEnd']),
+                 subject,
+                 min(hsp['sbjctStart'], hsp['sbjctEnd']),
+                 max(hsp['sbjctStart'], hsp['sbjctEnd']),
+                 subject))
+    return(subject)
+
+def formatDetails(hsp, subject, context, translatedSub, origSeq, programName):
+    # match details for one HSP (alignment, then gapless sequences)
+    query = hsp['query']
+    frame = None
+    if(hsp['frame'] != None):
+        frame = tuple(json.loads(hsp['frame']))
+    alignmentText = '<a name="%d" href="#summary">**** Alignment %d ****</a>\n' % (
+        hsp['num'], hsp['num'])
+    alignmentText += 'query: %s\n' % query
+    alignmentText += 'query length: %s\n' % hsp['queryLength']
+    alignmentText += 'subject: %s\n' % subject
+    alignmentText += 'subject length: %s\n' % hsp['subjectLength']
+    alignmentText += 'align length: %s\n' % hsp['alignLength']
+    if(frame != None):
+        alignmentText += 'frame: (%d,%d)\n' % frame
+    alignmentText += 'score: %s\n' % hsp['score']
+    alignmentText += 'bits: %s\n' % hsp['bits']
+    alignmentText += 'identity: %0.2f%%\n' % hsp['identity']
+    alignmentText += 'query coverage: %0.2f%%\n' % hsp['coverage']
+    alignmentText += 'subject coverage: %0.2f%%\n' % hsp['subjCoverage']
+    alignmentText += 'e value: %g\n' % hsp['evalue']
+    alignmentText += blastresults.alignmentRows(hsp, programName)
+    # collect pieces in a list and join once, rather than adding to a
+    # string
+    details = [alignmentText, '\n']
+    gaplessQuery = hsp['gaplessQuery']
+    gaplessSbjct = hsp['gaplessSbjct']
+    details.append('** Gapless Query Match Subsequence **\n')
+    details.append('>%s [%d..%d]\n' % (query, hsp['queryStart'], hsp['queryEnd']))
+    for spos in xrange(0,len(gaplessQuery),70):
+        details.append(gaplessQuery[spos:spos+70] + '\n')
+    appendString = (' (translated)' if translatedSub else '')
+    if((context > 0) and not translatedSub):
+        appendString += ' (%d context)' % context
+    details.append('\n** Gapless Subject Match Subsequence%s **\n' % appendString)
+    matchCodes = blastresults.contextCodes(hsp, context, translatedSub)
+    if((context > 0) and not translatedSub):
+        details.append(formatSequence(matchCodes.pop(0), origSeq) + '\n')
+    else:
+        details.append('>%s [%d..%d%s%s]\n' % (
+            subject, hsp['sbjctStart'], hsp['sbjctEnd'],
+            ',translated' if translatedSub else '',
+            ',RC' if ((frame != None) and (frame[1] < 0)) else ''))
+        for spos in xrange(0,len(gaplessSbjct),70):
+            details.append(gaplessSbjct[spos:spos+70] + '\n')
+    if(matchCodes):
+        details.append('\n** Gapless Subject Match Subsequence%s **\n' % (
+            (' (%d context)' % context) if (context > 0) else ''))
+        details.append(formatSequence(matchCodes.pop(0), origSeq) + '\n')
+    details.append('\n')
+    return(''.join(details))
+
+def pageButtons(page, numPages):
+    # buttons for the first, last, and nearby pages of results
+    if(numPages <= 1):
+        return('')
+    buttonText = '<p>Page:'
+    lastShown = 0
+    for pageNum in xrange(1, numPages + 1):
+        if((pageNum != 1) and (pageNum != numPages) and
+           (abs(pageNum - page) > 3)):
+            continue
+        if(pageNum > lastShown + 1):
+            buttonText += ' ...'
+        if(pageNum == page):
+            buttonText += ' <b>%d</b>' % pageNum
+        else:
+            buttonText += (' <button type="submit" name="resultsPage" value="%d">%d</button>'
+                           % (pageNum, pageNum))
+        lastShown = pageNum
+    buttonText += '</p>\n'
+    return(buttonText)
+
+def formatResults(results, parameters, runTime, page, perPage,
+                  summaryOnly = False):
+    # generates the Results page text for one page of HSPs; this is
+    # printed as it is generated (see printFile), so only one page of
+    # HSPs is held in memory. For summary mode jobs, match details are
+    # only shown for the HSP chosen with 'showAlignment'.
     context = 0
     # sort out GBrowse pattern replacements
     gbrowsePatterns = dict()
@@ -256,278 +374,287 @@ def getResults(parameters):
     if(('CONTEXT' in parameters) and
        (parameters['CONTEXT'] != '')):
         context = int(parameters['CONTEXT'])
+    translatedSub = ((parameters['program'] == 'tblastn') or (parameters['program'] == 'tblastx'))
+    numAlignments = blastresults.countHsps(results)
+    numPages = (numAlignments + perPage - 1) // perPage
+    firstHsp = (page - 1) * perPage
+    hsps = list(blastresults.hspRows(results, firstHsp, perPage))
+    subjects = [linkSubject(hsp['subject'], hsp, gbrowsePatterns)
+                for hsp in hsps]
+    detailHsps = zip(hsps, subjects)
+    if(summaryOnly):
+        detailHsps = list()
+        shown = parameters.get('showAlignment', '')
+        if(shown.isdigit() and (int(shown) < numAlignments)):
+            for hsp in blastresults.hspRows(results, int(shown), 1):
+                detailHsps.append(
+                    (hsp, linkSubject(hsp['subject'], hsp, gbrowsePatterns)))
+    yield('<p>Reference Database: %s</p>\n' % parameters['queryDB'])
+    yield('<p>BLAST Run started: %s</p>\n'
+          % time.strftime('%Y-%b-%d %H:%M:%S', time.localtime(runTime)))
+    yield('<p>Number of alignments: %d</p>\n' % numAlignments)
+    if(numPages > 1):
+        yield('<p>Showing alignments %d-%d</p>\n'
+              % (firstHsp, firstHsp + len(hsps) - 1))
+    yield(pageButtons(page, numPages))
+    if(summaryOnly):
+        # the opened alignment comes first, so it is seen without
+        # scrolling past the summary
+        for text in formatMatchDetails(results, parameters, detailHsps,
+                                       context, translatedSub):
+            yield(text)
+    yield('<h2><a name="summary"></a>Summary</h2>\n')
+    yield('<table class="sortable">\n')
+    yield('<thead>\n' +
+          '  <tr>' +
+          '<th>Alignment</th>' +
+          '<th>Query</th>' +
+          '<th>Subject</th>' +
+          '<th>Bitscore</th>' +
+          '<th>Coverage %</th>' +
+          '<th>Identity %</th>' +
+          '<th>E value</th>' +
+          '</tr>\n' +
+          '</thead>\n')
+    yield('<tbody>\n')
+    alignmentLink = '<a href="#%d">%d</a>'
+    if(summaryOnly):
+        alignmentLink = '<button type="submit" name="showAlignment" value="%d">%d</button>'
+    for (hsp, subject) in zip(hsps, subjects):
+        yield(('  <tr><td>' + alignmentLink + '</td><td>%s</td><td>%s</td>' +
+               '<td>%0.2f</td><td>%0.2f</td><td>%0.2f</td><td>%5g</td></tr>\n') % (
+            hsp['num'], hsp['num'], hsp['query'], subject, hsp['score'],
+            hsp['coverage'], hsp['identity'], hsp['evalue']))
+    yield('</tbody>\n')
+    yield('</table>\n')
+    if(not summaryOnly):
+        for text in formatMatchDetails(results, parameters, detailHsps,
+                                       context, translatedSub):
+            yield(text)
+    yield(pageButtons(page, numPages))
+    results.close()
+
+def formatMatchDetails(results, parameters, detailHsps, context,
+                       translatedSub):
+    # generates the Match Details section for (hsp, subject) pairs
+    if(not detailHsps):
+        return
+    # sequences for match context (only for the HSPs shown)
+    matchCodes = set()
+    for (hsp, subject) in detailHsps:
+        matchCodes.update(blastresults.contextCodes(hsp, context,
+                                                    translatedSub))
+    origSeq = blastresults.contextSequences(results, parameters['queryDB'],
+                                            matchCodes)
+    yield('<h2>Match Details</h2>')
+    yield('<pre>\n')
+    for (hsp, subject) in detailHsps:
+        yield(formatDetails(hsp, subject, context, translatedSub, origSeq,
+                            parameters['program']))
+    yield('</pre>\n')
+
+def getResults(parameters):
     # find location of results files and error output
-    reader = csv.reader(open(resultStorageName))
-    for row in reader:
-        sessionID = row[0]
-        resultFileName = row[1]
-        creationTime = float(row[2])
-        if((sessionID == parameters['sessionID']) and
-           (creationTime >= mostRecentTime)):
-            mostRecentFileName = resultFileName
-            mostRecentTime = creationTime
-        if((sessionID == parameters['sessionID']+".err") and
-           (creationTime >= mostRecentErrorTime)):
-            mostRecentErrorFileName = resultFileName
-            mostRecentErrorTime = creationTime
-    resultsFound = False
-    if(mostRecentFileName != None):
-        if((mostRecentErrorFileName != None) and (os.path.getsize(mostRecentErrorFileName) > 0)):
-            f = open(mostRecentErrorFileName, 'r')
-            errorStr = "<pre>"
-            for line in f:
-                errorStr += line
-            errorStr += "</pre>"
-            writeError(errorStr, parameters)
-            return
-        if(os.path.getsize(mostRecentFileName) == 0):
-            return('The results file is empty. Have a sip of your favourite beverage then click "Results" again.')
-        resultFile = open(mostRecentFileName, 'r')
-        blast_records = NCBIXML.parse(resultFile)
-        formattedPreResult += ('<p>Reference Database: %s</p>\n'
-                               % parameters['queryDB'])
-        formattedPreResult += ('<p>BLAST Run started: %s</p>\n'
-                               % time.strftime('%Y-%b-%d %H:%M:%S',
-                                               time.localtime(mostRecentTime)))
-        formattedFullResult += '<h2>Match Details</h2>'
-        formattedFullResult += '<pre>\n'
-        numAlignments = 0
-        queries = set()
-        summaryTable = list()
-        origSeq = dict()
-        translatedQuery = (parameters['program'] == 'blastx')
-        translatedSub = ((parameters['program'] == 'tblastn') or (parameters['program'] == 'tblastx'))
-        for blast_record in blast_records:
-            for alignment in blast_record.alignments:
-                for hsp in alignment.hsps:
-                    resultsFound = True
-                    query = blast_record.query
-                    subject = alignment.hit_def
-                    if('hit_id' in vars(alignment) and not ('BL_ORD_ID' in alignment.hit_id)):
-                        subject = alignment.hit_id
-                    if(" " in query):
-                        query = query[0:query.find(" ")];
-                    if(" " in subject):
-                        subject = subject[0:subject.find(" ")];
-                    identity = float(hsp.identities) / (hsp.align_length) * 100
-                    coverage = float(abs(hsp.query_end - hsp.query_start)+1) / blast_record.query_length * 100
-                    subjCoverage = float(abs(hsp.sbjct_end - hsp.sbjct_start)+1) / alignment.length * 100
-                    # place appropriate hyperlinks into subject names
-                    for subPattern in gbrowsePatterns:
-                        if(subPattern in subject):
-                            subject = (
-                                gbrowsePatterns[subPattern] %
-                                (subject,
-                                 min(hsp.sbjct_start, hsp.sbjct_end),
-                                 max(hsp.sbjct_start, hsp.sbjct_end),
-                                 subject,
-                                 min(hsp.sbjct_start, hsp.sbjct_end),
-                                 max(hsp.sbjct_start, hsp.sbjct_end),
-                                 subject))
-                    alignmentText = '<a name="%d" href="#summary">**** Alignment %d ****</a>\n' % (
-                        numAlignments, numAlignments)
-                    alignmentText += 'query: %s\n' % query
-                    alignmentText += 'query length: %s\n' % blast_record.query_length
-                    alignmentText += 'subject: %s\n' % subject
-                    alignmentText += 'subject length: %s\n' % alignment.length
-                    alignmentText += 'align length: %s\n' % hsp.align_length
-                    if('frame' in vars(hsp)):
-                        alignmentText += 'frame: (%d,%d)\n' % hsp.frame
-                    alignmentText += 'score: %s\n' % hsp.score
-                    alignmentText += 'bits: %s\n' % hsp.bits
-                    alignmentText += 'identity: %0.2f%%\n' % identity
-                    alignmentText += 'query coverage: %0.2f%%\n' % coverage
-                    alignmentText += 'subject coverage: %0.2f%%\n' % subjCoverage
-                    alignmentText += 'e value: %g\n' % hsp.expect
-                    #alignmentText += '\n%s\n\n' % vars(hsp)
-                    querySpos = oldQPos = queryPos = hsp.query_start
-                    sbjctSpos = oldSPos = sbjctPos = hsp.sbjct_start
-                    alignSpos = alignPos = 0
-                    queryDir =  1 if (hsp.query_start < hsp.query_end) else -1
-                    sbjctDir = 1 if (hsp.sbjct_start < hsp.sbjct_end) else -1
-                    incQuery = False
-                    incSbjct = False
-                    incStepSbjct = 1
-                    if(translatedSub):
-                        incStepSbjct = 3
-                    for hsp.char in hsp.match:
-                        if(hsp.query[alignPos] != '-'):
-                            oldQPos = queryPos
-                            if(not incQuery):
-                                querySpos = queryPos
-                            incQuery = True
-                            queryPos += queryDir
-                        if(hsp.sbjct[alignPos] != '-'):
-                            oldSPos = sbjctPos
-                            if(not incSbjct):
-                                sbjctSpos = sbjctPos
-                            incSbjct = True
-                            sbjctPos += sbjctDir
-                        alignPos += 1
-                        if((alignPos % 100 == 0) or (alignPos >= len(hsp.match))):
-                            if('frame' in vars(hsp) and (hsp.frame[1] < 0)):
-                                adjSSPos = hsp.sbjct_end - (sbjctSpos - hsp.sbjct_start) * incStepSbjct
-                                adjSEPos = hsp.sbjct_end - (oldSPos - hsp.sbjct_start) * incStepSbjct + (incStepSbjct-1)
-                            else:
-                                adjSSPos = hsp.sbjct_start + (sbjctSpos - hsp.sbjct_start) * incStepSbjct
-                                adjSEPos = hsp.sbjct_start + (oldSPos - hsp.sbjct_start) * incStepSbjct + (incStepSbjct-1)
-                            alignmentText += '\n'
-                            alignmentText += 'Query %9d %s %-9d\n' % (
-                                querySpos, hsp.query[alignSpos:alignPos], oldQPos)
-                            alignmentText += '      %9s %s\n' % ('', hsp.match[alignSpos:alignPos])
-                            alignmentText += 'Sbjct %9s %s %-9d\n' % (
-                                adjSSPos, hsp.sbjct[alignSpos:alignPos], adjSEPos)
-                            incQuery = False
-                            incSbjct = False
-                            alignSpos = alignPos
-                    formattedFullResult += alignmentText + '\n'
-                    gaplessQuery = hsp.query.replace("-","")
-                    gaplessSbjct = hsp.sbjct.replace("-","")
-                    formattedFullResult += '** Gapless Query Match Subsequence **\n'
-                    formattedFullResult += '>%s [%d..%d]\n' % (query, hsp.query_start, hsp.query_end)
-                    for spos in xrange(0,len(gaplessQuery),70):
-                        formattedFullResult += gaplessQuery[spos:spos+70] + '\n'
-                    appendString = (' (translated)' if translatedSub else '')
-                    if((context > 0) and not translatedSub):
-                        appendString += ' (%d context)' % context
-                    formattedFullResult += '\n** Gapless Subject Match Subsequence%s **\n' % appendString
-                    if((context > 0) and not translatedSub):
-                        matchStart = max(1,hsp.sbjct_start-context)
-                        matchEnd = hsp.sbjct_end+context
-                        if(matchEnd < matchStart):
-                            matchStart = max(1,hsp.sbjct_end-context)
-                            matchEnd = hsp.sbjct_start+context
-                        matchCode = '%s %d-%d' % (
-                            alignment.hit_id, matchStart, matchEnd)
-                        formattedFullResult += '%%SEQ(%s)\n' % matchCode
-                        origSeq[matchCode] = ""
-                    else:
-                        formattedFullResult += '>%s [%d..%d%s%s]\n' % (
-                            subject, hsp.sbjct_start, hsp.sbjct_end,
-                            ',translated' if translatedSub else '',
-                            ',RC' if ('frame' in vars(hsp) and (hsp.frame[1] < 0)) else '')
-                        for spos in xrange(0,len(gaplessSbjct),70):
-                            formattedFullResult += gaplessSbjct[spos:spos+70] + '\n'
-                    if(translatedSub and ('hit_id' in vars(alignment))):
-                        matchStart = max(1,hsp.sbjct_start-context)
-                        matchEnd = hsp.sbjct_end+context
-                        if(matchEnd < matchStart):
-                            matchStart = max(1,hsp.sbjct_end-context)
-                            matchEnd = hsp.sbjct_start+context
-                        matchCode = '%s %d-%d' % (
-                            alignment.hit_id, matchStart, matchEnd)
-                        formattedFullResult += '\n** Gapless Subject Match Subsequence%s **\n' % (
-                            (' (%d context)' % context) if (context > 0) else '')
-                        formattedFullResult += '%%SEQ(%s)\n' % matchCode
-                        origSeq[matchCode] = ""
-                    formattedFullResult += '\n'
-                    queries.add(blast_record.query)
-                    summaryTable.append((query, subject, hsp.score,
-                        coverage, identity, hsp.expect))
-                    numAlignments += 1
-        if(translatedSub or (context > 0)):
-            getSequences(parameters, origSeq)
-            for (key, value) in origSeq.items():
-                keyAnnot = '%s]' % key.replace("-","..").replace(" "," [")
-                seqStr = ''
-                for spos in xrange(0,len(value),70):
-                    seqStr += value[spos:spos+70] + '\n'
-                formattedFullResult = formattedFullResult.replace('%%SEQ(%s)' % key,'>%s\n%s' % (keyAnnot, seqStr))
-        formattedFullResult += '</pre>\n'
-        formattedPreResult += ('<p>Number of alignments: %d</p>\n'
-                               % numAlignments)
-        formattedSummaryResult += '<h2><a name="summary"></a>Summary</h2>\n'
-        formattedSummaryResult += '<table class="sortable">\n'
-        formattedSummaryResult += ('<thead>\n' +
-                                   '  <tr>' +
-                                   '<th>Alignment</th>' +
-                                   '<th>Query</th>' +
-                                   '<th>Subject</th>' +
-                                   '<th>Bitscore</th>' +
-                                   '<th>Coverage %</th>' +
-                                   '<th>Identity %</th>' +
-                                   '<th>E value</th>' +
-                                   '</tr>\n' +
-                                   '</thead>\n')
-        formattedSummaryResult += '<tbody>\n'
-        for alignment in range(numAlignments):
-            formattedSummaryResult += (('  <tr><td><a href="#%d">%d</a></td><td>%s</td><td>%s</td>' +
-                                        '<td>%0.2f</td><td>%0.2f</td><td>%0.2f</td><td>%5g</td></tr>\n') % (
-                    alignment,
-                    alignment,
-                    (summaryTable[alignment])[0],
-                    (summaryTable[alignment])[1],
-                    (summaryTable[alignment])[2],
-                    (summaryTable[alignment])[3],
-                    (summaryTable[alignment])[4],
-                    (summaryTable[alignment])[5]))
-        formattedSummaryResult += '</tbody>\n'
-        formattedSummaryResult += '</table>\n'
-    if(resultsFound):
-        return(formattedPreResult + formattedSummaryResult + formattedFullResult)
-    else:
+    job = jobstore.latestJob(parameters['sessionID'])
+    if(job == None):
+        return('No hits were found')
+    mostRecentFileName = job['resultFile']
+    mostRecentErrorFileName = job['errorFile']
+    mostRecentTime = job['submitTime']
+    if(os.path.exists(mostRecentErrorFileName) and (os.path.getsize(mostRecentErrorFileName) > 0)):
+        f = open(mostRecentErrorFileName, 'r')
+        errorStr = "<pre>"
+        for line in f:
+            errorStr += line
+        errorStr += "</pre>"
+        raise PageError(errorStr)
+    job = blastqueue.jobStatus(job['jobID'])
+    # the status paragraph is kept up to date by templates/jobstatus.js,
+    # which shows the results once the job has finished
+    if(job and (job['state'] == 'queued')):
+        return('<p id="jobStatus">Your BLAST job is waiting to run (%d job(s) ahead of it). Click "Results" again to check progress.</p>' %
+               job['queuePosition'])
+    if(job and (job['state'] == 'running')):
+        return('<p id="jobStatus">Your BLAST job has been running for %d seconds. Have a sip of your favourite beverage then click "Results" again.</p>' %
+               (time.time() - job['startTime']))
+    if(os.path.getsize(mostRecentFileName) == 0):
+        return('The results file is empty. Have a sip of your favourite beverage then click "Results" again.')
+    results = blastresults.openResults(job)
+    numAlignments = blastresults.countHsps(results)
+    if(numAlignments == 0):
+        results.close()
         return('No hits were found')
+    perPage = max(1, int(parameters.get('results_per_page') or 100))
+    numPages = (numAlignments + perPage - 1) // perPage
+    page = 1
+    if(parameters.get('resultsPage', '').isdigit()):
+        page = min(max(int(parameters['resultsPage']), 1), numPages)
+    # the opened alignment isn't kept when moving to another page
+    parameters['seenFields'].append('showAlignment')
+    # the page is generated while it is printed
+    return(formatResults(results, parameters, mostRecentTime, page, perPage,
+                         blastresults.isTabular(job['commandLine'])))
+
+def jobStatusJSON(sessionID):
+    # state, elapsed time and estimated progress of the session's latest
+    # job, for polling from the Results page without reloading it
+    status = {'state': 'none'}
+    job = jobstore.latestJob(sessionID)
+    if(job != None):
+        job = blastqueue.jobStatus(job['jobID'])
+    if(job != None):
+        status['state'] = job['state']
+        if(job['state'] == 'queued'):
+            status['queuePosition'] = job['queuePosition']
+            status['elapsed'] = int(time.time() - job['submitTime'])
+        elif(job['state'] == 'running'):
+            status['elapsed'] = int(time.time() - job['startTime'])
+            (doneQueries, totalQueries) = blastqueue.jobProgress(job)
+            status['queriesDone'] = doneQueries
+            status['queries'] = totalQueries
+            if(totalQueries > 0):
+                status['progress'] = round(float(doneQueries) / totalQueries, 3)
+        elif(job['state'] == 'finished'):
+            status['elapsed'] = int((job['endTime'] or 0) -
+                                    (job['startTime'] or job['submitTime']))
+            status['progress'] = 1.0
+    return(json.dumps(status))
+
+def pageText(form, requestURI):
+    # yields the page (without HTTP header) for a submitted form, as it
+    # is generated
+    myparams = {
+        "class_query"  : "taboff",
+        "class_params" : "taboff",
+        "class_results": "taboff",
+        "seenFields"   : list(),
+        "addFields"    : ('resultsExist','sessionID','blastCommand'),
+        }
+
+    #blastn -db db/3alln_smed -query /tmp/tmpGFk3hs -outfmt 5 -task blastn -evalue 10 -max_target_seqs 100 -word_size 11
+
+    currentProgram = form.getfirst("selectProgram","blastn")
+    currentTab = form.getfirst("selectTab","query")
+
+    # get local site defaults
+    loadDefaults('templates/site_defaults.csv', myparams)
+    # get default values for this program
+    loadDefaults('templates/%s_defaults.csv' % currentProgram, myparams)
+    # overwrite default values with previous form values
+    loadForm(form, myparams)
+
+    # add sessionID if it doesn't already exist
+    if(not('sessionID' in myparams)):
+        myparams['sessionID'] = base64.b64encode(os.urandom(16))
+
+    myparams['program'] = currentProgram
+    # activate current tab
+    myparams['class_' + currentTab] = "tabon"
+
+    if(myparams['program'] in ('blastn', 'blastx', 'tblastx')):
+        myparams['inputType'] = 'nucleotide';
+    if(myparams['program'] in ('blastp', 'tblastn')):
+        myparams['inputType'] = 'protein';
+
+    myparams['databases'] = getBlastDBs(myparams)
+    myparams['request_uri'] = requestURI
+
+    try:
+        # run BLAST (if requested)
+        if(form.getfirst("runBlast","") == "BLAST"):
+            runBlast(currentProgram, form, myparams)
+
+        if((not('resultsExist' in myparams)) or (myparams['resultsExist'] != 'True')):
+            myparams['class_results'] += " tabdisabled"
+        else:
+            # retrieve result file, and display on tab (if tab is visible)
+            if(currentTab == 'results'):
+                myparams['results'] = getResults(myparams)
+    except PageError as e:
+        pageError = e
+    else:
+        pageError = None
+
+    for text in templateText('templates/header.html', myparams):
+        yield text
+    if(pageError):
+        yield "<h1>Error</h1>\n"
+        yield "<p>%s</p>\n" % pageError
+    else:
+        for text in templateText('templates/%s_%s.html' %
+                                 (currentProgram, currentTab), myparams):
+            yield text
+        if('errors' in myparams):
+            yield '<h3>Errors:</h3><pre>%s</pre>\n' % myparams['errors']
+    hiddenValues = cStringIO.StringIO()
+    printHiddenValues(form, myparams, hiddenValues)
+    yield hiddenValues.getvalue()
+    for text in templateText('templates/footer.html', myparams):
+        yield text
+
+def handleRequest(form, requestURI, outFile = sys.stdout):
+    # writes the page (without HTTP header) for a submitted form
+    for text in pageText(form, requestURI):
+        outFile.write(text)
+
+def textChunks(pieces, chunkSize = 16384):
+    # joins small pieces of text into chunks of about chunkSize bytes,
+    # since WSGI servers send each item of the response separately
+    chunk = list()
+    size = 0
+    for piece in pieces:
+        chunk.append(piece)
+        size += len(piece)
+        if(size >= chunkSize):
+            yield ''.join(chunk)
+            chunk = list()
+            size = 0
+    if(chunk):
+        yield ''.join(chunk)
+
+def application(environ, start_response):
+    # WSGI entry point, so that a long-running process can serve many
+    # requests (e.g. mod_wsgi, or 'blast.py serve' for local testing)
+    # template and database paths are relative to the cgi-bin directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    form = cgi.FieldStorage(fp = environ['wsgi.input'], environ = environ)
+    if(form.getfirst('status', '') == 'json'):
+        page = jobStatusJSON(form.getfirst('sessionID', ''))
+        start_response('200 OK', [('Content-Type', 'application/json'),
+                                  ('Cache-Control', 'no-cache'),
+                                  ('Content-Length', str(len(page)))])
+        return [page]
+    requestURI = environ.get('REQUEST_URI')
+    if(not requestURI):
+        requestURI = environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')
+        if(environ.get('QUERY_STRING')):
+            requestURI += '?' + environ['QUERY_STRING']
+    # the page is sent as it is generated, so that results are shown
+    # while they are being read
+    start_response('200 OK', [('Content-Type', 'text/html')])
+    return textChunks(pageText(form, requestURI))
 
 ### Begin Actual Program ###
 
-#cgitb.enable() # make errors visible on web pages
-
-form = cgi.FieldStorage()   # FieldStorage object to
-                            # hold the form data
-myparams = {
-    "class_query"  : "taboff",
-    "class_params" : "taboff",
-    "class_results": "taboff",
-    "seenFields"   : list(),
-    "addFields"    : ('resultsExist','sessionID','blastCommand'),
-    }
-
-#blastn -db db/3alln_smed -query /tmp/tmpGFk3hs -outfmt 5 -task blastn -evalue 10 -max_target_seqs 100 -word_size 11
-
-currentProgram = form.getfirst("selectProgram","blastn")
-currentTab = form.getfirst("selectTab","query")
-
-# get local site defaults
-loadDefaults('templates/site_defaults.csv', myparams)
-# get default values for this program
-loadDefaults('templates/%s_defaults.csv' % currentProgram, myparams)
-# overwrite default values with previous form values
-loadForm(form, myparams)
-
-# add sessionID if it doesn't already exist
-if(not('sessionID' in myparams)):
-    myparams['sessionID'] = base64.b64encode(os.urandom(16))
-
-myparams['program'] = currentProgram
-# activate current tab
-myparams['class_' + currentTab] = "tabon"
-
-if(myparams['program'] in ('blastn', 'blastx', 'tblastx')):
-    myparams['inputType'] = 'nucleotide';
-if(myparams['program'] in ('blastp', 'tblastn')):
-    myparams['inputType'] = 'protein';
-
-myparams['databases'] = getBlastDBs(myparams)
-myparams['request_uri'] = os.environ['REQUEST_URI']
-
-# remove stale results files
-cleanUpResultsFiles(myparams)
-
-# run BLAST (if requested)
-if(form.getfirst("runBlast","") == "BLAST"):
-    runBlast(currentProgram, form, myparams)
-
-if((not('resultsExist' in myparams)) or (myparams['resultsExist'] != 'True')):
-    myparams['class_results'] += " tabdisabled"
-else:
-    # retrieve result file, and display on tab (if tab is visible)
-    if(currentTab == 'results'):
-        myparams['results'] = getResults(myparams)
-
-printFile('templates/header.html', myparams, True)
-printFile('templates/%s_%s.html' % (currentProgram, currentTab),
-          myparams, False)
-if('errors' in myparams):
-    print('<h3>Errors:</h3><pre>%s</pre>' % myparams['errors']);
-printHiddenValues(form, myparams)
-printFile('templates/footer.html', myparams, False)
+if(__name__ == '__main__'):
+    if((len(sys.argv) > 1) and (sys.argv[1] == 'serve') and
+       not ('GATEWAY_INTERFACE' in os.environ)):
+        # local test server: blast.py serve [port]
+        from wsgiref.simple_server import make_server
+        port = int(sys.argv[2]) if (len(sys.argv) > 2) else 8000
+        sys.stderr.write('Serving on http://localhost:%d/\n' % port)
+        make_server('localhost', port, application).serve_forever()
+    else:
+        #cgitb.enable() # make errors visible on web pages
+
+        form = cgi.FieldStorage()   # FieldStorage object to
+                                    # hold the form data
+        if(form.getfirst('status', '') == 'json'):
+            # job status for the Results page poller (see jobstatus.js)
+            print('Content-type: application/json')
+            print('Cache-Control: no-cache\n')
+            print(jobStatusJSON(form.getfirst('sessionID', '')))
+        else:
+            # HTTP header
+            print('Content-type: text/html\n\n')
+            handleRequest(form, os.environ['REQUEST_URI'])
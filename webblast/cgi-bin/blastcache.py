@@ -0,0 +1,94 @@
+#!/usr/bin/python
+
+# blastcache.py -- content-addressed cache of BLAST results
+#
+# Results are stored under a key made from the normalised query
+# sequences, the database files (names, sizes and modification times)
+# and the BLAST command-line options that affect the output (program,
+# task, evalue, max_target_seqs, word_size, ...). Re-submitting an
+# identical search copies the stored result instead of running BLAST.
+# When the cache grows beyond its size limit, the least recently used
+# results are removed.
+
+import os # file handling
+import glob # for database file lists
+import shutil # for copying results
+import hashlib # for cache keys
+
+cacheDir = 'templates/results/cache'
+
+def normaliseQuery(queryText):
+    # remove blank lines and line wrapping, and upper-case sequences, so
+    # that differently-formatted copies of the same query match
+    records = list()
+    for line in queryText.splitlines():
+        line = line.strip()
+        if(not line):
+            continue
+        if(line.startswith('>')):
+            records.append([' '.join(line.split()), ''])
+        else:
+            if(not records):
+                records.append(['>', ''])
+            records[-1][1] += ''.join(line.split()).upper()
+    return '\n'.join('%s\n%s' % (header, seq) for (header, seq) in records)
+
+def databaseSignature(dbName):
+    signature = list()
+    for fileName in sorted(glob.glob(dbName + '.*')):
+        fileStat = os.stat(fileName)
+        signature.append('%s:%d:%d' % (fileName, fileStat.st_size,
+                                       int(fileStat.st_mtime)))
+    return ';'.join(signature)
+
+def cacheKey(commandLine, queryText, dbName):
+    # the query file name differs for every submission, so it is left out
+    options = list(commandLine)
+    if('-query' in options):
+        queryPos = options.index('-query')
+        del options[queryPos:(queryPos + 2)]
+    keyHash = hashlib.sha256()
+    keyHash.update('\0'.join(options) + '\0')
+    keyHash.update(databaseSignature(dbName) + '\0')
+    keyHash.update(normaliseQuery(queryText))
+    return keyHash.hexdigest()
+
+def cacheFileName(key):
+    return os.path.join(cacheDir, '%s.out' % key)
+
+def fetchResult(key, resultFileName):
+    # copy a cached result into resultFileName; returns False if there
+    # is no cached result for this key
+    cachedName = cacheFileName(key)
+    try:
+        shutil.copyfile(cachedName, resultFileName)
+        os.utime(cachedName, None) # mark as recently used
+    except (IOError, OSError):
+        return False
+    return True
+
+def storeResult(key, resultFileName, maxBytes):
+    if(not os.path.isdir(cacheDir)):
+        os.makedirs(cacheDir)
+    tmpName = cacheFileName(key) + '.tmp'
+    shutil.copyfile(resultFileName, tmpName)
+    os.rename(tmpName, cacheFileName(key))
+    evictResults(maxBytes)
+
+def evictResults(maxBytes):
+    # remove least recently used results until the cache fits in maxBytes
+    entries = list()
+    totalBytes = 0
+    for fileName in os.listdir(cacheDir):
+        if(fileName.endswith('.out')):
+            fileStat = os.stat(os.path.join(cacheDir, fileName))
+            entries.append((fileStat.st_mtime, fileStat.st_size, fileName))
+            totalBytes += fileStat.st_size
+    for (mtime, size, fileName) in sorted(entries):
+        if(totalBytes <= maxBytes):
+            break
+        try:
+            os.remove(os.path.join(cacheDir, fileName))
+        except OSError:
+            pass
+        totalBytes -= size
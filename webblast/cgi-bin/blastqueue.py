@@ -0,0 +1,383 @@
+#!/usr/bin/python
+
+# blastqueue.py -- run submitted BLAST jobs with a bounded number of
+# concurrent processes
+#
+# blast.py adds jobs to the queue with submitJob(), which also starts a
+# dispatcher ('blastqueue.py <max jobs>') in the background. Only one
+# dispatcher runs at a time (others wait on a lock file); it starts
+# queued jobs whenever fewer than <max jobs> are running, and exits when
+# the queue is empty. Job state is kept in the job store (jobstore.py).
+#
+# Jobs are started in order of (number of running jobs for the job's
+# session, submission time), so one session submitting many queries
+# cannot hold up jobs from other sessions.
+#
+# Queries with many sequences are split into up to <max jobs> chunks of
+# consecutive sequences, which are queued as separate jobs. When all
+# chunks of a job have finished, their output is merged (in query order)
+# into the job's results file. Tabular (summary mode) output is simply
+# joined together.
+
+import os # file handling, process checks
+import re # for XML renumbering
+import sys # for command-line arguments
+import time # for job times
+import shutil # for joining tabular output
+import fcntl # for dispatcher lock
+import tempfile # for chunk files
+import subprocess # for running BLAST
+import blastcache # for storing results
+import blastresults # for processing results
+import jobstore # for job state
+
+lockFileName = 'templates/results/dispatch.lock'
+
+def submitJob(sessionID, commandLine, resultFileName, errorFileName,
+              inputFileName, parameters, cacheKey=None):
+    # queue a BLAST job, and make sure a dispatcher is running for it;
+    # returns the job. If the result is already in the cache, it is
+    # copied to resultFileName and the job is returned as finished.
+    threads = int(parameters.get('threads_per_job', 1))
+    maxJobs = int(parameters.get('max_running_jobs', 2))
+    jobID = os.path.basename(resultFileName)
+    job = {
+        'jobID': jobID,
+        'sessionID': sessionID,
+        'commandLine': list(commandLine) + ['-num_threads', str(threads)],
+        'resultFile': resultFileName,
+        'errorFile': errorFileName,
+        'inputFile': inputFileName,
+        'state': 'queued',
+        'submitTime': time.time(),
+        'startTime': None,
+        'endTime': None,
+        'pid': None,
+        'exitCode': None,
+        'cacheKey': cacheKey,
+        'cacheBytes': int(parameters.get('cache_size_mb', 0)) * 1024 * 1024,
+        'context': int(parameters.get('CONTEXT') or 0),
+        }
+    if(cacheKey and (job['cacheBytes'] > 0) and
+       blastcache.fetchResult(cacheKey, resultFileName)):
+        open(errorFileName, 'w').close()
+        job['state'] = 'finished'
+        job['startTime'] = job['endTime'] = job['submitTime']
+        job['exitCode'] = 0
+        job['cacheKey'] = None # already stored
+        jobstore.saveJob(job)
+        if(os.path.exists(inputFileName)):
+            os.unlink(inputFileName)
+        return job
+    with open(inputFileName, 'r') as inputFile:
+        chunkTexts = splitQuery(inputFile.read(), maxJobs,
+                                int(parameters.get('split_min_sequences', 0)))
+    if(len(chunkTexts) > 1):
+        submitChunks(job, chunkTexts)
+    else:
+        jobstore.saveJob(job)
+    # the dispatcher is detached from the web request, so the page can be
+    # returned straight away
+    with open(os.devnull, 'r+') as nullFile:
+        subprocess.Popen((pythonExecutable(), os.path.abspath(__file__),
+                          str(maxJobs)),
+                         stdin=nullFile, stdout=nullFile, stderr=nullFile,
+                         close_fds=True, preexec_fn=os.setsid)
+    return job
+
+def splitQuery(queryText, numChunks, minSequences):
+    # splits FASTA query text into at most numChunks pieces of
+    # consecutive sequences with similar total length; queries with
+    # fewer than minSequences sequences are not split
+    records = list() # [lines, sequence length]
+    for line in queryText.splitlines(True):
+        if(line.startswith('>') or (not records)):
+            records.append([[line], 0])
+        else:
+            records[-1][0].append(line)
+            records[-1][1] += len(line.strip())
+    if((minSequences < 2) or (len(records) < minSequences) or
+       (numChunks < 2)):
+        return [queryText]
+    totalLength = sum(length for (lines, length) in records)
+    chunks = [[]]
+    doneLength = 0
+    for (lines, length) in records:
+        if(chunks[-1] and (len(chunks) < numChunks) and
+           (doneLength >= totalLength * len(chunks) / float(numChunks))):
+            chunks.append([])
+        chunks[-1].extend(lines)
+        doneLength += length
+    return [''.join(lines) for lines in chunks]
+
+def submitChunks(job, chunkTexts):
+    # queue a job as separate chunk jobs; the job itself waits (in the
+    # 'split' state) until all chunks have finished
+    chunkDir = os.path.dirname(job['resultFile'])
+    queryPos = job['commandLine'].index('-query') + 1
+    for (chunkNum, chunkText) in enumerate(chunkTexts):
+        files = [tempfile.NamedTemporaryFile(dir = chunkDir, delete = False)
+                 for x in range(3)]
+        files[2].write(chunkText)
+        for chunkFile in files:
+            chunkFile.close()
+        commandLine = list(job['commandLine'])
+        commandLine[queryPos] = files[2].name
+        chunk = dict(job)
+        chunk.update({
+            'jobID': os.path.basename(files[0].name),
+            'commandLine': commandLine,
+            'resultFile': files[0].name,
+            'errorFile': files[1].name,
+            'inputFile': files[2].name,
+            'cacheKey': None,
+            'parentID': job['jobID'],
+            'chunk': chunkNum,
+            })
+        jobstore.saveJob(chunk)
+    job['state'] = 'split'
+    jobstore.saveJob(job)
+
+def mergeResults(resultFileName, chunkFileNames):
+    # joins the BLAST XML output of query chunks into one file; the
+    # header comes from the first chunk, and iterations (one per query
+    # sequence) are renumbered to follow on from the previous chunk
+    iterNum = 0
+    with open(resultFileName, 'w') as resultFile:
+        if(not chunkFileNames):
+            # no output from any chunk
+            return
+        for (chunkPos, chunkFileName) in enumerate(chunkFileNames):
+            section = 'header'
+            with open(chunkFileName, 'r') as chunkFile:
+                for line in chunkFile:
+                    tag = line.strip()
+                    if(tag == '<BlastOutput_iterations>'):
+                        if(chunkPos == 0):
+                            resultFile.write(line)
+                        section = 'iterations'
+                    elif(tag == '</BlastOutput_iterations>'):
+                        section = 'footer'
+                    elif(section == 'iterations'):
+                        if(tag.startswith('<Iteration_iter-num>')):
+                            iterNum += 1
+                            line = re.sub('>[0-9]+<', '>%d<' % iterNum, line)
+                        elif(tag.startswith('<Iteration_query-ID>')):
+                            line = re.sub('Query_[0-9]+',
+                                          'Query_%d' % iterNum, line)
+                        resultFile.write(line)
+                    elif((section == 'header') and (chunkPos == 0)):
+                        resultFile.write(line)
+        resultFile.write('</BlastOutput_iterations>\n</BlastOutput>\n')
+
+def joinResults(resultFileName, chunkFileNames):
+    # joins the tabular output of query chunks into one file
+    with open(resultFileName, 'w') as resultFile:
+        for chunkFileName in chunkFileNames:
+            with open(chunkFileName, 'r') as chunkFile:
+                shutil.copyfileobj(chunkFile, resultFile)
+
+def mergeJob(job, chunks):
+    # finish a split job once all of its chunks have finished
+    chunkFileNames = [x['resultFile'] for x in chunks
+                      if os.path.getsize(x['resultFile']) > 0]
+    if(blastresults.isTabular(job['commandLine'])):
+        joinResults(job['resultFile'], chunkFileNames)
+    else:
+        mergeResults(job['resultFile'], chunkFileNames)
+    exitCode = 0
+    with open(job['errorFile'], 'w') as errorFile:
+        for chunk in chunks:
+            with open(chunk['errorFile'], 'r') as chunkErrorFile:
+                errorFile.write(chunkErrorFile.read())
+            if(chunk['exitCode'] != 0):
+                exitCode = chunk['exitCode']
+    startTimes = [x['startTime'] for x in chunks if x['startTime']]
+    job['startTime'] = min(startTimes) if startTimes else None
+    for chunk in chunks:
+        for fileName in (chunk['resultFile'], chunk['errorFile']):
+            if(os.path.exists(fileName)):
+                os.unlink(fileName)
+        jobstore.deleteJob(chunk['jobID'])
+    finishJob(job, exitCode)
+
+def pythonExecutable():
+    # under an embedded WSGI server (e.g. mod_wsgi), sys.executable can be
+    # the web server rather than python
+    if('python' in os.path.basename(sys.executable)):
+        return sys.executable
+    return 'python'
+
+def jobStatus(jobID):
+    # returns the job, with 'queuePosition' (number of jobs that
+    # were submitted earlier and are still waiting) for queued jobs
+    job = jobstore.getJob(jobID)
+    if(job and (job['state'] == 'split')):
+        # a split job is running once any of its chunks has started
+        startTimes = [x['startTime'] for x in jobstore.chunkJobs(jobID)
+                      if x['startTime']]
+        if(startTimes):
+            job['state'] = 'running'
+            job['startTime'] = min(startTimes)
+        else:
+            job['state'] = 'queued'
+    if(job and (job['state'] == 'queued')):
+        job['queuePosition'] = jobstore.queuePosition(job)
+    return job
+
+def countInFile(fileName, text, blockSize = 1024 * 1024):
+    # number of times text appears in a file, read a block at a time so
+    # that large (or still growing) files aren't read into memory
+    count = 0
+    if((not fileName) or (not os.path.exists(fileName))):
+        return count
+    with open(fileName, 'r') as countFile:
+        carry = ''
+        while True:
+            block = countFile.read(blockSize)
+            if(not block):
+                break
+            block = carry + block
+            count += block.count(text)
+            # keep the end of the block in case text spans two blocks
+            carry = block[-(len(text) - 1):] if (len(text) > 1) else ''
+    return count
+
+def tabularQueriesDone(fileName):
+    # number of queries finished in tabular output. '# Query:' is written
+    # when a query is started, so the last query isn't counted until the
+    # '# BLAST processed' trailer is written at the end of the output.
+    queries = countInFile(fileName, '# Query: ')
+    with open(fileName, 'r') as resultFile:
+        resultFile.seek(max(os.path.getsize(fileName) - 1024, 0))
+        if(not ('# BLAST processed' in resultFile.read())):
+            queries = max(queries - 1, 0)
+    return queries
+
+def jobProgress(job):
+    # returns (finished queries, total queries) for a running job; BLAST
+    # writes one XML iteration per query sequence, so the number of these
+    # in the output (of every chunk, for a split job) is the number of
+    # queries done so far
+    totalQueries = countInFile(job['inputFile'], '\n>')
+    if(job['inputFile'] and os.path.exists(job['inputFile'])):
+        with open(job['inputFile'], 'r') as inputFile:
+            if(inputFile.read(1) == '>'):
+                totalQueries += 1
+    resultFiles = [x['resultFile'] for x in jobstore.chunkJobs(job['jobID'])]
+    if(not resultFiles):
+        resultFiles = [job['resultFile']]
+    if(blastresults.isTabular(job['commandLine'])):
+        doneQueries = sum(tabularQueriesDone(x) for x in resultFiles
+                          if (x and os.path.exists(x)))
+    else:
+        doneQueries = sum(countInFile(x, '</Iteration>') for x in resultFiles)
+    return (min(doneQueries, totalQueries), totalQueries)
+
+def processAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+def finishJob(job, exitCode):
+    job['state'] = 'finished'
+    job['endTime'] = time.time()
+    job['exitCode'] = exitCode
+    jobstore.saveJob(job)
+    if(job['inputFile'] and os.path.exists(job['inputFile'])):
+        os.unlink(job['inputFile'])
+    if(job.get('parentID')):
+        # chunk output is dealt with when the job is merged
+        return
+    # only store and process successful runs with no error output
+    if((exitCode != 0) or (os.path.getsize(job['errorFile']) > 0) or
+       (os.path.getsize(job['resultFile']) == 0)):
+        return
+    if(job.get('cacheKey') and (job['cacheBytes'] > 0)):
+        blastcache.storeResult(job['cacheKey'], job['resultFile'],
+                               job['cacheBytes'])
+    try:
+        blastresults.processResults(job)
+    except Exception:
+        # leave it to the Results page, which will show the error
+        pass
+
+def startJob(job):
+    resultFile = open(job['resultFile'], 'w')
+    errorFile = open(job['errorFile'], 'w')
+    try:
+        process = subprocess.Popen(job['commandLine'], stdout=resultFile,
+                                   stderr=errorFile, close_fds=True)
+    except OSError as e:
+        errorFile.write('Unable to run BLAST: %s\n' % e)
+        errorFile.close()
+        resultFile.close()
+        finishJob(job, -1)
+        return None
+    resultFile.close()
+    errorFile.close()
+    job['state'] = 'running'
+    job['startTime'] = time.time()
+    job['pid'] = process.pid
+    jobstore.saveJob(job)
+    return process
+
+def dispatch(maxJobs):
+    if(not os.path.isdir(os.path.dirname(lockFileName))):
+        os.makedirs(os.path.dirname(lockFileName))
+    lockFile = open(lockFileName, 'w')
+    # wait for any other dispatcher to finish
+    fcntl.flock(lockFile, fcntl.LOCK_EX)
+    # remove expired results; this only needs to happen now and then,
+    # so it is done here rather than on every page view
+    for error in jobstore.sweep():
+        sys.stderr.write(error + '\n')
+    running = dict() # jobID -> Popen object (None for orphaned jobs)
+    for job in jobstore.jobsInState('running'):
+        # jobs left running by an earlier dispatcher
+        if(processAlive(job['pid'])):
+            running[job['jobID']] = None
+        else:
+            finishJob(job, None)
+    while True:
+        for jobID in list(running.keys()):
+            process = running[jobID]
+            if(process is None):
+                if(processAlive(jobstore.getJob(jobID)['pid'])):
+                    continue
+                exitCode = None
+            else:
+                exitCode = process.poll()
+                if(exitCode is None):
+                    continue
+            finishJob(jobstore.getJob(jobID), exitCode)
+            del running[jobID]
+        for job in jobstore.jobsInState('split'):
+            chunks = jobstore.chunkJobs(job['jobID'])
+            if(chunks and all((x['state'] == 'finished') for x in chunks)):
+                mergeJob(job, chunks)
+        queued = jobstore.jobsInState('queued')
+        sessionRunning = dict()
+        for job in jobstore.jobsInState('running'):
+            sessionRunning[job['sessionID']] = (
+                sessionRunning.get(job['sessionID'], 0) + 1)
+        while(queued and (len(running) < maxJobs)):
+            job = min(queued, key=lambda x: (
+                sessionRunning.get(x['sessionID'], 0), x['submitTime']))
+            queued.remove(job)
+            process = startJob(job)
+            if(process):
+                running[job['jobID']] = process
+                sessionRunning[job['sessionID']] = (
+                    sessionRunning.get(job['sessionID'], 0) + 1)
+        if((not running) and (not queued)):
+            break
+        time.sleep(0.5)
+    lockFile.close()
+
+if(__name__ == '__main__'):
+    # dispatcher paths are relative to the cgi-bin directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    dispatch(int(sys.argv[1]) if (len(sys.argv) > 1) else 2)
@@ -0,0 +1,434 @@
+#!/usr/bin/python
+
+# blastresults.py -- process BLAST XML output once into a results store
+#
+# When a job finishes, its XML output is parsed into one row per HSP
+# (summary values, formatted alignment rows and gapless matching
+# sequences), and any subject sequences needed to show match context
+# are fetched with blastdbcmd. These are saved in a SQLite file next to
+# the results file ('<results file>.sqlite'), which the Results page
+# reads instead of parsing the XML on every view.
+#
+# Jobs run in summary mode use tabular output (-outfmt 7) instead of
+# XML. Only the aligned sequences are stored for these, and alignment
+# rows are formatted when an HSP is opened on the Results page.
+
+import os # file handling
+import json # for HSP frames
+import collections # for the region cache
+import threading # for the region cache lock
+import sqlite3 # for the results store
+import tempfile # for blastdbcmd input/output
+import subprocess # for running blastdbcmd
+import blastcache # for database signatures
+from Bio.Blast import NCBIXML # for XML parsing
+
+# the HSP columns have no declared type, so values come back exactly
+# as they were stored (i.e. integers stay integers)
+hspFields = ('num', 'query', 'subject', 'hitID', 'queryLength',
+             'subjectLength', 'alignLength', 'frame', 'score', 'bits',
+             'identity', 'coverage', 'subjCoverage', 'evalue',
+             'queryStart', 'queryEnd', 'sbjctStart', 'sbjctEnd',
+             'alignmentRows', 'gaplessQuery', 'gaplessSbjct',
+             'alignedQuery', 'alignedSbjct')
+# columns requested for summary mode (see isTabular)
+tabularFields = ('qseqid sseqid stitle qlen slen length qframe sframe score'
+                 ' bitscore nident evalue qstart qend sstart send qseq sseq')
+# positive-scoring pairs of different residues in BLOSUM62 (the default
+# matrix), marked with '+' in protein alignments
+positivePairs = set()
+for pair in ('AS', 'RK', 'RQ', 'ND', 'NH', 'NS', 'NB', 'DE', 'DB', 'DZ',
+             'QE', 'QK', 'QZ', 'EK', 'EB', 'EZ', 'HY', 'IL', 'IM', 'IV',
+             'LM', 'LV', 'KZ', 'MV', 'FW', 'FY', 'ST', 'WY', 'BZ'):
+    positivePairs.update((pair, pair[::-1]))
+
+def storeFileName(resultFileName):
+    return resultFileName + '.sqlite'
+
+def commandOption(commandLine, option):
+    if(option in commandLine):
+        return commandLine[commandLine.index(option) + 1]
+    return None
+
+def isTabular(commandLine):
+    # True for jobs run in summary mode
+    outputFormat = commandOption(commandLine, '-outfmt') or '5'
+    return (outputFormat.split()[0] == '7')
+
+class RegionCache(object):
+    # least recently used subject regions fetched from BLAST databases,
+    # kept for the life of the process (i.e. between requests when run
+    # as a WSGI application); regions for a database are dropped when
+    # its files change. A multi-threaded WSGI server shares the cache
+    # between threads, so it is only changed while holding its lock.
+    def __init__(self, maxBytes):
+        self.lock = threading.Lock()
+        self.maxBytes = maxBytes
+        self.numBytes = 0
+        self.regions = collections.OrderedDict() # (db, id, start, end) -> seq
+        self.index = dict() # (db, id) -> set of (start, end)
+        self.signatures = dict() # db -> database file signature
+    def checkDatabase(self, dbName):
+        signature = blastcache.databaseSignature(dbName)
+        with self.lock:
+            if(self.signatures.get(dbName, signature) != signature):
+                for key in [x for x in self.regions if x[0] == dbName]:
+                    self.remove(key)
+            self.signatures[dbName] = signature
+    def remove(self, key):
+        # (called with the lock held)
+        self.numBytes -= len(self.regions.pop(key))
+        self.index[key[:2]].discard(key[2:])
+    def get(self, dbName, hitID, start, end):
+        # returns the sequence for a range, if it is in a cached region
+        with self.lock:
+            for (regionStart, regionEnd) in self.index.get((dbName, hitID), ()):
+                if((regionStart <= start) and (end <= regionEnd)):
+                    key = (dbName, hitID, regionStart, regionEnd)
+                    seq = self.regions.pop(key)
+                    self.regions[key] = seq # mark as recently used
+                    return seq[(start - regionStart):(end - regionStart + 1)]
+        return None
+    def put(self, dbName, hitID, start, end, seq):
+        key = (dbName, hitID, start, end)
+        with self.lock:
+            if(key in self.regions):
+                self.remove(key)
+            self.regions[key] = seq
+            self.index.setdefault((dbName, hitID), set()).add((start, end))
+            self.numBytes += len(seq)
+            while(self.numBytes > self.maxBytes):
+                self.remove(next(iter(self.regions)))
+
+regionCache = RegionCache(32 * 1024 * 1024)
+
+def parseEntry(searchCode):
+    # 'id start-end' -> (id, start, end)
+    (hitID, seqRange) = searchCode.rsplit(' ', 1)
+    (start, end) = seqRange.split('-')
+    return (hitID, int(start), int(end))
+
+def mergeRanges(ranges):
+    # combines overlapping or adjacent (start, end) ranges
+    merged = list()
+    for (start, end) in sorted(ranges):
+        if(merged and (start <= merged[-1][1] + 1)):
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def fetchEntries(dbName, entries):
+    # returns sequences for 'id start-end' entries, using one blastdbcmd
+    # call; blastdbcmd skips entries it can't find, so if the number of
+    # sequences doesn't match, entries are fetched one at a time instead
+    seqs = list()
+    with tempfile.NamedTemporaryFile(delete=False) as searchFile:
+        searchFileName = searchFile.name
+        for searchCode in entries:
+            searchFile.write('%s\n' % searchCode)
+    commandLine = list(('blastdbcmd',
+                        '-db', dbName,
+                        '-entry_batch', searchFileName,
+                        '-outfmt', '%s'))
+    with tempfile.TemporaryFile() as outFile:
+        runProcess = subprocess.Popen(commandLine, stdout = outFile)
+        runProcess.wait()
+        outFile.seek(0)
+        for line in outFile:
+           seqs.append(line.rstrip())
+    os.unlink(searchFileName)
+    if((len(seqs) != len(entries)) and (len(entries) > 1)):
+        seqs = [(fetchEntries(dbName, [x]) or [''])[0] for x in entries]
+    return seqs
+
+def getSequences(dbName, searchDict):
+    # fills in sequences for 'id start-end' keys of searchDict. Ranges
+    # are looked up in regionCache; the rest are merged per subject and
+    # fetched together.
+    regionCache.checkDatabase(dbName)
+    pending = list() # (searchCode, id, start, end)
+    for searchCode in searchDict:
+        (hitID, start, end) = parseEntry(searchCode)
+        seq = regionCache.get(dbName, hitID, start, end)
+        if(seq is None):
+            pending.append((searchCode, hitID, start, end))
+        else:
+            searchDict[searchCode] = seq
+    if(not pending):
+        return
+    wanted = dict() # id -> list of (start, end)
+    for (searchCode, hitID, start, end) in pending:
+        wanted.setdefault(hitID, list()).append((start, end))
+    regions = [(hitID, start, end) for hitID in sorted(wanted)
+               for (start, end) in mergeRanges(wanted[hitID])]
+    seqs = fetchEntries(dbName, ['%s %d-%d' % x for x in regions])
+    for ((hitID, regionStart, regionEnd), seq) in zip(regions, seqs):
+        if(seq):
+            regionCache.put(dbName, hitID, regionStart, regionEnd, seq)
+        for (searchCode, entryID, start, end) in pending:
+            if((entryID == hitID) and (regionStart <= start) and
+               (end <= regionEnd)):
+                searchDict[searchCode] = seq[(start - regionStart):
+                                             (end - regionStart + 1)]
+
+def contextCode(hitID, sbjctStart, sbjctEnd, context):
+    # blastdbcmd entry for a subject match, with <context> extra bases
+    # on each side
+    matchStart = max(1,sbjctStart-context)
+    matchEnd = sbjctEnd+context
+    if(matchEnd < matchStart):
+        matchStart = max(1,sbjctEnd-context)
+        matchEnd = sbjctStart+context
+    return '%s %d-%d' % (hitID, matchStart, matchEnd)
+
+def contextCodes(hsp, context, translatedSub):
+    # returns the blastdbcmd entries needed to display an HSP row
+    codes = list()
+    if((context > 0) and not translatedSub):
+        codes.append(contextCode(hsp['hitID'], hsp['sbjctStart'],
+                                 hsp['sbjctEnd'], context))
+    if(translatedSub and (hsp['hitID'] != None)):
+        codes.append(contextCode(hsp['hitID'], hsp['sbjctStart'],
+                                 hsp['sbjctEnd'], context))
+    return codes
+
+def formatAlignment(hsp, translatedSub):
+    # alignment rows (100 columns per row) with query/subject positions.
+    # Positions are worked out once per row from the number of residues
+    # (non-gap columns) before and within the row, rather than by
+    # stepping through the alignment one column at a time.
+    rows = list()
+    alignLength = len(hsp.match)
+    queryDir =  1 if (hsp.query_start < hsp.query_end) else -1
+    sbjctDir = 1 if (hsp.sbjct_start < hsp.sbjct_end) else -1
+    incStepSbjct = 1
+    if(translatedSub):
+        incStepSbjct = 3
+    reverseSbjct = ('frame' in vars(hsp)) and (hsp.frame[1] < 0)
+    querySpos = hsp.query_start
+    sbjctSpos = hsp.sbjct_start
+    queryDone = sbjctDone = 0 # residues before the current row
+    for alignSpos in xrange(0, alignLength, 100):
+        alignPos = min(alignSpos + 100, alignLength)
+        queryRow = hsp.query[alignSpos:alignPos]
+        sbjctRow = hsp.sbjct[alignSpos:alignPos]
+        queryCount = len(queryRow) - queryRow.count('-')
+        sbjctCount = len(sbjctRow) - sbjctRow.count('-')
+        # a row that is all gaps keeps the start position of the row
+        # before it
+        if(queryCount > 0):
+            querySpos = hsp.query_start + queryDone * queryDir
+        if(sbjctCount > 0):
+            sbjctSpos = hsp.sbjct_start + sbjctDone * sbjctDir
+        queryDone += queryCount
+        sbjctDone += sbjctCount
+        # positions of the last residues up to the end of the row
+        oldQPos = hsp.query_start + max(queryDone - 1, 0) * queryDir
+        oldSPos = hsp.sbjct_start + max(sbjctDone - 1, 0) * sbjctDir
+        if(reverseSbjct):
+            adjSSPos = hsp.sbjct_end - (sbjctSpos - hsp.sbjct_start) * incStepSbjct
+            adjSEPos = hsp.sbjct_end - (oldSPos - hsp.sbjct_start) * incStepSbjct + (incStepSbjct-1)
+        else:
+            adjSSPos = hsp.sbjct_start + (sbjctSpos - hsp.sbjct_start) * incStepSbjct
+            adjSEPos = hsp.sbjct_start + (oldSPos - hsp.sbjct_start) * incStepSbjct + (incStepSbjct-1)
+        rows.append('\nQuery %9d %s %-9d\n' % (querySpos, queryRow, oldQPos))
+        rows.append('      %9s %s\n' % ('', hsp.match[alignSpos:alignPos]))
+        rows.append('Sbjct %9s %s %-9d\n' % (adjSSPos, sbjctRow, adjSEPos))
+    return ''.join(rows)
+
+class AlignedHsp(object):
+    # the HSP attributes used by formatAlignment, for HSPs read from
+    # tabular output
+    def __init__(self, hsp, match):
+        self.query = hsp['alignedQuery']
+        self.sbjct = hsp['alignedSbjct']
+        self.match = match
+        self.query_start = hsp['queryStart']
+        self.query_end = hsp['queryEnd']
+        self.sbjct_start = hsp['sbjctStart']
+        self.sbjct_end = hsp['sbjctEnd']
+        if(hsp['frame'] != None):
+            self.frame = tuple(json.loads(hsp['frame']))
+
+def matchLine(alignedQuery, alignedSbjct, protein):
+    # the middle line of an alignment: identical residues (as letters for
+    # proteins, '|' for nucleotides) and positive-scoring protein pairs
+    match = list()
+    for (queryRes, sbjctRes) in zip(alignedQuery.upper(),
+                                    alignedSbjct.upper()):
+        if((queryRes == '-') or (sbjctRes == '-')):
+            match.append(' ')
+        elif(queryRes == sbjctRes):
+            match.append(queryRes if protein else '|')
+        elif(protein and ((queryRes + sbjctRes) in positivePairs)):
+            match.append('+')
+        else:
+            match.append(' ')
+    return ''.join(match)
+
+def alignmentRows(hsp, programName):
+    # alignment rows for an HSP, formatting them now if the job was run
+    # in summary mode
+    if(hsp['alignmentRows'] != None):
+        return hsp['alignmentRows']
+    match = matchLine(hsp['alignedQuery'], hsp['alignedSbjct'],
+                      programName != 'blastn')
+    return formatAlignment(AlignedHsp(hsp, match),
+                           programName in ('tblastn', 'tblastx'))
+
+def parseTabular(resultFile):
+    # yields HSP rows (without 'num') from tabular output; lines starting
+    # with '#' are comments
+    for line in resultFile:
+        if(line.startswith('#') or (not line.strip())):
+            continue
+        (query, hitID, title, queryLength, subjectLength, alignLength,
+         queryFrame, sbjctFrame, score, bits, identities, evalue,
+         queryStart, queryEnd, sbjctStart, sbjctEnd, alignedQuery,
+         alignedSbjct) = line.rstrip('\r\n').split('\t')
+        subject = hitID
+        if('BL_ORD_ID' in hitID):
+            subject = title
+        if(" " in subject):
+            subject = subject[0:subject.find(" ")];
+        (queryLength, subjectLength, alignLength, queryStart, queryEnd,
+         sbjctStart, sbjctEnd) = [int(x) for x in (
+             queryLength, subjectLength, alignLength, queryStart, queryEnd,
+             sbjctStart, sbjctEnd)]
+        identity = float(identities) / alignLength * 100
+        coverage = float(abs(queryEnd - queryStart)+1) / queryLength * 100
+        subjCoverage = float(abs(sbjctEnd - sbjctStart)+1) / subjectLength * 100
+        frame = json.dumps((int(queryFrame), int(sbjctFrame)))
+        yield (query, subject, hitID, queryLength, subjectLength,
+               alignLength, frame, float(score), float(bits), identity,
+               coverage, subjCoverage, float(evalue), queryStart, queryEnd,
+               sbjctStart, sbjctEnd, None, alignedQuery.replace("-",""),
+               alignedSbjct.replace("-",""), alignedQuery, alignedSbjct)
+
+def createStore(connection):
+    with connection:
+        connection.execute('CREATE TABLE hsps (num INTEGER PRIMARY KEY, %s)'
+                           % ', '.join(hspFields[1:]))
+        connection.execute('CREATE TABLE sequences'
+                           ' (matchCode TEXT PRIMARY KEY, seq TEXT)')
+
+def processResults(job):
+    # parse the XML output of a finished job into its results store
+    commandLine = job['commandLine']
+    translatedSub = commandLine[0] in ('tblastn', 'tblastx')
+    storeName = storeFileName(job['resultFile'])
+    # build in a temporary file then rename, so a partly-processed store
+    # is never read
+    tmpFile = tempfile.NamedTemporaryFile(
+        dir = os.path.dirname(storeName), delete = False)
+    tmpFile.close()
+    connection = sqlite3.connect(tmpFile.name)
+    connection.text_factory = str
+    createStore(connection)
+    insertCommand = 'INSERT INTO hsps VALUES (%s)' % ', '.join(
+        '?' * len(hspFields))
+    numAlignments = 0
+    codes = set()
+    if(isTabular(commandLine)):
+        # context sequences are fetched when HSPs are opened
+        with open(job['resultFile'], 'r') as resultFile:
+            rows = list()
+            for row in parseTabular(resultFile):
+                rows.append((numAlignments,) + row)
+                numAlignments += 1
+                if(len(rows) >= 1000):
+                    with connection:
+                        connection.executemany(insertCommand, rows)
+                    rows = list()
+            with connection:
+                connection.executemany(insertCommand, rows)
+        connection.close()
+        os.rename(tmpFile.name, storeName)
+        return
+    with open(job['resultFile'], 'r') as resultFile:
+        for blast_record in NCBIXML.parse(resultFile):
+            rows = list()
+            for alignment in blast_record.alignments:
+                for hsp in alignment.hsps:
+                    query = blast_record.query
+                    subject = alignment.hit_def
+                    hitID = None
+                    if('hit_id' in vars(alignment)):
+                        hitID = alignment.hit_id
+                        if(not ('BL_ORD_ID' in alignment.hit_id)):
+                            subject = alignment.hit_id
+                    if(" " in query):
+                        query = query[0:query.find(" ")];
+                    if(" " in subject):
+                        subject = subject[0:subject.find(" ")];
+                    identity = float(hsp.identities) / (hsp.align_length) * 100
+                    coverage = float(abs(hsp.query_end - hsp.query_start)+1) / blast_record.query_length * 100
+                    subjCoverage = float(abs(hsp.sbjct_end - hsp.sbjct_start)+1) / alignment.length * 100
+                    frame = None
+                    if('frame' in vars(hsp)):
+                        frame = json.dumps(hsp.frame)
+                    row = (numAlignments, query, subject, hitID,
+                           blast_record.query_length, alignment.length,
+                           hsp.align_length, frame, hsp.score, hsp.bits,
+                           identity, coverage, subjCoverage, hsp.expect,
+                           hsp.query_start, hsp.query_end,
+                           hsp.sbjct_start, hsp.sbjct_end,
+                           formatAlignment(hsp, translatedSub),
+                           hsp.query.replace("-",""),
+                           hsp.sbjct.replace("-",""), None, None)
+                    codes.update(contextCodes(dict(zip(hspFields, row)),
+                                              job.get('context') or 0,
+                                              translatedSub))
+                    rows.append(row)
+                    numAlignments += 1
+            with connection:
+                connection.executemany(insertCommand, rows)
+    connection.close()
+    os.rename(tmpFile.name, storeName)
+    # fetch match context for the context size used in the search form
+    connection = openResults(job)
+    contextSequences(connection, commandOption(commandLine, '-db'), codes)
+    connection.close()
+
+def openResults(job):
+    # returns a connection to the results store of a finished job,
+    # processing the XML output first if that hasn't been done yet
+    storeName = storeFileName(job['resultFile'])
+    if(not os.path.exists(storeName)):
+        processResults(job)
+    connection = sqlite3.connect(storeName, timeout=30)
+    connection.text_factory = str
+    connection.row_factory = sqlite3.Row
+    return connection
+
+def countHsps(connection):
+    (count,) = connection.execute('SELECT COUNT(*) FROM hsps').fetchone()
+    return count
+
+def hspRows(connection, firstHsp = 0, count = -1):
+    # HSPs are numbered from 0, so a page of rows is a range of the
+    # primary key
+    return connection.execute(
+        'SELECT * FROM hsps WHERE num >= ? ORDER BY num LIMIT ?',
+        (firstHsp, count))
+
+def contextSequences(connection, dbName, matchCodes):
+    # returns {matchCode: sequence}; sequences that haven't been stored
+    # yet are fetched with blastdbcmd and added to the store
+    seqs = dict()
+    for matchCode in matchCodes:
+        row = connection.execute(
+            'SELECT seq FROM sequences WHERE matchCode = ?',
+            (matchCode,)).fetchone()
+        if(row):
+            seqs[matchCode] = row[0]
+    missing = dict((x, "") for x in matchCodes if not (x in seqs))
+    if(missing):
+        getSequences(dbName, missing)
+        with connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO sequences VALUES (?, ?)',
+                missing.items())
+        seqs.update(missing)
+    return seqs
@@ -0,0 +1,195 @@
+#!/usr/bin/python
+
+# jobstore.py -- SQLite store of BLAST jobs and their results files
+#
+# Each submitted search is one row, keyed on job ID and indexed by
+# session and submission time, so finding a session's latest results
+# doesn't depend on how many jobs have been run. Searches that are split
+# into chunks (see blastqueue.py) have an extra row per chunk, with
+# 'parentID' set to the job ID of the search. Old results are removed
+# by sweep(), which is run by the job dispatcher, and can also be run
+# periodically (e.g. from cron) as 'jobstore.py sweep' from the cgi-bin
+# directory.
+
+import os # file handling
+import sys # for command-line arguments
+import json # for storing command lines
+import time # for expiry
+import sqlite3 # for the job database
+
+storeName = 'templates/results/jobs.sqlite'
+jobFields = ('jobID', 'sessionID', 'state', 'submitTime', 'startTime',
+             'endTime', 'pid', 'exitCode', 'commandLine', 'resultFile',
+             'errorFile', 'inputFile', 'cacheKey', 'cacheBytes', 'context',
+             'parentID', 'chunk')
+# columns added after the first version of the store, with their types;
+# stores made by earlier versions have these columns added when opened
+addedColumns = (('context', 'INTEGER'), ('parentID', 'TEXT'),
+                ('chunk', 'INTEGER'))
+# the store is only set up (created or updated) once per process
+storeReady = False
+
+def setupStore(connection):
+    # write-ahead logging lets page views read while jobs are updated
+    connection.execute('PRAGMA journal_mode=WAL')
+    with connection:
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            ' jobID TEXT PRIMARY KEY, sessionID TEXT NOT NULL,'
+            ' state TEXT NOT NULL, submitTime REAL NOT NULL,'
+            ' startTime REAL, endTime REAL, pid INTEGER, exitCode INTEGER,'
+            ' commandLine TEXT, resultFile TEXT, errorFile TEXT,'
+            ' inputFile TEXT, cacheKey TEXT, cacheBytes INTEGER,'
+            ' context INTEGER, parentID TEXT, chunk INTEGER)')
+        columns = set(row['name'] for row in
+                      connection.execute('PRAGMA table_info(jobs)'))
+        for (column, columnType) in addedColumns:
+            if(not column in columns):
+                connection.execute('ALTER TABLE jobs ADD COLUMN %s %s' %
+                                   (column, columnType))
+        connection.execute('CREATE INDEX IF NOT EXISTS jobs_session'
+                           ' ON jobs (sessionID, submitTime)')
+        connection.execute('CREATE INDEX IF NOT EXISTS jobs_state'
+                           ' ON jobs (state, submitTime)')
+        connection.execute('CREATE INDEX IF NOT EXISTS jobs_submitted'
+                           ' ON jobs (submitTime)')
+        connection.execute('CREATE INDEX IF NOT EXISTS jobs_parent'
+                           ' ON jobs (parentID, chunk)')
+
+def connect():
+    global storeReady
+    storeDir = os.path.dirname(storeName)
+    if((not storeReady) and (not os.path.isdir(storeDir))):
+        os.makedirs(storeDir)
+    connection = sqlite3.connect(storeName, timeout=30)
+    connection.row_factory = sqlite3.Row
+    if(not storeReady):
+        setupStore(connection)
+        storeReady = True
+    return connection
+
+def rowToJob(row):
+    if(row is None):
+        return None
+    job = dict(zip(row.keys(), row))
+    job['commandLine'] = json.loads(job['commandLine'] or '[]')
+    return job
+
+def saveJob(job):
+    values = dict(job)
+    values['commandLine'] = json.dumps(job.get('commandLine', []))
+    connection = connect()
+    with connection:
+        connection.execute(
+            'INSERT OR REPLACE INTO jobs (%s) VALUES (%s)' %
+            (', '.join(jobFields), ', '.join(':' + x for x in jobFields)),
+            dict((field, values.get(field)) for field in jobFields))
+    connection.close()
+
+def getJob(jobID):
+    connection = connect()
+    job = rowToJob(connection.execute('SELECT * FROM jobs WHERE jobID = ?',
+                                      (jobID,)).fetchone())
+    connection.close()
+    return job
+
+def latestJob(sessionID):
+    connection = connect()
+    job = rowToJob(connection.execute(
+        'SELECT * FROM jobs WHERE sessionID = ? AND parentID IS NULL'
+        ' ORDER BY submitTime DESC LIMIT 1', (sessionID,)).fetchone())
+    connection.close()
+    return job
+
+def jobsInState(state):
+    connection = connect()
+    jobs = [rowToJob(row) for row in connection.execute(
+        'SELECT * FROM jobs WHERE state = ? ORDER BY submitTime', (state,))]
+    connection.close()
+    return jobs
+
+def chunkJobs(parentID):
+    connection = connect()
+    jobs = [rowToJob(row) for row in connection.execute(
+        'SELECT * FROM jobs WHERE parentID = ? ORDER BY chunk', (parentID,))]
+    connection.close()
+    return jobs
+
+def deleteJob(jobID):
+    connection = connect()
+    with connection:
+        connection.execute('DELETE FROM jobs WHERE jobID = ?', (jobID,))
+    connection.close()
+
+def queuePosition(job):
+    # number of jobs that were submitted earlier and are still waiting
+    connection = connect()
+    (position,) = connection.execute(
+        'SELECT COUNT(*) FROM jobs WHERE state = ? AND submitTime < ?',
+        ('queued', job['submitTime'])).fetchone()
+    connection.close()
+    return position
+
+def isResultsFile(fileName):
+    # read first lines to make sure it really is a results file
+    # [the program shouldn't delete files that aren't results files]
+    if(os.path.getsize(fileName) == 0):
+        # empty files are assumed to be empty results files
+        return True
+    with open(fileName, 'r') as resultFile:
+        if(fileName.endswith('.sqlite')):
+            # processed results (see blastresults.py)
+            return (resultFile.read(16) == 'SQLite format 3\0')
+        line1 = resultFile.readline()
+        if(('BLAST' in line1) or ('USAGE' in line1) or
+           ('Command line argument error:' in line1) or
+           ('Error: NCBI' in line1) or ('CFastaReader' in line1) or
+           ('Unable to run BLAST' in line1)):
+            return True
+        line2 = resultFile.readline()
+        return ('NCBI BlastOutput' in line2)
+
+def sweep(maxAge=60 * 60 * 24):
+    # NOTE: this method deletes files. While attempts are made to make
+    # sure only appropriate files are deleted, it is not advisable to
+    # trust this completely (i.e. don't run the web server as a user
+    # that has access to critical system files)
+    # Returns a list of problems found when deleting files.
+    errors = list()
+    connection = connect()
+    expired = connection.execute(
+        'SELECT * FROM jobs WHERE submitTime < ? AND state = ?',
+        (time.time() - maxAge, 'finished')).fetchall()
+    for row in expired:
+        filesLeft = False
+        for fileName in (row['resultFile'], row['errorFile'],
+                         row['resultFile'] + '.sqlite'):
+            if((not fileName) or (not os.path.exists(fileName))):
+                continue
+            if(not isResultsFile(fileName)):
+                errors.append('File \'%s\' does not look like a results file'
+                              % fileName)
+                filesLeft = True
+                continue
+            try:
+                os.remove(fileName)
+            except OSError:
+                errors.append('File \'%s\' cannot be deleted by %s' %
+                              (fileName, os.getuid()))
+                filesLeft = True
+        if(filesLeft):
+            # keep the job, so that its files are tried again next time
+            continue
+        with connection:
+            connection.execute('DELETE FROM jobs WHERE jobID = ?',
+                               (row['jobID'],))
+    connection.close()
+    return errors
+
+if(__name__ == '__main__'):
+    if((len(sys.argv) < 2) or (sys.argv[1] != 'sweep')):
+        sys.stderr.write('Usage: %s sweep\n' % sys.argv[0])
+        sys.exit(1)
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    for error in sweep():
+        sys.stderr.write(error + '\n')
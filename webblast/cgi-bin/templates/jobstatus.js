@@ -0,0 +1,69 @@
+/*
+  jobstatus.js -- keep the Results page up to date while a BLAST job is
+  waiting or running
+
+  If the page has a 'jobStatus' element (see getResults in blast.py),
+  the job status is fetched from blast.py (with status=json) every few
+  seconds and shown in that element. When the job has finished, the
+  Results tab is submitted so that the results are shown.
+*/
+
+var jobStatusInterval = 3000; // milliseconds between status requests
+var jobStatusRetryInterval = 15000; // ... after a failed request
+
+function jobStatusURL(form) {
+  var sessionField = form.querySelector('input[name="sessionID"]');
+  var url = form.getAttribute('action') || window.location.href;
+  return url + ((url.indexOf('?') < 0) ? '?' : '&') +
+    'status=json&sessionID=' + encodeURIComponent(sessionField.value);
+}
+
+function jobStatusText(status) {
+  if (status.state == 'queued') {
+    return 'Your BLAST job is waiting to run (' + status.queuePosition +
+      ' job(s) ahead of it).';
+  }
+  var text = 'Your BLAST job has been running for ' + status.elapsed +
+    ' seconds';
+  if (status.queries) {
+    text += ' (' + status.queriesDone + ' of ' + status.queries +
+      ' queries done, ' + Math.round(status.progress * 100) + '%)';
+  }
+  return text + '. Results will be shown when it has finished.';
+}
+
+function pollJobStatus() {
+  var statusElement = document.getElementById('jobStatus');
+  var form = document.forms[0];
+  if (!statusElement || !form || !window.XMLHttpRequest ||
+      !form.querySelector('input[name="sessionID"]')) return;
+  var request = new XMLHttpRequest();
+  request.onreadystatechange = function() {
+    if (request.readyState != 4) return;
+    var status = null;
+    if (request.status == 200) {
+      try {
+        status = JSON.parse(request.responseText);
+      } catch (e) {
+        status = null;
+      }
+    }
+    if (!status) {
+      setTimeout(pollJobStatus, jobStatusRetryInterval);
+    } else if (status.state == 'finished') {
+      // show the results (or error output) of the finished job
+      form.querySelector('#t_results button').click();
+    } else if ((status.state == 'queued') || (status.state == 'running')) {
+      statusElement.innerHTML = jobStatusText(status);
+      setTimeout(pollJobStatus, jobStatusInterval);
+    }
+  };
+  request.open('GET', jobStatusURL(form), true);
+  request.send(null);
+}
+
+if (window.addEventListener) {
+  window.addEventListener('load', function() {
+    setTimeout(pollJobStatus, jobStatusInterval);
+  }, false);
+}
@@ -15,28 +15,66 @@ import sys # for command-line argument parsing
 import shutil # for copying files
 import math # for label placement
 
+# templates are compiled once per process (and again if the file
+# changes)
+templateCache = dict()
+
+def compileTemplate(fileName):
+    # returns (plan, fields) for a template. The plan is a list of text
+    # to write as-is (runs of lines without parameters), and lines with
+    # parameters, which are lists of alternating text and parameter
+    # names ('%(name)'); fields are the form fields in the template.
+    plan = list()
+    fields = set()
+    text = list()
+    for line in open(fileName, 'r'):
+        fields.update(re.findall('<(?:input|textarea|select).*?name="(.*?)"', line))
+        pieces = re.split("%\((.*?)\)", line)
+        if(len(pieces) == 1):
+            text.append(line.rstrip() + '\n')
+            continue
+        if(text):
+            plan.append(''.join(text))
+            text = list()
+        plan.append(pieces)
+    if(text):
+        plan.append(''.join(text))
+    return (plan, fields)
+
+def loadTemplate(fileName):
+    # returns the compiled template, or None if the file doesn't exist
+    try:
+        fileStat = os.stat(fileName)
+    except OSError:
+        templateCache.pop(fileName, None)
+        return None
+    signature = (fileStat.st_mtime, fileStat.st_size)
+    if((not (fileName in templateCache)) or
+       (templateCache[fileName][0] != signature)):
+        templateCache[fileName] = (signature, compileTemplate(fileName))
+    return templateCache[fileName][1]
+
 def printFile(fileName, parameters, printContent):
     if(printContent):
         # HTTP header
         print('Content-type: text/html\n')
-    if(not(os.path.exists(fileName))):
+    template = loadTemplate(fileName)
+    if(template == None):
         print('File does not exist: %s' % fileName)
         return
-    readFile = open(fileName, 'r')
-    for line in readFile:
-        paramMatches = re.findall("%\((.*?)\)", line)
-        for param in paramMatches:
-            # doing a 'manual' replacement because the usual %(param)
-            # notation doesn't seem to work
-            if(param in parameters):
-                line = line.replace('%(' + param + ')',
-                                    parameters[param])
-            else:
-                line = line.replace('%(' + param + ')', '')
-        seenFields = re.findall('<(?:input|textarea|select).*?name="(.*?)"', line)
-        for field in seenFields:
-            parameters['seenFields'].add(field)
-        print(line.rstrip())
+    (plan, fields) = template
+    parameters['seenFields'].update(fields)
+    output = list()
+    for item in plan:
+        if(isinstance(item, str)):
+            output.append(item)
+            continue
+        # odd-numbered pieces are parameters; missing parameters are
+        # left blank
+        line = [(parameters.get(piece, '') if (pos % 2) else piece)
+                for (pos, piece) in enumerate(item)]
+        output.append(''.join(line).rstrip() + '\n')
+    sys.stdout.write(''.join(output))
 
 def printHiddenValues(lastForm, parameters):
     # make sure runProgram state isn't preserved across multiple submits